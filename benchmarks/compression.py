@@ -0,0 +1,99 @@
+"""
+Benchmark of the compressed transport between the bot and the data API.
+
+For each endpoint, fetches the response without compression and with each
+supported encoding, and reports the bytes transferred and the time to decode
+(decompress and parse) the body. The results are written as JSON.
+
+Usage (with the mock API running):
+  python -m benchmarks.compression [--url http://localhost] [--key "open sesame"]
+      [--repeats 5] [--output results.json]
+"""
+
+import argparse
+import gzip
+import json
+import sys
+import time
+import zlib
+from datetime import timedelta
+from typing import Dict
+
+import requests
+
+from bot.helpers import YearWeek
+
+DECOMPRESSORS = {
+    "identity": lambda data: data,
+    "gzip": gzip.decompress,
+    "deflate": zlib.decompress,
+}
+
+
+def measure(url: str, key: str, params: Dict, encoding: str, repeats: int) -> Dict:
+    """ Fetch url with the encoding, and measure the transfer and decoding
+
+    :return: dict of bytes transferred, and best times in milliseconds
+    """
+    best_total = best_decode = float("inf")
+    size = 0
+    for _ in range(repeats):
+        t = time.perf_counter()
+        res = requests.get(
+            url,
+            params,
+            headers={"x-api-key": key, "Accept-Encoding": encoding},
+            stream=True,
+        )
+        res.raise_for_status()
+        raw = res.raw.read(decode_content=False)
+        t_received = time.perf_counter()
+        used = res.headers.get("Content-Encoding", "identity")
+        json.loads(DECOMPRESSORS[used](raw))
+        t_decoded = time.perf_counter()
+
+        size = len(raw)
+        best_total = min(best_total, t_decoded - t)
+        best_decode = min(best_decode, t_decoded - t_received)
+    return {
+        "content_encoding": used,
+        "bytes": size,
+        "decode_ms": 1000 * best_decode,
+        "total_ms": 1000 * best_total,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost")
+    parser.add_argument("--key", default="open sesame")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="output file, default is stdout")
+    args = parser.parse_args(argv)
+
+    start = YearWeek.now() + timedelta(weeks=-52)
+    endpoints = {
+        "/users": {},
+        "/skills": {},
+        "/allocations": {"start": str(start)},
+    }
+    results = {}
+    for route, params in endpoints.items():
+        url = args.url + route
+        results[route] = {
+            encoding: measure(url, args.key, params, encoding, args.repeats)
+            for encoding in DECOMPRESSORS
+        }
+        identity = results[route]["identity"]["bytes"]
+        for result in results[route].values():
+            result["ratio"] = identity / result["bytes"] if result["bytes"] else None
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Benchmark of the candidate search at company scale.
+
+Generates synthetic users and allocation histories with the generator of the
+mock data api (mock_data_api/synthetic.py), and times
+find_person_by_skills, chronological_allocations and Bot.find_candidates
+(end to end, through Bot.reply) against a stubbed Datasource.
+Latency percentiles and allocation counts are written as JSON.
+
+Usage:
+  python -m benchmarks.find_candidates [--sizes 1000 10000 100000]
+      [--queries 50] [--seed 0] [--output results.json]
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Callable, Dict
+
+from bot.bot import Bot
+from bot.chatBotDatabase import get_database_object
+from bot.data_api.datasource import NotFound
+from bot.helpers import YearWeek
+from bot.searches.find_kit import chronological_allocations, find_person_by_skills
+
+# The synthetic company of the mock data api, which is not a package
+MOCK_API_DIR = Path(__file__).parents[1] / "mock_data_api"
+if str(MOCK_API_DIR) not in sys.path:
+    sys.path.insert(0, str(MOCK_API_DIR))
+from synthetic import SyntheticCompany
+
+
+class StubDatasource:
+    "Datasource serving a SyntheticCompany from memory"
+
+    def __init__(self, company: SyntheticCompany):
+        self.company = company
+
+    def user_info(self, user_id):
+        return self.company.users.get(user_id)
+
+    def all_users(self):
+        return dict(self.company.users)
+
+    def skills_by_user(self):
+        return {user: info["skills"] for user, info in self.company.users.items()}
+
+    def allocations_within(self, start: YearWeek, end: YearWeek = None):
+        start = str(start)
+        end = str(end) if end else None
+        result = {}
+        for user, allocations in self.company.allocations.items():
+            matching = [
+                allocation
+                for allocation in allocations
+                if start <= allocation["yearWeek"]
+                and (end is None or allocation["yearWeek"] <= end)
+            ]
+            if matching:
+                result[user] = matching
+        return result
+
+    def users_and_allocations(self, start: YearWeek, end: YearWeek = None):
+        return self.all_users(), self.allocations_within(start, end)
+
+    def search_candidates(self, *_args, **_kwargs):
+        # Measure the client side search
+        raise NotFound("/search")
+
+
+def timings(func: Callable[[], object], repeats: int) -> Dict[str, float]:
+    """ Run func repeatedly, and return latency percentiles in milliseconds
+
+    :param func: Function to time
+    :param repeats: How many times to run the function
+    :return: dict of latency statistics
+    """
+    samples = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        func()
+        samples.append(1000 * (time.perf_counter() - t))
+    samples.sort()
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": samples[-1],
+    }
+
+
+def benchmark(nb_employees: int, nb_queries: int, seed: int) -> Dict:
+    """ Benchmark the candidate search with a company of nb_employees
+
+    :param nb_employees: Size of the synthetic company
+    :param nb_queries: How many queries to time for each function
+    :param seed: Seed for generating the company and queries
+    :return: Results as dict
+    """
+    result = {"employees": nb_employees, "setup_s": {}}
+
+    t = time.perf_counter()
+    # allocations from a year ago to a year ahead
+    company = SyntheticCompany(
+        nb_employees, seed, date.today() - timedelta(weeks=52), nb_weeks=2 * 52
+    )
+    result["setup_s"]["generate"] = time.perf_counter() - t
+    ds = StubDatasource(company)
+
+    nb_allocations = sum(len(a) for a in company.allocations.values())
+    start_week = YearWeek.now()
+    users = ds.all_users()
+    allocations = ds.allocations_within(start_week)
+    result["allocations"] = {
+        "total": nb_allocations,
+        "per_employee": nb_allocations / nb_employees,
+        "from_current_week": sum(len(a) for a in allocations.values()),
+    }
+
+    t = time.perf_counter()
+    bot = Bot(
+        send_message=lambda *_: True,
+        check_schedule="0 0 1 1 *",
+        message_interval=30,
+        user_db=get_database_object("sqlite", ":memory:"),
+        data_source=ds,  # type: ignore
+    )
+    result["setup_s"]["bot"] = time.perf_counter() - t
+
+    rng = random.Random(seed)
+    queries = [company.random_query(rng) for _ in range(nb_queries)]
+    employees = rng.choices(list(company.allocations), k=nb_queries)
+
+    def run_each(func, items):
+        it = iter(items)
+        return lambda: func(next(it))
+
+    end_week = start_week + timedelta(weeks=52)
+    range_end = start_week + timedelta(weeks=8)
+    result["timings_ms"] = {
+        "find_person_by_skills": timings(
+            run_each(
+                lambda skills: find_person_by_skills(
+                    skills, users, allocations, str(start_week)
+                ),
+                queries,
+            ),
+            nb_queries,
+        ),
+        "chronological_allocations": timings(
+            run_each(
+                lambda employee: list(
+                    chronological_allocations(
+                        company.allocations[employee], start_week, end_week
+                    )
+                ),
+                employees,
+            ),
+            nb_queries,
+        ),
+        "Bot.find_candidates": timings(
+            run_each(
+                lambda skills: bot.reply("benchmark", "find " + ", ".join(skills)),
+                queries,
+            ),
+            nb_queries,
+        ),
+        "Bot.find_candidates range": timings(
+            run_each(
+                lambda skills: bot.reply(
+                    "benchmark",
+                    f"find w{start_week.week}-w{range_end.week} 50% "
+                    + ", ".join(skills),
+                ),
+                queries,
+            ),
+            nb_queries,
+        ),
+    }
+    bot.scheduler.shutdown()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+    )
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="output file, default is stdout")
+    args = parser.parse_args(argv)
+
+    results = {
+        "python": sys.version.split()[0],
+        "week": str(YearWeek.now()),
+        "results": [],
+    }
+    for size in args.sizes:
+        print(f"benchmarking {size} employees", file=sys.stderr)
+        results["results"].append(benchmark(size, args.queries, args.seed))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
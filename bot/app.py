@@ -8,12 +8,15 @@ from slackeventsapi import SlackEventAdapter
 import atexit
 import json
 import os
+from datetime import timedelta
 
 from dotenv import load_dotenv, find_dotenv
 
-from bot.bot import Bot
-from bot.chatBotDatabase import get_database_object
-from bot.data_api.datasource import Datasource
+from bot.bot import Bot, CandidateQuery
+from bot.chatBotDatabase import DEFAULT_POOL_SIZE, get_database_object
+from bot.data_api.datasource import PAGE_SIZE, Datasource
+from bot.data_api.async_datasource import AsyncDatasource, SyncFacade
+from bot.data_api.mirror import DataMirror
 
 # Get the tokens from .env file (.env.sample in version control)
 # Use load_dotenv to enable overwriting the values from system environment
@@ -60,16 +63,57 @@ INTERVAL = int(ENV["BOT_DAYS_BETWEEN_MESSAGES"])
 DB_TYPE = ENV["DB_TYPE"]
 DB_CONNECTION_STRING = ENV["DB_CONNECTION_STRING"]
 
-bot_db = get_database_object(DB_TYPE, DB_CONNECTION_STRING, retry_delays=(1, 2, 5))
+bot_db = get_database_object(
+    DB_TYPE,
+    DB_CONNECTION_STRING,
+    retry_delays=(1, 2, 5),
+    pool_size=int(ENV.get("DB_POOL_SIZE", DEFAULT_POOL_SIZE)),
+)
 atexit.register(bot_db.close)
 
+if ENV.get("DATA_API_ASYNC", "").lower() in ("1", "true", "yes"):
+    if ENV.get("DATA_MIRROR_FILE"):
+        print("DATA_MIRROR_FILE is ignored, the async data api client has no mirror")
+    data_source = SyncFacade(
+        AsyncDatasource(
+            ENV["DATA_API_URL"],
+            ENV["DATA_API_KEY"],
+            max_concurrency=int(ENV.get("DATA_API_POOL_SIZE", 10)),
+        )
+    )
+else:
+    mirror = None
+    if ENV.get("DATA_MIRROR_FILE"):
+        mirror = DataMirror(
+            ENV["DATA_MIRROR_FILE"],
+            sync_interval=timedelta(
+                minutes=float(ENV.get("DATA_MIRROR_SYNC_MINUTES", 30))
+            ),
+        )
+        atexit.register(mirror.close)
+    data_source = Datasource(
+        ENV["DATA_API_URL"],
+        ENV["DATA_API_KEY"],
+        pool_size=int(ENV.get("DATA_API_POOL_SIZE", 10)),
+        mirror=mirror,
+        page_size=int(ENV.get("DATA_API_PAGE_SIZE", PAGE_SIZE)),
+    )
+atexit.register(data_source.close)
+
 bot = Bot(
     send_message=send_message,
     check_schedule=CRON,
     message_interval=INTERVAL,
     user_db=bot_db,
-    data_source=Datasource(ENV["DATA_API_URL"], ENV["DATA_API_KEY"]),
+    data_source=data_source,
+    sync_interval=timedelta(minutes=float(ENV.get("DATA_API_SYNC_MINUTES", 10))),
+    write_behind_interval=(
+        timedelta(seconds=float(ENV["DB_WRITE_BEHIND_SECONDS"]))
+        if ENV.get("DB_WRITE_BEHIND_SECONDS")
+        else None
+    ),
 )
+atexit.register(bot.flush_writes)
 
 
 @app.route("/slack/events/interact", methods=["POST"])
@@ -141,16 +185,11 @@ def interaction():
     elif action_dict["action_id"] == "show_more_candidates":
         og_timestamp = json_form["container"]["message_ts"]
         channel = json_form["channel"]["id"]
-        nb_already_suggested, query_skills, query_year, query_week = action_dict[
-            "value"
-        ].split("_")
+        nb_already_suggested, _, query = action_dict["value"].partition("_")
         nb_already_suggested = int(nb_already_suggested)
-        query_skills = query_skills.split(",")
-        query_year = int(query_year)
-        query_week = int(query_week)
 
         formatted_suggestions = bot.show_more_candidates(
-            (query_skills, query_year, query_week), nb_already_suggested
+            CandidateQuery.decode(query), nb_already_suggested
         )
 
         slack_client.chat_update(
@@ -1,20 +1,86 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from typing import NamedTuple, Optional, Callable, List, Iterable, Dict, Any, Tuple
 
 import re
+import requests
 from time import time
 from datetime import datetime, timedelta
 
-from bot.data_api.datasource import Datasource, Timeout
+from bot.data_api.datasource import Datasource, NotFound, Timeout
 from bot.recommenders.skill_recommender import SkillRecommenderCF
-from bot.chatBotDatabase import IBotDatabase, User, HistoryEntry
-from bot.searches.find_kit import find_person_by_skills
+from bot.chatBotDatabase import IBotDatabase, User, HistoryEntry, WriteBehind
+from bot.searches.find_kit import (
+    SEARCH_WEEKS,
+    find_person_by_skills,
+    find_person_available_in_range,
+    find_team,
+)
 from bot.helpers import YearWeek
 
 
 BotReply = Dict[str, Any]
 
+# Most employees matched by the recommender that are sent to the api's search,
+# to keep the url short. With more, all users are fetched instead.
+MAX_SEARCH_IDS = 500
+
+# Matches the query part of find commands
+#   optional week, or range of weeks, e.g. 'w5' or 'w5-w12'
+#   optional free capacity percentage, e.g. '60%' or '60% free'
+#   the skills, separated with commas
+# Examples
+#   python, java
+#   w12 python
+#   w5-w12 60% free python, java
+FIND_QUERY_PATTERN = (
+    r"(?:(?P<start>w\d{1,2})(?:\s*-\s*(?P<end>w\d{1,2}))?\s+)?"
+    r"(?:(?P<free>\d{1,3})\s*%(?:\s+free)?\s+)?"
+    r"(?P<skills>.*)"
+)
+
+
+class CandidateQuery(NamedTuple):
+    skills: List[str]
+    start_week: YearWeek
+    end_week: Optional[YearWeek] = None
+    """Last week of the range, None when looking for the next free weeks"""
+    min_free: int = 0
+    """Free capacity percentage required for every week of the range"""
+
+    def encode(self) -> str:
+        """Encode the query as string, e.g. to store it in a button value
+
+        The skills must not contain ',' or '_' characters.
+        """
+        end = str(self.end_week) if self.end_week else ""
+        return f"{','.join(self.skills)}_{self.start_week}_{end}_{self.min_free}"
+
+    def free_str(self) -> str:
+        "Describe the required free capacity, e.g. 'at least 60% free'"
+        if self.min_free:
+            return f"at least {self.min_free}% free"
+        return "free"
+
+    @classmethod
+    def decode(cls, value: str) -> "CandidateQuery":
+        """Decode query encoded with CandidateQuery.encode
+
+        Also accepts the older form: <skills>_<year>_<week>
+        """
+        parts = value.split("_")
+        skills = parts[0].split(",")
+        if len(parts) == 3:
+            return cls(skills, YearWeek(int(parts[1]), int(parts[2])))
+        _skills, start, end, min_free = parts
+        return cls(
+            skills,
+            YearWeek.from_string(start),
+            YearWeek.from_string(end) if end else None,
+            int(min_free),
+        )
+
 
 class Command(NamedTuple):
     name: str
@@ -52,16 +118,45 @@ class Bot:
         message_interval: int,
         user_db: IBotDatabase,
         data_source: Datasource,
+        sync_interval: Optional[timedelta] = timedelta(minutes=10),
+        write_behind_interval: Optional[timedelta] = None,
     ):
+        """
+        :param sync_interval: How often to apply the changes of the data api,
+            None to not sync
+        :param write_behind_interval: How often to write the reminders of the
+            checks and the history from the users in one transaction. When None,
+            the history is written right away, and the reminders of each check
+            at its end.
+        """
         self.send_message = send_message
         self.user_db: IBotDatabase = user_db
         self.data_source: Datasource = data_source
         self.recommender = SkillRecommenderCF(self.data_source)
 
         self._message_interval = timedelta(days=message_interval)
+        self._writes = WriteBehind(self.user_db)
+        self._write_behind = bool(write_behind_interval)
 
         self.scheduler = BackgroundScheduler()
         self.scheduler.add_job(self._tick, CronTrigger.from_crontab(check_schedule))
+        mirror = getattr(self.data_source, "mirror", None)
+        if mirror is not None:
+            self.scheduler.add_job(
+                self.data_source.sync_mirror,
+                IntervalTrigger(seconds=mirror.sync_interval.total_seconds()),
+                next_run_time=datetime.now(),
+            )
+        if sync_interval and hasattr(self.data_source, "sync_changes"):
+            self.scheduler.add_job(
+                self._sync_changes,
+                IntervalTrigger(seconds=sync_interval.total_seconds()),
+            )
+        if write_behind_interval:
+            self.scheduler.add_job(
+                self._writes.flush,
+                IntervalTrigger(seconds=write_behind_interval.total_seconds()),
+            )
         self.scheduler.start()
 
         def matcher(regex):
@@ -100,12 +195,19 @@ class Bot:
                 self.sign_off,
                 help_text="leave the service",
             ),
+            Command(
+                "find team",
+                matcher(r"find\s+team\s+" + FIND_QUERY_PATTERN),
+                self.find_team,
+                requires_signup=False,
+                help_text="find the smallest available team with certain skills, usage as in `find`",
+            ),
             Command(
                 "find",
-                matcher("find\s+(w\d{1,2}\s+)?(.*)"),
+                matcher(r"find\s+" + FIND_QUERY_PATTERN),
                 self.find_candidates,
                 requires_signup=False,
-                help_text="find candidates with certain skills",
+                help_text="find candidates with certain skills, usage: `find [w<week>[-w<week>]] [<percent>% free] <skill>, ...`",
             ),
         ]
 
@@ -148,52 +250,207 @@ class Bot:
                     break
                 try:
                     return command.action(user_id, message, match)
-                except Timeout:
+                except (Timeout, requests.ConnectionError):
+                    # Timeout includes CircuitOpen, and both data api clients
+                    # raise requests.ConnectionError when it is unreachable
                     return {
                         "text": "Sorry, I'm having some connection issues right now"
                     }
         return self.help()
 
-    def find_candidates(self, _user_id: str, _message: str, match: re.Match):
-        "Find candidate employees who have particular skills"
-        start_week = YearWeek.now()
+    @staticmethod
+    def _parse_candidate_query(match: re.Match) -> CandidateQuery:
+        """ Construct candidate query from the match of a find command
 
-        requested_week, skills = match.groups()
-        if requested_week:
-            y, w = start_week
+        :param match: match object containing the groups start, end, free and skills
+        :return: The query
+        :raises ValueError: with a message for the user, if the query is not valid
+        """
+        current_week = YearWeek.now()
+
+        def upcoming(requested_week: str, after: YearWeek) -> YearWeek:
+            y, w = after
             week = int(requested_week[1:])
             if week < w:
                 y += 1
-            start_week = YearWeek(y, week)
+            return YearWeek(y, week)
+
+        start_week = current_week
+        end_week = None
+        min_free = 0
+        if requested_week := match["start"]:
+            start_week = upcoming(requested_week, current_week)
             if not start_week.valid():
-                return {
-                    "text": f"The requested week ({requested_week.strip()}) is not valid"
-                }
+                raise ValueError(f"The requested week ({requested_week}) is not valid")
+        if requested_week := match["end"]:
+            end_week = upcoming(requested_week, start_week)
+            if not end_week.valid():
+                raise ValueError(f"The requested week ({requested_week}) is not valid")
+        if match["free"]:
+            min_free = int(match["free"])
+            if min_free > 100:
+                raise ValueError(f"The requested capacity ({min_free}%) is not valid")
+            if end_week is None:
+                end_week = start_week
+
+        skills = {s.strip() for s in match["skills"].split(",")}
+        return CandidateQuery(list(skills), start_week, end_week, min_free)
 
-        skills = {s.strip() for s in skills.split(",")}
-        users = self.data_source.all_users()
-        allocations = self.data_source.allocations_within(start_week, None)
+    def find_candidates(self, _user_id: str, _message: str, match: re.Match):
+        "Find candidate employees who have particular skills"
+        try:
+            query = self._parse_candidate_query(match)
+        except ValueError as e:
+            return {"text": str(e)}
 
-        people = find_person_by_skills(skills, users, allocations, str(start_week))
+        people = self._search_candidates(query)
 
         if not people:
             return {"text": "I could not find anyone available with those skills"}
         else:
-            return self._format_candidate_suggestions(
-                people[:5], (skills, start_week.year, start_week.week)
+            return self._format_candidate_suggestions(people[:5], query)
+
+    def find_team(self, _user_id: str, _message: str, match: re.Match):
+        "Find the smallest team of available employees covering the skills"
+        try:
+            query = self._parse_candidate_query(match)
+        except ValueError as e:
+            return {"text": str(e)}
+        # The whole team must be available at the same time
+        if query.end_week is None:
+            query = query._replace(end_week=query.start_week)
+
+        users, allocations = self._fetch_candidate_data(
+            query.skills, query.start_week, query.end_week, query.min_free
+        )
+        team, missing = find_team(
+            query.skills,
+            users,
+            allocations,
+            query.start_week,
+            query.end_week,
+            query.min_free,
+        )
+
+        if not team:
+            return {"text": "I could not find anyone available with those skills"}
+
+        if query.start_week == query.end_week:
+            when = f"on {query.start_week}"
+        else:
+            when = f"every week from {query.start_week} to {query.end_week}"
+        blocks = [
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": f"I found the following team, who are {query.free_str()} {when}",
+                },
+            }
+        ]
+        for employee_id, skill, availability in team:
+            skill_str = ", ".join(skill)
+            _w, p = availability[0]
+            blocks.append(
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": f"*{employee_id}*\n\twith skills: {skill_str}\n\tfree every week: {round(100*(1-p))}%",
+                    },
+                }
+            )
+        if missing:
+            blocks.append(
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": f"I could not find anyone available with: {', '.join(missing)}",
+                    },
+                }
             )
+        return {"blocks": blocks}
+
+    def _search_candidates(self, query: CandidateQuery) -> List:
+        """ Find the candidates matching the query, best candidates first
+
+        :param query: Query for which to find the candidates
+        :return: List of candidates as returned by the find_kit functions
+        """
+        # Match also similar skills, e.g. "React" with "ReactJS"
+        skill_weights = self.recommender.skill_matches(query.skills)
+        # The api matches only the requested skills as written, so it is asked
+        # for the employees matched by the recommender as well, e.g. by stem
+        if query.end_week is None:
+            # find_person_by_skills looks at most a year ahead
+            users, allocations = self._fetch_candidate_data(
+                query.skills, query.start_week, None, None, skill_weights.keys()
+            )
+            return find_person_by_skills(
+                query.skills, users, allocations, str(query.start_week), skill_weights,
+            )
+        users, allocations = self._fetch_candidate_data(
+            query.skills,
+            query.start_week,
+            query.end_week,
+            query.min_free,
+            skill_weights.keys(),
+        )
+        return find_person_available_in_range(
+            query.skills,
+            users,
+            allocations,
+            query.start_week,
+            query.end_week,
+            query.min_free,
+            skill_weights,
+        )
+
+    def _fetch_candidate_data(
+        self,
+        skills: Iterable[str],
+        start_week: YearWeek,
+        end_week: Optional[YearWeek],
+        min_free: Optional[int],
+        employee_ids: Iterable[int] = (),
+    ) -> Tuple[Dict, Dict]:
+        """ Fetch users and allocations for finding candidates
+
+        The api's search endpoint is used to filter the data, when the api has
+        it. Otherwise all users and the allocations of the weeks are fetched,
+        and the filtering is left for the find_kit functions.
+
+        :param skills: Skills of which the candidates need to have at least one
+        :param start_week: The first week of the allocations
+        :param end_week: The last week of the allocations, None for the weeks searched by find_person_by_skills
+        :param min_free: Free capacity percentage required for every week, None to not filter by availability
+        :param employee_ids: Employees to include as well, e.g. matched with similar skills
+        :return: tuple: (users, allocations)
+        """
+        # A bounded window, the allocations further ahead would not be used
+        end_week = end_week or start_week + timedelta(weeks=SEARCH_WEEKS)
+        employee_ids = list(employee_ids)
+        if len(employee_ids) <= MAX_SEARCH_IDS:
+            try:
+                return self.data_source.search_candidates(
+                    skills, start_week, end_week, min_free, employee_ids
+                )
+            except NotFound:
+                pass
+        return self.data_source.users_and_allocations(start_week, end_week)
 
     def _format_candidate_suggestions(
         self,
         candidate_list: List,
-        original_query: Tuple[Iterable[str], int, int],
+        original_query: CandidateQuery,
         *,
         max_suggestions: Optional[int] = None,
     ) -> BotReply:
         """ Format candidate suggestions into slack message blocks.
 
         :param candidate_list: List of candidate suggestions
-        :param original_query: Query for which the candidates were found. Contains: (list of skills, year, week)
+        :param original_query: Query for which the candidates were found
         :param max_suggestions: Maximum number of candidates to suggest
         :return: Slack message blocks for the candidate suggestions
         """
@@ -202,37 +459,38 @@ class Bot:
         else:
             max_suggestions = len(candidate_list) + 1
 
-        query_skills = original_query[0]
-        query_year = original_query[1]
-        query_week = original_query[2]
-
-        blocks = [
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "I found the following employees who are free next",
-                },
-            }
-        ]
+        if original_query.end_week is None:
+            header = "I found the following employees who are free next"
+        else:
+            header = (
+                "I found the following employees who are "
+                f"{original_query.free_str()} every week from "
+                f"{original_query.start_week} to {original_query.end_week}"
+            )
+        blocks = [{"type": "section", "text": {"type": "mrkdwn", "text": header},}]
 
         for employee_id, skill, availability in candidate_list:
             skill_str = ", ".join(skill)
             w, p = availability[0]
-            avail = f"{w}, {round(100*(1-p))}%"
+            if original_query.end_week is None:
+                avail = f"available next: {w}, {round(100*(1-p))}%"
+            else:
+                avail = f"free every week: {round(100*(1-p))}%"
             blocks.append(
                 {
                     "type": "section",
                     "text": {
                         "type": "mrkdwn",
-                        "text": f"*{employee_id}*\n\twith skills: {skill_str}\n\tavailable next: {avail}",
+                        "text": f"*{employee_id}*\n\twith skills: {skill_str}\n\t{avail}",
                     },
                 }
             )
 
         if len(candidate_list) < max_suggestions:
-            query_skills = set(
-                i.replace(",", "").replace("_", "") for i in query_skills
+            query = original_query._replace(
+                skills=list(
+                    {i.replace(",", "").replace("_", "") for i in original_query.skills}
+                )
             )
             blocks.append(
                 {
@@ -241,7 +499,7 @@ class Bot:
                         {
                             "type": "button",
                             "text": {"type": "plain_text", "text": "Show more"},
-                            "value": f"{len(candidate_list)}_{','.join(query_skills)}_{query_year}_{query_week}",  # Easily get the number of already suggested candidates and the original query
+                            "value": f"{len(candidate_list)}_{query.encode()}",  # Easily get the number of already suggested candidates and the original query
                             "action_id": "show_more_candidates",
                         }
                     ],
@@ -252,22 +510,19 @@ class Bot:
 
     def show_more_candidates(
         self,
-        query: Tuple[List[str], int, int],
+        query: CandidateQuery,
         nb_already_suggested: int,
         *,
         increment_by: int = 2,
     ) -> BotReply:
         """ Get candidate recommendation message with more suggestions.
 
-        :param query: Query for which to get more suggestions. Contains: (list of skills, year, week)
+        :param query: Query for which to get more suggestions
         :param nb_already_suggested: How many have already been suggested
         :param increment_by: How many more to suggest
         :return: Recommendation message
         """
-        start_week = YearWeek(query[1], query[2])
-        users = self.data_source.all_users()
-        allocations = self.data_source.allocations_within(start_week, None)
-        people = find_person_by_skills(query[0], users, allocations, str(start_week))
+        people = self._search_candidates(query)
 
         nb_to_show = nb_already_suggested + increment_by
         if len(people) <= nb_to_show:
@@ -308,20 +563,47 @@ class Bot:
             return False
         return True
 
+    def _sync_changes(self):
+        "Apply the changed users of the data api to the cache and the recommender"
+        if not self.data_source.changes_available:
+            return
+        try:
+            changes = self.data_source.sync_changes()
+        except NotFound:
+            print("Data api does not have the changes, the data is refreshed in full")
+            return
+        skills_by_user = {
+            employee_id: user["skills"] for employee_id, user in changes.users.items()
+        }
+        self.recommender.update_user_skills(
+            skills_by_user, changes.deleted, complete=changes.reset
+        )
+
+    def flush_writes(self):
+        "Write the reminders and history not written yet"
+        self._writes.flush()
+
     def _tick(self):
         print("tick", datetime.now())
         self._check_skill_recommendations()
 
     def _check_skill_recommendations(self):
         now = datetime.now()
-        for user in self.user_db.get_users():
-            if user.remind_next and user.remind_next > now:
-                continue
-            rec = self._recommendations_for(employee_id=user.employee_id)
-            if not rec:
-                continue
-            self.user_db.set_next_reminder(user.user_id, now + self._message_interval)
-            self.send_message(user.user_id, self._format_skill_recommendations(rec))
+        try:
+            # Read before messaging, not to keep a database connection meanwhile
+            for user in list(self.user_db.get_due_users(now)):
+                if self._writes.next_reminder(user.user_id):
+                    continue  # reminded, but not written yet
+                rec = self._recommendations_for(employee_id=user.employee_id)
+                if not rec:
+                    continue
+                self._writes.set_next_reminder(
+                    user.user_id, now + self._message_interval
+                )
+                self.send_message(user.user_id, self._format_skill_recommendations(rec))
+        finally:
+            if not self._write_behind:
+                self._writes.flush()
 
     def _recommendations_for(
         self,
@@ -358,6 +640,7 @@ class Bot:
                 [user] = self.user_db.get_user_by_employeeid(employee_id)
                 user_id = user.user_id
             history = self.user_db.get_history_by_user_id(user_id)
+            history += self._writes.history(user_id)
         previous = {item for _id, _date, item in history}
         try:
             rec = self.recommender.recommend_skills_to_user(
@@ -483,9 +766,10 @@ class Bot:
 
     def update_user_history(self, user_id: str, skills: List[str]):
         now = datetime.now()
-
-        for skill in skills:
-            self.user_db.add_history(user_id, now, skill)
+        if self._write_behind:
+            self._writes.add_history_many(user_id, now, skills)
+        else:
+            self.user_db.add_history_many(user_id, now, skills)
 
         if len(skills) > 1:
             skill_str = "s " + ", ".join(skills[:-1]) + f" or {skills[-1]}"
@@ -2,10 +2,43 @@ import sqlite3
 import datetime
 import threading
 import time
+from itertools import chain
 
 import psycopg2 as psy
-
-from typing import NamedTuple, Optional, List, Tuple, Dict, Iterable
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from typing import (
+    Any,
+    Callable,
+    NamedTuple,
+    Optional,
+    List,
+    Tuple,
+    Dict,
+    Iterable,
+    Iterator,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+# Default maximum number of connections to a Postgres database
+DEFAULT_POOL_SIZE = 4
+# Number of rows fetched at a time when streaming query results
+FETCH_BATCH_SIZE = 500
+
+# Users to be reminded at the given time, most overdue first. The union reads
+# both parts in the order of the users_remind_next index, and merges them
+# without sorting, which an OR in the WHERE clause, or an ORDER BY of an
+# expression, would prevent.
+# SQLite sorts NULLs first, and has NULLS FIRST only since 3.30, so it is added
+# for Postgres only, which sorts NULLs last by default.
+DUE_USERS_QUERY = (
+    "SELECT * FROM users WHERE remind_next IS NULL"
+    " UNION ALL SELECT * FROM users WHERE remind_next <= {param}"
+    " ORDER BY remind_next{nulls_first}"
+)
 
 
 class User(NamedTuple):
@@ -33,6 +66,26 @@ class IBotDatabase:
     ) -> None:
         ...
 
+    def add_history_many(
+        self, user_id: str, dateStamp: datetime.datetime, skills: Iterable[str]
+    ) -> None:
+        "Add the skills to the history of the user in one transaction"
+        ...
+
+    def write_batch(
+        self,
+        reminders: Iterable[Tuple[str, datetime.datetime]],
+        history: Iterable[HistoryEntry],
+    ) -> None:
+        """ Set the next reminders and add the history entries in one transaction.
+        The writes for users that do not exist are ignored, as are the history
+        entries already written, so a batch can be written again.
+
+        :param reminders: (user_id, time of the next reminder)
+        :param history: (user_id, dateStamp, recommended_skill)
+        """
+        ...
+
     def get_user_by_id(self, user_id: str) -> User:
         ...
 
@@ -42,6 +95,17 @@ class IBotDatabase:
     def get_users(self) -> List[User]:
         ...
 
+    def get_due_users(
+        self, now: datetime.datetime, limit: Optional[int] = None
+    ) -> Iterator[User]:
+        """ Yield the users without a reminder, or with a reminder before now,
+        fetched in batches as they are consumed
+
+        :param now: Time of the reminders due
+        :param limit: Maximum number of users, None for all
+        """
+        ...
+
     def get_history_by_user_id(self, user_id: str) -> List[HistoryEntry]:
         ...
 
@@ -76,6 +140,12 @@ class SQLiteBotDatabase(IBotDatabase):
             botdb.execute(
                 "CREATE TABLE IF NOT EXISTS history(user_id TEXT, dateStamp timestamp, recommended_skill TEXT, FOREIGN KEY(user_id) REFERENCES users(id))"
             )
+            botdb.execute(
+                "CREATE INDEX IF NOT EXISTS users_remind_next ON users(remind_next)"
+            )
+            botdb.execute(
+                "CREATE INDEX IF NOT EXISTS history_user_date ON history(user_id, dateStamp)"
+            )
 
     def add_user(self, user: User):
         with self._lock, self.connection as conn:
@@ -102,6 +172,22 @@ class SQLiteBotDatabase(IBotDatabase):
                 (user_id, dateStamp, recommended_skill),
             )
 
+    def add_history_many(self, user_id, dateStamp, skills):
+        self.write_batch((), ((user_id, dateStamp, skill) for skill in skills))
+
+    def write_batch(self, reminders, history):
+        with self._lock, self.connection as conn:
+            botdb = conn.cursor()
+            botdb.executemany(
+                "UPDATE users SET remind_next = (?) WHERE id = (?)",
+                ((at, user_id) for user_id, at in reminders),
+            )
+            # Only the entries of existing users, and not already written
+            botdb.executemany(
+                "INSERT INTO history (user_id, dateStamp, recommended_skill) SELECT ?1, ?2, ?3 WHERE EXISTS (SELECT 1 FROM users WHERE id = ?1) AND NOT EXISTS (SELECT 1 FROM history WHERE user_id = ?1 AND dateStamp = ?2 AND recommended_skill = ?3)",
+                history,
+            )
+
     def get_user_by_id(self, user_id: str) -> User:
         botdb = self.connection.cursor()
         botdb.execute("SELECT * FROM users WHERE id = (?)", (user_id,))
@@ -121,6 +207,17 @@ class SQLiteBotDatabase(IBotDatabase):
         botdb.execute("SELECT * FROM users")
         return [User(*row) for row in botdb.fetchall()]
 
+    def get_due_users(self, now, limit=None) -> Iterator[User]:
+        query = DUE_USERS_QUERY.format(param="(?)", nulls_first="")
+        params: Tuple = (now,)
+        if limit is not None:
+            query += " LIMIT (?)"
+            params += (limit,)
+        botdb = self.connection.cursor()
+        botdb.execute(query, params)
+        for rows in iter(lambda: botdb.fetchmany(FETCH_BATCH_SIZE), []):
+            yield from (User(*row) for row in rows)
+
     def get_history_by_user_id(self, user_id: str) -> List[HistoryEntry]:
         botdb = self.connection.cursor()
         botdb.execute(
@@ -153,50 +250,147 @@ class SQLiteBotDatabase(IBotDatabase):
 
 
 class PostgresBotDatabase(IBotDatabase):
-    def __init__(self, connection_string: str):
+    def __init__(
+        self,
+        connection_string: str,
+        *,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        health_check_idle: float = 30,
+    ):
+        """
+        Each call checks out a connection from a pool of at most pool_size
+        connections, waiting for one when all are in use, so concurrent
+        threads do not share a transaction.
+
+        :param connection_string: Connection parameters
+        :param pool_size: Maximum number of connections to the database
+        :param health_check_idle: Connections idle for longer than this (in
+            seconds) are checked before use, and replaced if they do not respond
+        """
+        self.health_check_idle = health_check_idle
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._last_used: Dict[Any, float] = {}
         try:
-            self.connection = psy.connect(connection_string)
+            self._pool = ThreadedConnectionPool(1, pool_size, connection_string)
         except psy.OperationalError as e:
-            self.connection = None  # __del__ requires this attribute
+            self._pool = None  # __del__ requires this attribute
             raise ConnectionError(e) from None
         self._create_tables()
 
     def __del__(self):
         self.close()
 
+    def _checkout(self):
+        "Get a healthy connection from the pool, waiting for one if all are in use"
+        self._slots.acquire()
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                self._discard(conn)
+                conn = self._pool.getconn()
+        except psy.OperationalError as e:
+            self._slots.release()
+            raise ConnectionError(e) from None
+        return conn
+
+    def _checkin(self, conn):
+        "Return the connection to the pool, closing it if it is broken"
+        if conn.closed:
+            self._discard(conn)
+        else:
+            self._last_used[conn] = time.monotonic()
+            self._pool.putconn(conn)
+        self._slots.release()
+
+    def _discard(self, conn):
+        self._last_used.pop(conn, None)
+        self._pool.putconn(conn, close=True)
+
+    def _is_healthy(self, conn) -> bool:
+        "Check the connection with a trivial query, if it has been idle long"
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(conn, 0) < self.health_check_idle:
+            return True
+        try:
+            with conn, conn.cursor() as botdb:
+                botdb.execute("SELECT 1")
+        except psy.Error:
+            return False
+        return True
+
+    def _execute(self, operation: Callable[[Any], T], idempotent: bool = False) -> T:
+        """ Call the operation with a cursor of a pooled connection, in a
+        transaction committed if the operation returns
+
+        If the connection has been dropped, e.g. by a restart of the database,
+        an idempotent operation is retried once with a new connection. Other
+        operations are not, as the connection may have been dropped after the
+        transaction was committed, and the error is raised.
+
+        :param operation: Function of the cursor
+        :param idempotent: Whether running the operation twice has the same effect as once
+        """
+        for attempt in range(2 if idempotent else 1):
+            conn = self._checkout()
+            try:
+                with conn, conn.cursor() as botdb:
+                    return operation(botdb)
+            except (psy.OperationalError, psy.InterfaceError):
+                if not conn.closed or not idempotent or attempt:
+                    raise
+                # The other connections were likely dropped too, check them
+                self._last_used.clear()
+            finally:
+                self._checkin(conn)
+        raise AssertionError("unreachable")
+
+    def _fetchall(self, query: str, params: Tuple = ()) -> List[Tuple]:
+        def fetchall(botdb):
+            botdb.execute(query, params)
+            return botdb.fetchall()
+
+        return self._execute(fetchall, idempotent=True)
+
     def _create_tables(self):
-        with self.connection as conn:
-            botdb = conn.cursor()
+        def create_tables(botdb):
             botdb.execute(
                 "CREATE TABLE IF NOT EXISTS users(id TEXT PRIMARY KEY UNIQUE, employeeId INT UNIQUE NOT NULL, remind_next timestamp)"
             )
-
-        with self.connection as conn:
-            botdb = conn.cursor()
             botdb.execute(
                 "CREATE TABLE IF NOT EXISTS history(user_id TEXT, dateStamp timestamp, recommended_skill TEXT, FOREIGN KEY(user_id) REFERENCES users(id))"
             )
+            # Postgres sorts NULLs last by default, unlike SQLite
+            botdb.execute(
+                "CREATE INDEX IF NOT EXISTS users_remind_next ON users(remind_next NULLS FIRST)"
+            )
+            botdb.execute(
+                "CREATE INDEX IF NOT EXISTS history_user_date ON history(user_id, dateStamp)"
+            )
+
+        self._execute(create_tables, idempotent=True)
 
     def add_user(self, user: User):
-        with self.connection as conn:
-            botdb = conn.cursor()
+        def add_user(botdb):
             try:
                 botdb.execute("INSERT INTO users VALUES(%s,%s,%s)", user)
             except psy.errors.UniqueViolation:
                 raise KeyError("User already exists")
 
+        self._execute(add_user)
+
     def set_next_reminder(self, user_id: str, at: datetime.datetime):
-        with self.connection as conn:
-            botdb = conn.cursor()
+        def set_next_reminder(botdb):
             botdb.execute(
                 "UPDATE users SET remind_next = %s WHERE id = %s", (at, user_id)
             )
             if botdb.rowcount != 1:
                 raise KeyError("User does not exist")
 
+        self._execute(set_next_reminder, idempotent=True)
+
     def add_history(self, user_id, dateStamp, recommended_skill):
-        with self.connection as conn:
-            botdb = conn.cursor()
+        def add_history(botdb):
             try:
                 botdb.execute(
                     "INSERT INTO history (user_id, dateStamp, recommended_skill) VALUES(%s,%s,%s)",
@@ -205,58 +399,176 @@ class PostgresBotDatabase(IBotDatabase):
             except psy.errors.ForeignKeyViolation:
                 pass
 
+        self._execute(add_history)
+
+    def add_history_many(self, user_id, dateStamp, skills):
+        self.write_batch((), [(user_id, dateStamp, skill) for skill in skills])
+
+    def write_batch(self, reminders, history):
+        reminders, history = list(reminders), list(history)
+
+        def write_batch(botdb):
+            execute_values(
+                botdb,
+                "UPDATE users SET remind_next = data.at FROM (VALUES %s) AS data(id, at) WHERE users.id = data.id",
+                reminders,
+            )
+            # Only the entries of existing users, not to violate the foreign key,
+            # and not already written, so the batch can be written again
+            execute_values(
+                botdb,
+                "INSERT INTO history (user_id, dateStamp, recommended_skill) SELECT * FROM (VALUES %s) AS data(user_id, dateStamp, recommended_skill) WHERE EXISTS (SELECT 1 FROM users WHERE users.id = data.user_id) AND NOT EXISTS (SELECT 1 FROM history WHERE history.user_id = data.user_id AND history.dateStamp = data.dateStamp AND history.recommended_skill = data.recommended_skill)",
+                history,
+            )
+
+        if reminders or history:
+            self._execute(write_batch, idempotent=True)
+
     def get_user_by_id(self, user_id: str) -> User:
-        botdb = self.connection.cursor()
-        botdb.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-        result = botdb.fetchall()
+        result = self._fetchall("SELECT * FROM users WHERE id = %s", (user_id,))
         if not result:
             raise KeyError("user_id not found", user_id)
         assert len(result) == 1, "database is corrupt"
         return User(*result[0])
 
     def get_user_by_employeeid(self, employee_id: int) -> List[User]:
-        botdb = self.connection.cursor()
-        botdb.execute("SELECT * FROM users WHERE employeeId = %s", (employee_id,))
-        return [User(*row) for row in botdb.fetchall()]
+        rows = self._fetchall(
+            "SELECT * FROM users WHERE employeeId = %s", (employee_id,)
+        )
+        return [User(*row) for row in rows]
 
     def get_users(self) -> List[User]:
-        botdb = self.connection.cursor()
-        botdb.execute("SELECT * FROM users")
-        return [User(*row) for row in botdb.fetchall()]
+        return [User(*row) for row in self._fetchall("SELECT * FROM users")]
+
+    def get_due_users(self, now, limit=None) -> Iterator[User]:
+        """ The users are read through a server-side cursor, which keeps a
+        connection of the pool checked out until the iteration ends.
+        """
+        query = DUE_USERS_QUERY.format(param="%s", nulls_first=" NULLS FIRST")
+        params: Tuple = (now,)
+        if limit is not None:
+            query += " LIMIT %s"
+            params += (limit,)
+        conn = self._checkout()
+        try:
+            # a named cursor is a server-side cursor
+            with conn, conn.cursor(name="due_users") as botdb:
+                botdb.itersize = FETCH_BATCH_SIZE
+                botdb.execute(query, params)
+                yield from (User(*row) for row in botdb)
+        finally:
+            self._checkin(conn)
 
     def get_history_by_user_id(self, user_id: str) -> List[HistoryEntry]:
-        botdb = self.connection.cursor()
-        botdb.execute(
+        return self._fetchall(
             "SELECT * FROM history WHERE user_id = %s ORDER BY dateStamp DESC",
             (user_id,),
         )
-        return botdb.fetchall()
 
     def get_history_sortedby_datestamp(self) -> List[HistoryEntry]:
-        botdb = self.connection.cursor()
-        botdb.execute("SELECT * FROM history ORDER BY dateStamp DESC")
-        return botdb.fetchall()
+        return self._fetchall("SELECT * FROM history ORDER BY dateStamp DESC")
 
     def delete_user(self, user_id):
         self.get_user_by_id(user_id)  # fail if user does not exist
-        self.delete_history_by_user_id(user_id)
-        with self.connection as conn:
-            botdb = conn.cursor()
+
+        def delete_user(botdb):
+            botdb.execute("DELETE FROM history WHERE user_id = %s", (user_id,))
             botdb.execute("DELETE FROM users WHERE id = %s", (user_id,))
 
+        self._execute(delete_user, idempotent=True)
+
     def delete_history_by_user_id(self, user_id):
-        with self.connection as conn:
-            botdb = conn.cursor()
+        def delete_history(botdb):
             botdb.execute("DELETE FROM history WHERE user_id = %s", (user_id,))
 
+        self._execute(delete_history, idempotent=True)
+
     def close(self):
-        if self.connection:
-            self.connection.close()
-            self.connection = None
+        if self._pool:
+            self._pool.closeall()
+            self._pool = None
+
+
+class WriteBehind:
+    """ Buffer of reminder and history writes to a database, written together
+    in one transaction by flush, instead of a transaction for each write
+    """
+
+    def __init__(self, db: IBotDatabase):
+        self.db = db
+        self._lock = threading.Lock()
+        # Only one batch is written at a time, so the reminders are written in order
+        self._flush_lock = threading.Lock()
+        self._reminders: Dict[str, datetime.datetime] = {}
+        self._history: List[HistoryEntry] = []
+        # The batch being written by flush, still visible to the readers
+        self._writing_reminders: Dict[str, datetime.datetime] = {}
+        self._writing_history: List[HistoryEntry] = []
+
+    def set_next_reminder(self, user_id: str, at: datetime.datetime):
+        with self._lock:
+            self._reminders[user_id] = at
+
+    def add_history_many(
+        self, user_id: str, dateStamp: datetime.datetime, skills: Iterable[str]
+    ):
+        with self._lock:
+            self._history.extend((user_id, dateStamp, skill) for skill in skills)
+
+    def next_reminder(self, user_id: str) -> Optional[datetime.datetime]:
+        "Return the next reminder of the user not written yet, None if there is none"
+        with self._lock:
+            at = self._reminders.get(user_id)
+            if at is None:
+                at = self._writing_reminders.get(user_id)
+            return at
+
+    def history(self, user_id: str) -> List[HistoryEntry]:
+        "Return the history entries of the user not written yet"
+        with self._lock:
+            return [
+                entry
+                for entry in chain(self._writing_history, self._history)
+                if entry[0] == user_id
+            ]
+
+    def flush(self):
+        """ Write the buffered writes in one transaction. If it fails, the
+        writes are kept for the next flush.
+
+        The buffers are swapped for empty ones under the lock, and the
+        database is written outside it, so the writers are not blocked by
+        the transaction.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._reminders and not self._history:
+                    return
+                # The writes stay visible to next_reminder and history until written
+                self._writing_reminders, self._reminders = self._reminders, {}
+                self._writing_history, self._history = self._history, []
+            success = False
+            try:
+                self.db.write_batch(
+                    self._writing_reminders.items(), self._writing_history
+                )
+                success = True
+            finally:
+                with self._lock:
+                    if not success:
+                        # The reminders set meanwhile are newer
+                        self._reminders = {**self._writing_reminders, **self._reminders}
+                        self._history = self._writing_history + self._history
+                    self._writing_reminders = {}
+                    self._writing_history = []
 
 
 def get_database_object(
-    db_type: str, connection_string: str, *, retry_delays: Iterable[float] = ()
+    db_type: str,
+    connection_string: str,
+    *,
+    retry_delays: Iterable[float] = (),
+    pool_size: int = DEFAULT_POOL_SIZE,
 ) -> IBotDatabase:
     """ Get the correct database object with the given type and parameters
 
@@ -273,22 +585,24 @@ def get_database_object(
     :param db_type: postgre or sqlite
     :param connection_string: Connection parameters.
     :param retry_delays: iterable of delay times in seconds between connection attempts
+    :param pool_size: Maximum number of connections, for postgres database.
+        SQLite database shares one connection.
     :return: Database object
     """
     db_type = db_type.lower()
 
     db_dict = {
-        "postgre": PostgresBotDatabase,
-        "sqlite": SQLiteBotDatabase,
+        "postgre": lambda: PostgresBotDatabase(connection_string, pool_size=pool_size),
+        "sqlite": lambda: SQLiteBotDatabase(connection_string),
     }
 
-    for t, db_class in db_dict.items():
+    for t, make_db in db_dict.items():
         if db_type.startswith(t):
             for delay in retry_delays:
                 try:
-                    return db_class(connection_string)
+                    return make_db()
                 except ConnectionError as e:
                     time.sleep(delay)
-            return db_class(connection_string)
+            return make_db()
 
     raise ValueError(f"Unknown database type {db_type}.\nKnown types: postgre, sqlite")
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import threading
+import time
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+import aiohttp
+import requests
+
+from bot.data_api.datasource import (
+    AccessDenied,
+    AllocationCache,
+    CacheEntry,
+    CircuitBreaker,
+    CircuitOpen,
+    NotFound,
+    ResponseCache,
+    Timeout,
+    CONNECT_TIMEOUT,
+    DEFAULT_CACHE_TTLS,
+    DEFAULT_TIMEOUT,
+    DEFAULT_TIMEOUTS,
+    cache_key,
+    route_group,
+    split_candidates,
+)
+from bot.helpers import YearWeek
+
+
+class AsyncDatasource:
+    """ Data api client on asyncio, with the same methods as Datasource
+
+    All requests share one aiohttp.ClientSession, and at most max_concurrency
+    requests are in flight at a time. Like in Datasource, the requests go
+    through a circuit breaker, and the errors of aiohttp are raised as the
+    Timeout and ConnectionError of requests. Expired responses are returned
+    while they are revalidated in the background with their ETag, and the
+    last good response is returned while the api is failing.
+
+    Unlike Datasource, it has no mirror of the api data, and does not sync the
+    changed users (sync_changes), nor iterate the collections in pages.
+    The methods must be awaited in one event loop, see SyncFacade for using
+    the datasource from threads.
+    """
+
+    def __init__(
+        self,
+        api_base_url,
+        api_key,
+        *,
+        max_concurrency: int = 10,
+        timeouts: Optional[Dict[str, float]] = None,
+        cache_ttls: Optional[Dict[str, float]] = None,
+        cache_max_bytes: int = 64 * 2 ** 20,
+        max_stale: float = 3600,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        :param api_base_url: Url of the data api
+        :param api_key: Key for the data api
+        :param max_concurrency: Maximum number of concurrent requests to the api
+        :param timeouts: Read timeouts by route, overriding the DEFAULT_TIMEOUTS
+        :param cache_ttls: Cache time-to-live by route, overriding the DEFAULT_CACHE_TTLS, 0 to not cache
+        :param cache_max_bytes: Maximum total size of the cached responses, counted as JSON bytes, their decoded objects take several times more memory
+        :param max_stale: How long after expiring a cached response is still returned, while it is refreshed in the background
+        :param breaker: Circuit breaker for failing fast while the api is failing, by default CircuitBreaker()
+        """
+        self.base_url = api_base_url
+        self.headers = {"x-api-key": api_key}
+        self.max_concurrency = max_concurrency
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.cache_ttls = {**DEFAULT_CACHE_TTLS, **(cache_ttls or {})}
+        self.cache = ResponseCache(cache_max_bytes)
+        self.allocation_cache = AllocationCache(self.cache_ttls["/allocations"])
+        self.max_stale = max_stale
+        self.breaker = breaker or CircuitBreaker()
+        # Set to False when the api turns out to not have the search endpoint
+        self.search_available = True
+        # created on first use, in the event loop of the caller
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # requests in flight, for coalescing identical concurrent requests
+        self._in_flight: Dict = {}
+        # background refreshes of expired responses by cache key
+        self._refreshing: Dict[Hashable, asyncio.Future] = {}
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            # The responses are repetitive and compress well, aiohttp decodes them
+            self._session = aiohttp.ClientSession(
+                headers={**self.headers, "Accept-Encoding": "gzip, deflate"},
+                connector=connector,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def close(self):
+        for task in list(self._refreshing.values()):
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.allocation_cache.clear()
+
+    async def _fetch(self, route, params=None, etag=None):
+        """ Get the route from the api, through the circuit breaker
+
+        Raises CircuitOpen without contacting the api while the breaker is open.
+        Server errors and any exception count as failures, see
+        Datasource._request.
+
+        :return: tuple: (decoded response, ETag, size of response body),
+            or None if the response with etag is still valid
+        """
+        session = self._ensure_session()
+        url = self.base_url + route
+        if params:
+            # aiohttp takes repeated parameters as pairs
+            params = [
+                (name, str(item))
+                for name, value in params.items()
+                for item in (value if isinstance(value, list) else [value])
+            ]
+        headers = {"If-None-Match": etag} if etag else None
+        read_timeout = self.timeouts.get(route_group(route), DEFAULT_TIMEOUT)
+        # The whole body is bounded like in Datasource._read_body, not only the
+        # time between the chunks of a body sent slowly
+        timeout = aiohttp.ClientTimeout(
+            total=CONNECT_TIMEOUT + read_timeout,
+            sock_connect=CONNECT_TIMEOUT,
+            sock_read=read_timeout,
+        )
+        if not self.breaker.allow():
+            raise CircuitOpen(url)
+        success = False
+        try:
+            async with self._semaphore:
+                async with session.get(
+                    url, params=params, headers=headers, timeout=timeout
+                ) as res:
+                    if res.status == 304:
+                        success = True
+                        return None
+                    if res.status >= 400:
+                        success = res.status < 500
+                    if res.status in (401, 403):
+                        raise AccessDenied(url, res.status)
+                    elif res.status == 404:
+                        raise NotFound(url)
+                    elif res.status >= 400:
+                        return {}, None, 0
+                    body = await res.read()
+                    data = json.loads(body)
+                    success = True
+                    return data, res.headers.get("ETag"), len(body)
+        except asyncio.TimeoutError:
+            raise Timeout(url) from None
+        except aiohttp.ClientError as error:
+            raise requests.ConnectionError(f"{url}: {error!r}") from error
+        finally:
+            self.breaker.record(success)
+
+    async def _get(self, route, params=None):
+        """ Get the route from the cache or from the api
+
+        Concurrent identical requests are coalesced into one request to the api,
+        and the callers share the response, which must not be modified.
+        """
+        key = cache_key(route, params)
+        return await self._coalesced(key, lambda: self._get_once(key, route, params))
+
+    async def _coalesced(self, key, make_coroutine):
+        "Run the coroutine, or wait for the one already running with the key"
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_coroutine())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _task: self._in_flight.pop(key, None))
+        # a cancelled caller must not cancel the request of the others
+        return await asyncio.shield(task)
+
+    async def _get_once(self, key, route, params):
+        "See Datasource._get"
+        ttl = self.cache_ttls.get(route_group(route), 0)
+        entry = self.cache.get(key) if ttl else None
+        if entry is not None:
+            age = time.monotonic() - entry.fetched_at
+            if age < ttl:
+                return entry.data
+            if age < ttl + self.max_stale:
+                self._refresh_in_background(key, route, params, entry, ttl)
+                return entry.data
+        try:
+            return await self._fetch_to_cache(key, route, params, entry, ttl)
+        except (Timeout, requests.ConnectionError):
+            if entry is None:
+                raise
+            return entry.data
+
+    async def _fetch_to_cache(
+        self, key, route, params, entry: Optional[CacheEntry], ttl: float
+    ):
+        "Fetch the route, revalidating the entry if given, and update the cache"
+        result = await self._fetch(route, params, entry.etag if entry else None)
+        if result is None:
+            entry.fetched_at = time.monotonic()
+            self.cache.put(key, entry)
+            return entry.data
+        data, etag, size = result
+        if not size and entry is not None:
+            # The request failed, serve the last good response
+            return entry.data
+        if ttl and size:
+            self.cache.put(key, CacheEntry(data, etag, size, time.monotonic()))
+        return data
+
+    def _refresh_in_background(self, key, route, params, entry: CacheEntry, ttl: float):
+        if key in self._refreshing:
+            return
+
+        async def refresh():
+            try:
+                await self._fetch_to_cache(key, route, params, entry, ttl)
+            except Exception as e:
+                print(f"refreshing {route} failed: {e!r}")
+
+        task = asyncio.ensure_future(refresh())
+        self._refreshing[key] = task
+        task.add_done_callback(lambda _task: self._refreshing.pop(key, None))
+
+    async def user_info(self, user_id):
+        "See Datasource.user_info"
+        try:
+            return await self._get(f"/user/{user_id}")
+        except NotFound:
+            return None
+
+    async def user_infos(self, user_ids: Iterable[int]) -> List[Optional[Dict]]:
+        "Return user_info of each user, fetched concurrently"
+        return await asyncio.gather(*(self.user_info(i) for i in user_ids))
+
+    async def all_users(self):
+        return {user["employeeId"]: user for user in await self._get("/users")}
+
+    async def skills_by_user(self):
+        """returns dict: {employeeId: [str]}"""
+        return {
+            info["employeeId"]: info["skills"] for info in await self._get("/skills")
+        }
+
+    async def _cached_allocations(self, start: YearWeek, end: YearWeek):
+        "See Datasource._cached_allocations, the missing weeks are fetched concurrently"
+
+        route = "/allocations"
+
+        async def fetch(first, last):
+            params = {"start": str(first), "end": str(last)}
+            # Not through the response cache, the weeks are cached by week
+            result = await self._coalesced(
+                cache_key(route, params), lambda: self._fetch(route, params)
+            )
+            data = result[0]
+            if "users" in data:
+                allocations = {
+                    entry["employeeId"]: entry["allocations"] for entry in data["users"]
+                }
+                self.allocation_cache.put(first, last, allocations)
+
+        try:
+            await asyncio.gather(
+                *(fetch(*run) for run in self.allocation_cache.missing(start, end))
+            )
+        except (Timeout, requests.ConnectionError):
+            # Serve expired weeks while the api is failing
+            if not self.allocation_cache.has(start, end):
+                raise
+        return self.allocation_cache.get(start, end)
+
+    async def allocations_within(self, start: YearWeek, end: Optional[YearWeek]):
+        "See Datasource.allocations_within"
+        if end:
+            return await self._cached_allocations(start, end)
+        params = {"start": str(start)}
+        data = await self._get("/allocations", params)
+        return {
+            entry["employeeId"]: entry["allocations"] for entry in data.get("users", ())
+        }
+
+    async def users_and_allocations(
+        self, start: YearWeek, end: Optional[YearWeek]
+    ) -> Tuple[Dict, Dict]:
+        "Return the results of all_users and allocations_within, fetched concurrently"
+        users, allocations = await asyncio.gather(
+            self.all_users(), self.allocations_within(start, end)
+        )
+        return users, allocations
+
+    async def search_candidates(
+        self,
+        skills: Iterable[str],
+        start: YearWeek,
+        end: YearWeek,
+        min_free: Optional[int] = None,
+        employee_ids: Iterable[int] = (),
+    ) -> Tuple[Dict, Dict]:
+        "See Datasource.search_candidates"
+        if not self.search_available:
+            raise NotFound(self.base_url + "/search")
+        params = {"skills": sorted(skills), "start": str(start), "end": str(end)}
+        if min_free is not None:
+            params["min_free"] = min_free
+        if employee_ids:
+            params["ids"] = sorted(employee_ids)
+        try:
+            data = await self._get("/search", params)
+        except NotFound:
+            self.search_available = False
+            raise
+        return split_candidates(data)
+
+
+class SyncFacade:
+    """ Synchronous interface to AsyncDatasource, with the methods of Datasource
+
+    The event loop runs in a background thread, so the methods can be called
+    from any thread, e.g. the Flask handlers. Calls from different threads
+    share the connections and the concurrency limit of the datasource.
+    """
+
+    def __init__(self, datasource: AsyncDatasource):
+        self.datasource = datasource
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="datasource-loop", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    @property
+    def search_available(self):
+        return self.datasource.search_available
+
+    def user_info(self, user_id):
+        return self._run(self.datasource.user_info(user_id))
+
+    def user_infos(self, user_ids: Iterable[int]):
+        return self._run(self.datasource.user_infos(user_ids))
+
+    def all_users(self):
+        return self._run(self.datasource.all_users())
+
+    def skills_by_user(self):
+        return self._run(self.datasource.skills_by_user())
+
+    def allocations_within(self, start: YearWeek, end: Optional[YearWeek]):
+        return self._run(self.datasource.allocations_within(start, end))
+
+    def users_and_allocations(self, start: YearWeek, end: Optional[YearWeek]):
+        return self._run(self.datasource.users_and_allocations(start, end))
+
+    def search_candidates(self, skills, start, end, min_free=None, employee_ids=()):
+        return self._run(
+            self.datasource.search_candidates(
+                skills, start, end, min_free, employee_ids
+            )
+        )
+
+    def clear_cache(self):
+        self.datasource.clear_cache()
+
+    def close(self):
+        self._run(self.datasource.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
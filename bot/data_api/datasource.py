@@ -1,12 +1,80 @@
-from typing import Optional
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+from itertools import takewhile
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import json
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from bot.data_api.json_stream import iter_array_items
+from bot.data_api.mirror import DataMirror
 from bot.helpers import YearWeek
 
 
 Timeout = requests.Timeout
 
+# Read timeouts in seconds by the first part of the route.
+# The collection endpoints return data of the whole company, and need more time.
+DEFAULT_TIMEOUTS = {
+    "/user": 3,
+    "/users": 10,
+    "/skills": 10,
+    "/allocations": 10,
+    "/search": 5,
+    "/changes": 10,
+}
+DEFAULT_TIMEOUT = 5
+CONNECT_TIMEOUT = 3
+# How many times a failed connection is retried. With the retries of 502, 503
+# and 504 responses, a call waits at most
+#   (1 + CONNECT_RETRIES) * CONNECT_TIMEOUT for an unreachable api (6 s), or
+#   (1 + retries) * (CONNECT_TIMEOUT + read timeout) + backoff for an api
+#   responding with those errors slowly, e.g. 4 * (3 + 10) + 1.8 = 53.8 s for
+#   /users with the defaults, the backoff being 0, 0.6 and 1.2 s.
+# The circuit breaker fails the calls fast after a few of those.
+CONNECT_RETRIES = 1
+
+# Size of the chunks in which streamed responses are read
+STREAM_CHUNK_SIZE = 64 * 2 ** 10
+# Size of the chunks in which other responses are read, between which the
+# time taken is checked
+BODY_CHUNK_SIZE = 4 * 2 ** 10
+
+# Number of users in a page of the paginated collections
+PAGE_SIZE = 1000
+
+# How long responses are used from the cache, in seconds, by the first part of
+# the route. The HR data changes only a few times a day.
+DEFAULT_CACHE_TTLS = {
+    "/user": 60,
+    "/users": 300,
+    "/skills": 300,
+    "/allocations": 300,
+    "/search": 60,
+}
+
+# How many past weeks of allocations are kept in the mirror
+MIRROR_PAST_WEEKS = 4
+
 
 class AccessDenied(Exception):
     pass
@@ -16,21 +84,680 @@ class NotFound(Exception):
     pass
 
 
+class CircuitOpen(Timeout):
+    "Raised instead of requesting the api, while the circuit breaker is open"
+
+
+class CircuitBreaker:
+    """ Thread-safe circuit breaker for the requests to the api
+
+    The breaker opens when at least failure_rate of the recent requests have
+    failed, and the requests fail fast until reset_timeout has passed. Then
+    the breaker is half-open, and lets one trial request through. If it
+    succeeds, the breaker closes, otherwise it opens again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        *,
+        window: int = 20,
+        min_requests: int = 5,
+        failure_rate: float = 0.5,
+        reset_timeout: float = 30,
+        on_state_change: Optional[Callable[[str, str], None]] = None,
+    ):
+        """
+        :param window: How many of the most recent requests are considered
+        :param min_requests: How many requests are needed in the window before opening
+        :param failure_rate: Fraction of failed requests in the window that opens the breaker
+        :param reset_timeout: Seconds until an open breaker lets a trial request through
+        :param on_state_change: Called with the old and the new state, e.g. for monitoring
+        """
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.on_state_change = on_state_change or self._print_state_change
+        self.state = self.CLOSED
+        self._results: Deque[bool] = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _print_state_change(old: str, new: str):
+        print(f"Data api circuit breaker {old} -> {new}")
+
+    def _set_state(self, state: str):
+        "Change the state, the lock must be held"
+        old, self.state = self.state, state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        elif state == self.CLOSED:
+            self._results.clear()
+        if old != state:
+            self.on_state_change(old, state)
+
+    def allow(self) -> bool:
+        "Check if a request can be made, the result of which must then be recorded"
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial_running:
+                    return False
+                self._trial_running = True
+            return True
+
+    def record(self, success: bool):
+        "Record the result of an allowed request"
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_running = False
+                self._set_state(self.CLOSED if success else self.OPEN)
+                return
+            self._results.append(success)
+            failures = self._results.count(False)
+            if (
+                self.state == self.CLOSED
+                and len(self._results) >= self.min_requests
+                and failures >= self.failure_rate * len(self._results)
+            ):
+                self._set_state(self.OPEN)
+
+
+@dataclass
+class CacheEntry:
+    data: Any
+    etag: Optional[str]
+    size: int
+    """Size of the JSON response body in bytes, not of the decoded data"""
+    fetched_at: float
+    """Time of fetching or revalidating the data, from time.monotonic"""
+    ttl: Optional[float] = None
+    """Time-to-live overriding the one of the route, e.g. for data kept current by sync_changes"""
+
+
+class ResponseCache:
+    """ Thread-safe LRU cache of decoded responses, bounded by response sizes
+
+    The size of an entry is the length of its uncompressed JSON body, which is
+    cheap to know, not the memory taken by the decoded objects. Decoded JSON of
+    small dicts and strings typically takes several times the bytes of the
+    body, so max_bytes bounds the memory only up to that factor.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, entry: CacheEntry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def pop(self, key: Hashable) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def weeks_between(start: YearWeek, end: YearWeek) -> List[YearWeek]:
+    "Return the weeks from start to end inclusive"
+    return list(takewhile(lambda week: week <= end, start.iter_weeks()))
+
+
+class AllocationCache:
+    """ Thread-safe cache of allocations by week
+
+    The allocations of fetched week ranges are stored by week and employee,
+    so a range overlapping the cached weeks needs to fetch only the missing
+    weeks. At most max_weeks weeks are kept, the least recently used are
+    evicted first.
+    """
+
+    def __init__(self, ttl: float, max_weeks: int = 156):
+        self.ttl = ttl
+        self.max_weeks = max_weeks
+        # {week: (fetched_at, {employeeId: [Allocation]})}
+        self._weeks: "OrderedDict[YearWeek, Tuple[float, Dict[int, List[Dict]]]]"
+        self._weeks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def missing(
+        self, start: YearWeek, end: YearWeek
+    ) -> List[Tuple[YearWeek, YearWeek]]:
+        "Return the runs of consecutive weeks that are not cached or have expired"
+        now = time.monotonic()
+        runs = []
+        with self._lock:
+            for week in weeks_between(start, end):
+                cached = self._weeks.get(week)
+                if cached is not None and now - cached[0] < self.ttl:
+                    continue
+                if runs and runs[-1][1].next_week() == week:
+                    runs[-1] = (runs[-1][0], week)
+                else:
+                    runs.append((week, week))
+        return runs
+
+    def has(self, start: YearWeek, end: YearWeek) -> bool:
+        "Check if all the weeks are cached, even if expired"
+        with self._lock:
+            return all(week in self._weeks for week in weeks_between(start, end))
+
+    def put(self, start: YearWeek, end: YearWeek, allocations: Dict[int, List[Dict]]):
+        "Store the allocations fetched for the weeks from start to end"
+        by_week = {week: {} for week in weeks_between(start, end)}
+        for employee_id, items in allocations.items():
+            for item in items:
+                employees = by_week.get(YearWeek.from_string(item["yearWeek"]))
+                if employees is not None:
+                    employees.setdefault(employee_id, []).append(item)
+        now = time.monotonic()
+        with self._lock:
+            for week, employees in by_week.items():
+                self._weeks[week] = (now, employees)
+                self._weeks.move_to_end(week)
+            while len(self._weeks) > self.max_weeks:
+                self._weeks.popitem(last=False)
+
+    def get(self, start: YearWeek, end: YearWeek) -> Dict[int, List[Dict]]:
+        "Return the cached allocations from start to end, by employeeId in week order"
+        result = {}
+        with self._lock:
+            for week in weeks_between(start, end):
+                cached = self._weeks.get(week)
+                if cached is None:
+                    continue
+                self._weeks.move_to_end(week)
+                for employee_id, items in cached[1].items():
+                    result.setdefault(employee_id, []).extend(items)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._weeks.clear()
+
+
+class Changes(NamedTuple):
+    "Changes of the users since a token, from the changes endpoint"
+    token: Optional[str]
+    """Token to get the next changes with"""
+    users: Dict[int, Dict]
+    """Added and changed users by employeeId"""
+    deleted: List[int]
+    """Ids of the removed users"""
+    reset: bool
+    """Whether users has all the users instead of the changes, e.g. for an old token"""
+    synced: bool = True
+    """Whether the changes were received, False when the request failed"""
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls with the same key into one call
+
+    The first caller of a key runs the function, and the callers arriving
+    while it runs wait for, and share, its result or exception.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+NOT_MODIFIED = object()
+
+
+def route_group(route: str) -> str:
+    "Return the first part of the route, e.g. /user for /user/123"
+    return "/" + route.lstrip("/").split("/", 1)[0]
+
+
+def cache_key(route: str, params: Optional[Dict] = None) -> Hashable:
+    "Return hashable key for the response to the route with the params"
+    return (
+        route,
+        tuple(
+            sorted(
+                (name, tuple(value) if isinstance(value, list) else value)
+                for name, value in (params or {}).items()
+            )
+        ),
+    )
+
+
+def split_candidates(data: Dict) -> Tuple[Dict, Dict]:
+    """ Split the response of the search endpoint to users and allocations
+
+    :param data: Response of the search endpoint
+    :return: tuple: (users, allocations)
+    """
+    users = {}
+    allocations = {}
+    for entry in data.get("users", ()):
+        # the data may be cached, and must not be modified
+        allocations[entry["employeeId"]] = entry["allocations"]
+        users[entry["employeeId"]] = {
+            key: value for key, value in entry.items() if key != "allocations"
+        }
+    return users, allocations
+
+
 class Datasource:
-    def __init__(self, api_base_url, api_key):
+    def __init__(
+        self,
+        api_base_url,
+        api_key,
+        *,
+        pool_size: int = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.3,
+        timeouts: Optional[Dict[str, float]] = None,
+        cache_ttls: Optional[Dict[str, float]] = None,
+        cache_max_bytes: int = 64 * 2 ** 20,
+        max_stale: float = 3600,
+        synced_ttl: float = 3600,
+        mirror: Optional[DataMirror] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        page_size: int = PAGE_SIZE,
+    ):
+        """
+        :param api_base_url: Url of the data api
+        :param api_key: Key for the data api
+        :param pool_size: Maximum number of kept-alive connections to the api, should be at least the number of threads using the datasource
+        :param retries: How many times 502, 503 and 504 responses are retried, failed connections are retried CONNECT_RETRIES times
+        :param backoff_factor: Delay before the retries grows as backoff_factor * 2^retry seconds
+        :param timeouts: Read timeouts by route, overriding the DEFAULT_TIMEOUTS
+        :param cache_ttls: Cache time-to-live by route, overriding the DEFAULT_CACHE_TTLS, 0 to not cache
+        :param cache_max_bytes: Maximum total size of the cached responses, counted as JSON bytes, their decoded objects take several times more memory
+        :param max_stale: How long after expiring a cached response is still returned, while it is refreshed in the background
+        :param synced_ttl: How long after the last sync_changes the users and skills it keeps current are used from the cache, instead of the cache_ttls
+        :param mirror: Local copy of the api data, read when the api does not respond and until the first sync_mirror
+        :param breaker: Circuit breaker for failing fast while the api is failing, by default CircuitBreaker()
+        :param page_size: Number of users in a page, when iterating the collections, 0 to stream them whole instead, e.g. for an api without pagination
+        """
         self.base_url = api_base_url
         self.headers = {"x-api-key": api_key}
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.cache_ttls = {**DEFAULT_CACHE_TTLS, **(cache_ttls or {})}
+        self.cache = ResponseCache(cache_max_bytes)
+        self.allocation_cache = AllocationCache(self.cache_ttls["/allocations"])
+        self.max_stale = max_stale
+        self.synced_ttl = synced_ttl
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        self._refresher = ThreadPoolExecutor(max_workers=2)
+        self._in_flight = SingleFlight()
+        # Set to False when the api turns out to not have the search endpoint
+        self.search_available = True
+        # Token of the changes applied to the cache, and whether the api has them
+        self._changes_token: Optional[str] = None
+        self.changes_available = True
+        self.mirror = mirror
+        self.breaker = breaker or CircuitBreaker()
+        self.page_size = page_size
+        # Until the mirror is synced, its data from a previous run is preferred
+        # over waiting for the api
+        self._cold_start = True
 
-    def _get(self, route, params=None):
+        retry = Retry(
+            total=retries,
+            connect=CONNECT_RETRIES,
+            read=False,  # do not multiply the time waited on slow responses
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # The responses are repetitive and compress well, requests decodes them
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _timeout_for(self, route):
+        "Return (connect, read) timeout for the route"
+        read_timeout = self.timeouts.get(route_group(route), DEFAULT_TIMEOUT)
+        return CONNECT_TIMEOUT, read_timeout
+
+    def close(self):
+        self._refresher.shutdown(wait=False)
+        self.session.close()
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.allocation_cache.clear()
+
+    def sync_mirror(self):
+        "Copy the users and the current allocations from the api to the mirror"
+        if self.mirror is None:
+            return
+        start = YearWeek.now() + timedelta(weeks=-MIRROR_PAST_WEEKS)
+        users = self._get("/users")
+        allocations = self._get("/allocations", {"start": str(start)})
+        self.mirror.replace(
+            users,
+            {
+                entry["employeeId"]: entry["allocations"]
+                for entry in allocations.get("users", ())
+            },
+        )
+        self._cold_start = False
+
+    def _mirror_ready(self):
+        return self.mirror is not None and self.mirror.synced_at is not None
+
+    def _with_mirror(self, read_api: Callable[[], Any], read_mirror: Callable[[], Any]):
+        """ Read from the api, or from the mirror when the api does not respond
+
+        On a cold start, a synced mirror is read without contacting the api.
+        """
+        if not self._mirror_ready():
+            return read_api()
+        if self._cold_start:
+            return read_mirror()
+        try:
+            return read_api()
+        except (Timeout, requests.ConnectionError) as error:
+            print(f"Data api not responding, reading from the mirror: {error!r}")
+            return read_mirror()
+
+    def _stream_with_mirror(
+        self, stream_api: Callable[[], Iterator], read_mirror: Callable[[], Iterable]
+    ) -> Iterator:
+        "Like _with_mirror, for streamed responses"
+        if not self._mirror_ready():
+            yield from stream_api()
+            return
+        if self._cold_start:
+            yield from read_mirror()
+            return
+        started = False
+        try:
+            for item in stream_api():
+                started = True
+                yield item
+        except (Timeout, requests.ConnectionError) as error:
+            if started:
+                # Part of the items have already been yielded from the api
+                raise
+            print(f"Data api not responding, reading from the mirror: {error!r}")
+            yield from read_mirror()
+
+    def _request(self, route, **kwargs) -> Tuple[requests.Response, Any, int]:
+        """ Get the route from the api, through the circuit breaker
+
+        Raises CircuitOpen without contacting the api while the breaker is open.
+        Server errors and any exception, e.g. a timeout, a connection error or
+        a body that cannot be decoded, count as failures. The result is
+        recorded once the whole body has been read and decoded.
+
+        :param route: Route to get
+        :return: tuple: (response, decoded body of a successful response or
+            None, size of the body)
+        """
         url = self.base_url + route
-        res = requests.get(url, params, headers=self.headers, timeout=5)
+        if not self.breaker.allow():
+            raise CircuitOpen(url)
+        success = False
+        try:
+            res = self.session.get(
+                url, timeout=self._timeout_for(route), stream=True, **kwargs
+            )
+            body = self._read_body(res, route)
+            data = None
+            if res.ok and res.status_code != requests.codes.not_modified:
+                data = json.loads(body)
+            success = res.status_code < 500
+            return res, data, len(body)
+        finally:
+            self.breaker.record(success)
+
+    def _read_body(self, res: requests.Response, route) -> bytes:
+        """ Read the whole body of the response within the read timeout of the
+        route. The timeout of requests only limits each read, and a body sent
+        slowly could take any time.
+
+        Raises Timeout if the body takes longer, checked between chunks of
+        BODY_CHUNK_SIZE, and ConnectionError if the connection is closed in
+        the middle of the body.
+        """
+        deadline = time.monotonic() + self._timeout_for(route)[1]
+        chunks = []
+        with res:
+            try:
+                for chunk in res.iter_content(BODY_CHUNK_SIZE):
+                    if time.monotonic() > deadline:
+                        raise Timeout(f"{res.url}: body not received in time")
+                    chunks.append(chunk)
+            except requests.exceptions.ChunkedEncodingError as error:
+                raise requests.ConnectionError(error) from error
+        return b"".join(chunks)
+
+    def _fetch(self, route, params=None, etag=None):
+        """ Get the route from the api
+
+        :param route: Route to get
+        :param params: Query parameters
+        :param etag: ETag of the cached response, for revalidating it
+        :return: tuple: (decoded response, ETag, size of response body),
+            or NOT_MODIFIED if the response with etag is still valid
+        """
+        url = self.base_url + route
+        headers = {"If-None-Match": etag} if etag else None
+        res, data, size = self._request(route, params=params, headers=headers)
+        if res.status_code == requests.codes.not_modified:
+            return NOT_MODIFIED
         if res.ok:
-            return res.json()
+            return data, res.headers.get("ETag"), size
         if res.status_code in (requests.codes.unauthorized, requests.codes.forbidden):
             raise AccessDenied(url, res.status_code)
-        elif res.status_code == request.codes.not_found:
+        elif res.status_code == requests.codes.not_found:
             raise NotFound(url)
-        return {}
+        return {}, None, 0
+
+    def _stream(self, route, params=None, key=None) -> Iterator[Any]:
+        """ Get the route from the api, and yield the items of the response array
+        as they are decoded. The response is not cached.
+
+        The request goes through the circuit breaker like in _request, and its
+        result is recorded once the whole array has been decoded.
+
+        :param route: Route to get
+        :param params: Query parameters
+        :param key: Key of the array in the response object, None if the response is the array
+        :return: generator of the items
+        """
+        url = self.base_url + route
+        if not self.breaker.allow():
+            raise CircuitOpen(url)
+        success = False
+        try:
+            with self.session.get(
+                url, params=params, timeout=self._timeout_for(route), stream=True
+            ) as res:
+                if res.status_code in (
+                    requests.codes.unauthorized,
+                    requests.codes.forbidden,
+                ):
+                    success = True
+                    raise AccessDenied(url, res.status_code)
+                elif res.status_code == requests.codes.not_found:
+                    success = True
+                    raise NotFound(url)
+                elif not res.ok:
+                    success = res.status_code < 500
+                    return
+                try:
+                    yield from iter_array_items(
+                        res.iter_content(STREAM_CHUNK_SIZE), key
+                    )
+                except requests.exceptions.ChunkedEncodingError as error:
+                    raise requests.ConnectionError(error) from error
+                success = True
+        except GeneratorExit:
+            # The consumer stopped reading, the api did not fail
+            success = True
+            raise
+        finally:
+            self.breaker.record(success)
+
+    def _iter_pages(self, route, params=None) -> Iterator[Dict]:
+        """ Get a paginated collection from the api, and yield its records.
+        The next page is fetched when the records of the previous one have
+        been consumed. The pages are not cached, as only the records are kept
+        by the consumer, but concurrent identical requests are coalesced.
+
+        An api without pagination responds with the whole collection, the
+        records of which are then yielded.
+
+        :param route: Route of the collection
+        :param params: Query parameters other than the pagination
+        :return: generator of the records
+        """
+        params = {**(params or {}), "limit": self.page_size}
+        while True:
+            data = self._in_flight.do(
+                cache_key(route, params), lambda: self._fetch(route, params)[0]
+            )
+            if isinstance(data, list):
+                yield from data
+                return
+            yield from data.get("users", ())
+            after = data.get("next")
+            if after is None:
+                return
+            params = {**params, "after": after}
+
+    def _iter_collection(self, route, params=None, key=None) -> Iterator[Dict]:
+        """ Yield the records of the collection page by page, or streamed whole
+        and decoded incrementally when page_size is 0 (DATA_API_PAGE_SIZE=0)
+        """
+        if self.page_size:
+            return self._iter_pages(route, params)
+        return self._stream(route, params, key)
+
+    def _fetch_to_cache(self, key, route, params, entry: Optional[CacheEntry]):
+        "Fetch the route, revalidating the entry if given, and update the cache"
+        result = self._fetch(route, params, entry.etag if entry else None)
+        if result is NOT_MODIFIED:
+            entry.fetched_at = time.monotonic()
+            self.cache.put(key, entry)
+            return entry.data
+        data, etag, size = result
+        if not size and entry is not None:
+            # The request failed, serve the last good response
+            return entry.data
+        if size:
+            self.cache.put(key, CacheEntry(data, etag, size, time.monotonic()))
+        return data
+
+    def _refresh_in_background(self, key, route, params, entry: CacheEntry):
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._fetch_to_cache(key, route, params, entry)
+            except Exception as e:
+                print(f"refreshing {route} failed: {e!r}")
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(key)
+
+        self._refresher.submit(refresh)
+
+    def _get(self, route, params=None):
+        """ Get the route from the cache or from the api
+
+        Fresh cached responses are returned without contacting the api.
+        Expired responses are returned while they are refreshed in the
+        background, unless they have been expired for longer than max_stale.
+        Refreshing revalidates the response with its ETag, when there is one.
+        While the api is failing, the last good response is returned, however
+        old it is.
+
+        Concurrent identical requests are coalesced into one request to the api,
+        and the callers share the response, which must not be modified.
+        """
+        key = cache_key(route, params)
+        ttl = self.cache_ttls.get(route_group(route), 0)
+        if not ttl:
+            return self._in_flight.do(key, lambda: self._fetch(route, params)[0])
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry.ttl is not None:
+                ttl = entry.ttl
+            age = time.monotonic() - entry.fetched_at
+            if age < ttl:
+                return entry.data
+            if age < ttl + self.max_stale:
+                self._refresh_in_background(key, route, params, entry)
+                return entry.data
+        try:
+            return self._in_flight.do(
+                key, lambda: self._fetch_to_cache(key, route, params, entry)
+            )
+        except (Timeout, requests.ConnectionError):
+            if entry is None:
+                raise
+            return entry.data
 
     def user_info(self, user_id):
         """
@@ -41,23 +768,231 @@ class Datasource:
             "wishes": [str],
         }
         """
-        try:
-            return self._get(f"/user/{user_id}")
-        except NotFound:
-            return None
+
+        def read_api():
+            try:
+                return self._get(f"/user/{user_id}")
+            except NotFound:
+                return None
+
+        return self._with_mirror(read_api, lambda: self.mirror.user_info(user_id))
 
     def all_users(self):
-        return {user["employeeId"]: user for user in self._get("/users")}
+        return self._with_mirror(
+            lambda: {user["employeeId"]: user for user in self._get("/users")},
+            lambda: self.mirror.all_users(),
+        )
 
     def skills_by_user(self):
         """returns dict: {employeeId: [str]}"""
-        return {info["employeeId"]: info["skills"] for info in self._get("/skills")}
+        return self._with_mirror(
+            lambda: {
+                info["employeeId"]: info["skills"] for info in self._get("/skills")
+            },
+            lambda: self.mirror.skills_by_user(),
+        )
+
+    def _cached_allocations(self, start: YearWeek, end: YearWeek):
+        "Return the allocations from start to end, fetching only the weeks not cached"
+        route = "/allocations"
+        try:
+            for first, last in self.allocation_cache.missing(start, end):
+                params = {"start": str(first), "end": str(last)}
+                data = self._in_flight.do(
+                    cache_key(route, params), lambda: self._fetch(route, params)[0]
+                )
+                if "users" in data:
+                    self.allocation_cache.put(
+                        first,
+                        last,
+                        {
+                            entry["employeeId"]: entry["allocations"]
+                            for entry in data["users"]
+                        },
+                    )
+        except (Timeout, requests.ConnectionError):
+            # Serve expired weeks while the api is failing
+            if not self.allocation_cache.has(start, end):
+                raise
+        return self.allocation_cache.get(start, end)
 
     def allocations_within(self, start: YearWeek, end: Optional[YearWeek]):
+        """ Return the allocations from start to end inclusive, by employeeId
+
+        Bounded ranges are cached by week, and only the missing weeks are
+        fetched. Without end, all the future allocations are fetched.
+
+        returns dict: {employeeId: [Allocation]}
+        """
         params = {"start": str(start)}
         if end:
             params["end"] = str(end)
-        data = self._get("/allocations", params)
-        return {
-            entry["employeeId"]: entry["allocations"] for entry in data.get("users", ())
-        }
+
+        def read_api():
+            if end:
+                return self._cached_allocations(start, end)
+            data = self._get("/allocations", params)
+            return {
+                entry["employeeId"]: entry["allocations"]
+                for entry in data.get("users", ())
+            }
+
+        return self._with_mirror(
+            read_api, lambda: self.mirror.allocations_within(start, end)
+        )
+
+    def iter_users(self, fields: Optional[Iterable[str]] = None) -> Iterator[Dict]:
+        """ Yield the users of all_users one by one, fetching them page by page,
+        or decoding the whole response as it arrives
+
+        :param fields: Fields of the users to get, employeeId is always included
+        """
+        params = {"fields": ",".join(fields)} if fields else None
+        return self._stream_with_mirror(
+            lambda: self._iter_collection("/users", params),
+            lambda: self.mirror.all_users().values(),
+        )
+
+    def iter_skills_by_user(self) -> Iterator[Tuple[int, List[str]]]:
+        "Yield the items of skills_by_user one by one, like iter_users"
+
+        def stream_api():
+            for info in self._iter_collection("/skills"):
+                yield info["employeeId"], info["skills"]
+
+        return self._stream_with_mirror(
+            stream_api, lambda: self.mirror.skills_by_user().items()
+        )
+
+    def users_and_allocations(
+        self, start: YearWeek, end: Optional[YearWeek]
+    ) -> Tuple[Dict, Dict]:
+        "Return the results of all_users and allocations_within"
+        return self.all_users(), self.allocations_within(start, end)
+
+    def search_candidates(
+        self,
+        skills: Iterable[str],
+        start: YearWeek,
+        end: YearWeek,
+        min_free: Optional[int] = None,
+        employee_ids: Iterable[int] = (),
+    ) -> Tuple[Dict, Dict]:
+        """ Search users with any of the skills, or any of the employee_ids,
+        filtered by the api
+
+        When min_free is given, only users at least min_free percent free in
+        every week from start to end are included.
+
+        Raises NotFound if the api does not have the search endpoint.
+
+        returns tuple: (users, allocations) in the same form as the results of
+        all_users and allocations_within, only including the found users
+        """
+        if not self.search_available:
+            raise NotFound(self.base_url + "/search")
+        params = {"skills": sorted(skills), "start": str(start), "end": str(end)}
+        if min_free is not None:
+            params["min_free"] = min_free
+        if employee_ids:
+            params["ids"] = sorted(employee_ids)
+
+        def read_api():
+            try:
+                data = self._get("/search", params)
+            except NotFound:
+                self.search_available = False
+                raise
+            return split_candidates(data)
+
+        # The mirror does not filter, but the results are filtered again by
+        # the bot anyway
+        return self._with_mirror(
+            read_api,
+            lambda: (
+                self.mirror.all_users(),
+                self.mirror.allocations_within(start, end),
+            ),
+        )
+
+    def changes_since(self, token: Optional[str]) -> Changes:
+        """ Get the users changed since the token
+
+        Raises NotFound if the api does not have the changes endpoint.
+
+        :param token: Token of the previous changes, None to get all the users
+        """
+        if not self.changes_available:
+            raise NotFound(self.base_url + "/changes")
+        try:
+            data = self._get("/changes", {"since": token} if token else None)
+        except NotFound:
+            self.changes_available = False
+            raise
+        if "token" not in data:
+            # The request failed, nothing is known to have changed
+            return Changes(token, {}, [], False, synced=False)
+        return Changes(
+            token=data["token"],
+            users={user["employeeId"]: user for user in data.get("users", ())},
+            deleted=data.get("deleted", []),
+            reset=data.get("reset", False),
+        )
+
+    def sync_changes(self) -> Changes:
+        """ Get the users changed since the previous sync, and apply the changes
+        to the cached users and skills, instead of fetching them all again
+
+        The users and skills kept current this way are used from the cache for
+        synced_ttl after each sync, instead of their cache_ttls. The responses
+        that have been patched are fetched whole when they expire, as their
+        ETags no longer match.
+
+        Raises NotFound if the api does not have the changes endpoint.
+        """
+        changes = self.changes_since(self._changes_token)
+        if not changes.synced:
+            # The cache expires as usual until the changes are received again
+            return changes
+        now = time.monotonic()
+        ttl = self.synced_ttl
+
+        def patch(route, to_item):
+            key = cache_key(route)
+            entry = self.cache.get(key)
+            if changes.reset:
+                items = [to_item(user) for user in changes.users.values()]
+                size = len(json.dumps(items))
+            elif entry is None:
+                return
+            elif not changes.users and not changes.deleted:
+                # Nothing changed, the response is still the one of the ETag
+                self.cache.put(
+                    key, CacheEntry(entry.data, entry.etag, entry.size, now, ttl)
+                )
+                return
+            else:
+                removed = changes.users.keys() | set(changes.deleted)
+                # The cached data is shared, and must not be modified
+                items = [
+                    item for item in entry.data if item["employeeId"] not in removed
+                ]
+                items.extend(to_item(user) for user in changes.users.values())
+                size = entry.size
+            # The patched data does not match the ETag of the api anymore
+            self.cache.put(key, CacheEntry(items, None, size, now, ttl))
+
+        patch("/users", lambda user: user)
+        patch(
+            "/skills",
+            lambda user: {"employeeId": user["employeeId"], "skills": user["skills"]},
+        )
+        for employee_id in changes.deleted:
+            self.cache.pop(cache_key(f"/user/{employee_id}"))
+        for employee_id, user in changes.users.items():
+            key = cache_key(f"/user/{employee_id}")
+            if self.cache.get(key) is not None:
+                self.cache.put(key, CacheEntry(user, None, len(json.dumps(user)), now))
+
+        self._changes_token = changes.token
+        return changes
@@ -0,0 +1,106 @@
+"""
+Incremental decoding of large JSON responses.
+
+Only the items of one array are decoded at a time, so the memory use is
+bounded by the size of the largest item and the chunk size, instead of the
+size of the whole response.
+"""
+
+import codecs
+import json
+from typing import Any, Iterable, Iterator, Optional
+
+WHITESPACE = " \t\n\r"
+
+
+class _Buffer:
+    "Decoded text of the chunks, read further only when needed"
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self) -> bool:
+        "Read the next chunk, return False at the end of the input"
+        # Drop the consumed text to keep the buffer small
+        if self.pos:
+            self.text = self.text[self.pos :]
+            self.pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self.text += self._decoder.decode(chunk)
+                return True
+        self.text += self._decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def next_char(self) -> str:
+        "Skip whitespace and return the next character without consuming it"
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.read_more():
+                raise ValueError("unexpected end of JSON input")
+
+    def expect(self, char: str):
+        if self.next_char() != char:
+            raise ValueError(f"expected {char!r} at {self.text[self.pos:][:20]!r}")
+        self.pos += 1
+
+    def decode_value(self, decoder: json.JSONDecoder) -> Any:
+        "Decode and consume the next complete JSON value"
+        self.next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self.read_more():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.text) and not self.eof and self.read_more():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_array_items(
+    chunks: Iterable[bytes], key: Optional[str] = None
+) -> Iterator[Any]:
+    """ Yield the items of a JSON array, decoding the input incrementally
+
+    :param chunks: The JSON document in chunks of bytes, e.g. from Response.iter_content
+    :param key: When given, the document is an object, and the items of the array at this key are yielded. Otherwise the document is the array.
+    :return: generator of the decoded items
+    """
+    buffer = _Buffer(chunks)
+    decoder = json.JSONDecoder()
+
+    if key is not None:
+        buffer.expect("{")
+        while True:
+            if buffer.next_char() == "}":
+                return
+            name = buffer.decode_value(decoder)
+            buffer.expect(":")
+            if name == key:
+                break
+            buffer.decode_value(decoder)  # skip the value
+            if buffer.next_char() == ",":
+                buffer.pos += 1
+
+    buffer.expect("[")
+    if buffer.next_char() == "]":
+        return
+    while True:
+        yield buffer.decode_value(decoder)
+        if buffer.next_char() == ",":
+            buffer.pos += 1
+        else:
+            buffer.expect("]")
+            return
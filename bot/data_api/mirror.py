@@ -0,0 +1,126 @@
+""" Local copy of the data api in an SQLite file
+
+The mirror is synced periodically from the api, and the datasource reads
+from it when the api is not reachable, or before the first sync after a
+start, so the bot can start and answer while the api is slow or down.
+"""
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import json
+import sqlite3
+import threading
+
+from bot.helpers import YearWeek
+
+
+class DataMirror:
+    def __init__(
+        self, db_file_name: str, sync_interval: timedelta = timedelta(minutes=30)
+    ):
+        """
+        :param db_file_name: SQLite db file, :memory: for an in-memory mirror
+        :param sync_interval: How often the mirror should be synced from the api
+        """
+        self.sync_interval = sync_interval
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(db_file_name, check_same_thread=False)
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock, self.connection as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users(employeeId INT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS allocations(employeeId INT NOT NULL, id INT, yearWeek TEXT NOT NULL, percentage INT NOT NULL)"
+            )
+            # Range queries select the weeks first, the employee lookups the employee
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS allocations_week ON allocations(yearWeek, employeeId)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS allocations_employee ON allocations(employeeId, yearWeek)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    @property
+    def synced_at(self) -> Optional[datetime]:
+        "Time of the last completed sync, None if the mirror has never been synced"
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'synced_at'"
+            ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def replace(self, users: Iterable[Dict], allocations: Dict[int, List[Dict]]):
+        """ Replace the contents of the mirror in one transaction
+
+        :param users: Users as returned by the api
+        :param allocations: Allocations by employeeId, as returned by Datasource.allocations_within
+        """
+        with self._lock, self.connection as conn:
+            conn.execute("DELETE FROM users")
+            conn.execute("DELETE FROM allocations")
+            conn.executemany(
+                "INSERT INTO users VALUES(?,?)",
+                ((user["employeeId"], json.dumps(user)) for user in users),
+            )
+            conn.executemany(
+                "INSERT INTO allocations VALUES(?,?,?,?)",
+                (
+                    (employee_id, item.get("id"), item["yearWeek"], item["percentage"])
+                    for employee_id, items in allocations.items()
+                    for item in items
+                ),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES('synced_at', ?)",
+                (datetime.now().isoformat(),),
+            )
+
+    def user_info(self, user_id) -> Optional[Dict]:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT data FROM users WHERE employeeId = (?)", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all_users(self) -> Dict[int, Dict]:
+        with self._lock:
+            rows = self.connection.execute("SELECT data FROM users").fetchall()
+        users = (json.loads(data) for (data,) in rows)
+        return {user["employeeId"]: user for user in users}
+
+    def skills_by_user(self) -> Dict[int, List[str]]:
+        return {
+            employee_id: user["skills"]
+            for employee_id, user in self.all_users().items()
+        }
+
+    def allocations_within(
+        self, start: YearWeek, end: Optional[YearWeek]
+    ) -> Dict[int, List[Dict]]:
+        "Return the allocations from start to end (inclusive) by employeeId"
+        query = "SELECT employeeId, id, yearWeek, percentage FROM allocations WHERE yearWeek >= (?)"
+        params: Tuple = (str(start),)
+        if end:
+            query += " AND yearWeek <= (?)"
+            params += (str(end),)
+        query += " ORDER BY employeeId, yearWeek"
+        with self._lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return {
+            employee_id: [
+                {"id": id_, "yearWeek": year_week, "percentage": percentage}
+                for _, id_, year_week, percentage in group
+            ]
+            for employee_id, group in groupby(rows, key=lambda row: row[0])
+        }
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from bisect import bisect_left
+from dataclasses import dataclass, replace
 from pathlib import Path
 from collections import Counter, defaultdict, abc
 import numpy as np
@@ -12,8 +13,10 @@ from typing import (
     Set,
     Tuple,
     Dict,
+    FrozenSet,
     List,
     Iterable,
+    Union,
 )
 
 import yaml
@@ -40,6 +43,27 @@ class SkillRecommendation:
     most_similar_to: MutableSequence[str]
 
 
+@dataclass(frozen=True)
+class SkillModel:
+    """
+    Skill data derived from the skill features of the users. It is replaced
+    as a whole, so that a search or a recommendation never sees parts of two
+    versions.
+    """
+
+    skill_index: pd.DataFrame
+    skill_similarity: pd.DataFrame
+    skill_neighbours: Optional[pd.DataFrame]
+    top_similar: np.ndarray
+    """Positions of the most similar skills of each skill, by position"""
+    top_similarities: np.ndarray
+    skill_position: Dict[str, int]
+    employees_by_skill: Dict[str, FrozenSet[int]]
+    sorted_skills: List[str]
+    changed_users: FrozenSet[int] = frozenset()
+    """Users whose skills have changed since skill_index was built"""
+
+
 def recursive_update_dict(dict1, dict2):
     """ Recursively merge dictionaries.
 
@@ -119,16 +143,21 @@ def split_sentence(sentence: str) -> List[str]:
     return sentence.split()
 
 
-def clean_skills(data: SkillData, settings: MutableMapping[str, Any]) -> SkillData:
+def clean_skills(
+    data: Union[SkillData, Iterable[Tuple[int, Optional[MutableSequence[str]]]]],
+    settings: MutableMapping[str, Any],
+) -> SkillData:
     """ Clean the skill elements in the data.
     Includes stripping whitespace, removing non-characters.
 
-    :param data: Data to clean
+    :param data: Data to clean, as mapping or as iterable of (employee_id, skills) pairs
     :param settings: Settings to use when cleaning
     :return: Cleaned data
     """
+    if isinstance(data, abc.Mapping):
+        data = data.items()
     cleaned_data = {}
-    for employee_id, skills in data.items():
+    for employee_id, skills in data:
         if skills is not None:
             tmp = []
             for s in skills:
@@ -436,13 +465,30 @@ class SkillRecommenderCF:
         # Keep track of recommendations so as to not recommend the same thing multiple times
         self.recommendation_history = defaultdict(set)
 
-    def _normalize_skill_vectors(self):
+    @property
+    def skill_index(self) -> pd.DataFrame:
+        return self._model.skill_index
+
+    @property
+    def skill_similarity(self) -> pd.DataFrame:
+        return self._model.skill_similarity
+
+    @property
+    def skill_neighbours(self) -> Optional[pd.DataFrame]:
+        return self._model.skill_neighbours
+
+    @property
+    def employees_by_skill(self) -> Dict[str, FrozenSet[int]]:
+        return self._model.employees_by_skill
+
+    @staticmethod
+    def _normalize_skill_vectors(skill_index: pd.DataFrame) -> pd.DataFrame:
         """ Normalize user skill vectors in skill index to unit vectors
         This makes individual skills count less.
         """
-        magnitude = np.sqrt(np.square(self.skill_index).sum(axis=1))
+        magnitude = np.sqrt(np.square(skill_index).sum(axis=1))
 
-        self.skill_index = self.skill_index.divide(magnitude, axis="index")
+        return skill_index.divide(magnitude, axis="index")
 
     def _get_rarity_filtered_skills(self, user_skills: SkillData) -> Set[str]:
         """ Get all skills from skills by user.
@@ -472,12 +518,13 @@ class SkillRecommenderCF:
 
         return all_skills
 
-    def _make_skill_index(self, user_skills: SkillData):
+    def _make_skill_index(self, user_skills: SkillData) -> pd.DataFrame:
         """ Converts skills by user into pd.DataFrame
         Also, if needed, removes rare skills and normalizes skill vectors.
         (Determined by config)
 
         @param user_skills: Skill list for each user
+        @return: Skill index
         """
         all_skills = self._get_rarity_filtered_skills(user_skills)
 
@@ -501,36 +548,57 @@ class SkillRecommenderCF:
 
             data_dict[skill] = skill_prevalence
 
-        self.skill_index = pd.DataFrame(data_dict, index=sorted_users)
+        skill_index = pd.DataFrame(data_dict, index=sorted_users)
 
         if self.config["normalize_skill_vectors"]:
-            self._normalize_skill_vectors()
+            skill_index = self._normalize_skill_vectors(skill_index)
+        return skill_index
 
-    def _eval_skill_neighbours(self):
+    def _eval_skill_neighbours(self, skill_similarity: pd.DataFrame) -> pd.DataFrame:
         neigh_size = self.config["neighbourhood"]["neighbourhood_size"]
 
         data_neighbours = pd.DataFrame(
-            index=self.skill_similarity.columns, columns=range(1, neigh_size + 1)
+            index=skill_similarity.columns, columns=range(1, neigh_size + 1)
         )
-        for i in tqdm(range(0, len(self.skill_similarity.columns))):
+        for i in tqdm(range(0, len(skill_similarity.columns))):
             data_neighbours.iloc[i, :neigh_size] = (
-                self.skill_similarity.iloc[:, i]
+                skill_similarity.iloc[:, i]
                 .sort_values(ascending=False)[:neigh_size]
                 .index
             )
 
-        self.skill_neighbours = data_neighbours
+        return data_neighbours
 
-    def _get_most_similar(self, recommended_skills, user_skills, sz: int):
+    def _eval_top_similar(
+        self, skill_similarity: pd.DataFrame
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """ Find the most similar skills for each skill from the similarity matrix
+        These are used to expand skills in searches, without evaluating the
+        similarities again for each search.
+
+        @param skill_similarity: Similarity matrix of the skills
+        @return: Tuple: (positions of the most similar skills, their similarities)
+        """
+        nb_similar = self.config["fuzzy_matching"]["neighbours"]
+        similarities = np.nan_to_num(skill_similarity.to_numpy())
+        nb_similar = min(nb_similar + 1, similarities.shape[1])
+
+        top = np.argsort(-similarities, axis=1)[:, :nb_similar]
+        return top, np.take_along_axis(similarities, top, axis=1)
+
+    def _get_most_similar(
+        self, model: SkillModel, recommended_skills, user_skills, sz: int
+    ):
         """ Get the list of "most similar" skills in user_skills in relation to recommended_skills
 
+        @param model: Skill data to use
         @param recommended_skills: Recommended skills
         @param user_skills: User skills
         @param sz: How many "most similar" skills to list
         @return: List of "most similar" skills
         """
         similarities: pd.DataFrame = sum(
-            self.skill_similarity.loc[rec_skill].loc[user_skills]
+            model.skill_similarity.loc[rec_skill].loc[user_skills]
             for rec_skill in recommended_skills
         )
 
@@ -553,20 +621,38 @@ class SkillRecommenderCF:
         if reinitialize:
             self.initialize_recommender(reload_options=False)
 
+    def _user_vector(self, model: SkillModel, user_id: int) -> pd.Series:
+        """ Get the skill vector of user, as in the skill index
+        The vectors of the users whose skills have changed since the skill index
+        was built are made from their current skill features.
+
+        :param model: Skill data to use
+        :param user_id: User's user id
+        :return: Skill vector, all zeros for unknown users
+        """
+        if user_id not in model.changed_users and user_id in model.skill_index.index:
+            return model.skill_index.loc[user_id]
+
+        counts = Counter(
+            skill
+            for skill in self.user_skills.get(user_id) or ()
+            if skill in model.skill_position
+        )
+        vector = pd.Series(0.0, index=model.skill_index.columns)
+        for skill, count in counts.items():
+            vector[skill] = 1 if self.config["use_binary"] else count
+        if self.config["normalize_skill_vectors"] and counts:
+            vector = vector / np.sqrt(np.square(vector).sum())
+        return vector
+
     def get_user_skills(self, user_id: int) -> List[str]:
         """ Get extracted skill features of user
 
         :param user_id: User's user id
         :return: List of skill features
         """
-        if user_id in self.skill_index.index:
-            user_skills = [
-                skill for skill, sc in self.skill_index.loc[user_id].items() if sc > 0
-            ]
-        else:
-            user_skills = []
-
-        return user_skills
+        vector = self._user_vector(self._model, user_id)
+        return [skill for skill, sc in vector.items() if sc > 0]
 
     def initialize_recommender(
         self, ds: Optional[Datasource] = None, reload_options: bool = True
@@ -585,29 +671,219 @@ class SkillRecommenderCF:
             self._reload_options()
 
         self.skill_extractor = SkillExtractor(self.config["skill_features"])
-        similarity_evaluator = SimilarityClac(
-            self.config["similarity_metric"], self.config["nb_workers"]
-        )
 
         # print("Fetching skill data")
-        raw_skills_by_user = clean_skills(self.ds.skills_by_user(), self.config)
+        if hasattr(self.ds, "iter_skills_by_user"):
+            # Clean the skills as they arrive, not holding the whole response
+            skills_by_user = self.ds.iter_skills_by_user()
+        else:
+            skills_by_user = self.ds.skills_by_user().items()
+        # The skills as fetched, to find the users whose skills have changed
+        self._raw_skills = {}
+
+        def remember(pairs):
+            for employee_id, skills in pairs:
+                self._raw_skills[employee_id] = skills
+                yield employee_id, skills
+
+        raw_skills_by_user = clean_skills(remember(skills_by_user), self.config)
 
         # print("Extracting skill features")
         user_skills, skill_key = self.skill_extractor.extract_skill_features(
             raw_skills_by_user
         )
+        self.user_skills = user_skills
         self.skill_key = skill_key
 
+        self._build_skill_data()
+
+        # print("Init done!")
+
+    def _build_skill_data(self):
+        "Construct the skill index and the similarities from self.user_skills"
+        similarity_evaluator = SimilarityClac(
+            self.config["similarity_metric"], self.config["nb_workers"]
+        )
+
+        employees_by_skill = defaultdict(set)
+        for employee_id, skills in self.user_skills.items():
+            for skill in skills or ():
+                employees_by_skill[skill].add(employee_id)
+
         # print("Constructing skill index")
-        self._make_skill_index(user_skills)
+        skill_index = self._make_skill_index(self.user_skills)
         # print("Constructing skill similarity matrix")
-        self.skill_similarity = similarity_evaluator(self.skill_index)
+        skill_similarity = similarity_evaluator(skill_index)
 
+        skill_neighbours = None
         if self.config["neighbourhood"]["use_neighbourhood"]:
             # print("Evaluating skill neighbours")
-            self._eval_skill_neighbours()
+            skill_neighbours = self._eval_skill_neighbours(skill_similarity)
+
+        top_similar, top_similarities = self._eval_top_similar(skill_similarity)
+        self._model = SkillModel(
+            skill_index=skill_index,
+            skill_similarity=skill_similarity,
+            skill_neighbours=skill_neighbours,
+            top_similar=top_similar,
+            top_similarities=top_similarities,
+            skill_position={
+                skill: i for i, skill in enumerate(skill_similarity.columns)
+            },
+            employees_by_skill={
+                skill: frozenset(employees)
+                for skill, employees in employees_by_skill.items()
+            },
+            sorted_skills=sorted(employees_by_skill),
+        )
 
-        # print("Init done!")
+    def _update_employees_by_skill(
+        self, previous_skills: Dict[int, Optional[MutableSequence[str]]]
+    ):
+        """ Apply the changed skill features of users to the searches, keeping
+        the skill index and the similarities. Only the employee sets of the
+        changed skills are copied.
+
+        :param previous_skills: Skill features of the changed users before the change
+        """
+        model = self._model
+        employees_by_skill = dict(model.employees_by_skill)
+        for employee_id, skills in previous_skills.items():
+            for skill in set(skills or ()):
+                employees = employees_by_skill.get(skill, frozenset())
+                employees -= {employee_id}
+                if employees:
+                    employees_by_skill[skill] = employees
+                else:
+                    employees_by_skill.pop(skill, None)
+            for skill in set(self.user_skills.get(employee_id) or ()):
+                employees = employees_by_skill.get(skill, frozenset())
+                employees_by_skill[skill] = employees | {employee_id}
+
+        sorted_skills = model.sorted_skills
+        if employees_by_skill.keys() != model.employees_by_skill.keys():
+            sorted_skills = sorted(employees_by_skill)
+        self._model = replace(
+            model,
+            employees_by_skill=employees_by_skill,
+            sorted_skills=sorted_skills,
+            changed_users=model.changed_users | previous_skills.keys(),
+        )
+
+    def update_user_skills(
+        self,
+        skills_by_user: MutableMapping[int, Optional[MutableSequence[str]]],
+        deleted: Iterable[int] = (),
+        complete: bool = False,
+    ) -> bool:
+        """ Apply changed skills of users, without reinitializing the recommender
+        Only the skill features of the users whose skills have changed are
+        extracted again, and they are applied to the searches right away.
+        The skill index and the similarities are built again only for complete
+        changes, or once the skills of enough users have changed (determined
+        by config).
+
+        :param skills_by_user: New skills of the changed users
+        :param deleted: Ids of the removed users
+        :param complete: Whether skills_by_user has all the users, and the others should be removed
+        :return: Whether anything changed
+        """
+        missing = object()
+        changed = {
+            employee_id: skills
+            for employee_id, skills in skills_by_user.items()
+            if self._raw_skills.get(employee_id, missing) != skills
+        }
+        removed = set(deleted)
+        if complete:
+            removed.update(self._raw_skills.keys() - skills_by_user.keys())
+        removed &= self._raw_skills.keys()
+        if not changed and not removed:
+            return False
+
+        previous_skills = {}
+        for employee_id in removed | changed.keys():
+            self._raw_skills.pop(employee_id, None)
+            previous_skills[employee_id] = self.user_skills.pop(employee_id, None)
+        self._raw_skills.update(changed)
+
+        user_skills, skill_key = self.skill_extractor.extract_skill_features(
+            clean_skills(changed, self.config)
+        )
+        self.user_skills.update(user_skills)
+        for skill, name in skill_key.items():
+            self.skill_key.setdefault(skill, name)
+
+        nb_changed = len(self._model.changed_users | previous_skills.keys())
+        rebuild_after = self.config["rebuild_after_changes"] * len(self.user_skills)
+        if complete or nb_changed > rebuild_after:
+            self._build_skill_data()
+        else:
+            self._update_employees_by_skill(previous_skills)
+        return True
+
+    def similar_skill_features(
+        self, skill: str, model: Optional[SkillModel] = None
+    ) -> List[Tuple[str, float]]:
+        """ Get the skill feature of skill, and the skill features most similar to it
+
+        :param skill: Skill as written by a user, e.g. "React"
+        :param model: Skill data to use, the current one by default
+        :return: List of (skill feature, similarity), the skill feature itself first
+        """
+        model = model or self._model
+        _, features = self.skill_extractor.post_process_skill_features(
+            [clean_one(skill, self.config)]
+        )
+        if not features:
+            return []
+        [feature] = features
+
+        similar = [(feature, 1.0)]
+        min_similarity = self.config["fuzzy_matching"]["min_similarity"]
+
+        # Skills starting with the skill, e.g. "react" -> "reactjs"
+        sorted_skills = model.sorted_skills
+        i = bisect_left(sorted_skills, feature)
+        while i < len(sorted_skills) and sorted_skills[i].startswith(feature):
+            similarity = len(feature) / len(sorted_skills[i])
+            if sorted_skills[i] != feature and similarity >= min_similarity:
+                similar.append((sorted_skills[i], similarity))
+            i += 1
+
+        position = model.skill_position.get(feature)
+        if position is not None:
+            for i, similarity in zip(
+                model.top_similar[position], model.top_similarities[position]
+            ):
+                if i != position and similarity >= min_similarity:
+                    similar.append(
+                        (model.skill_similarity.columns[i], float(similarity))
+                    )
+        return similar
+
+    def skill_matches(self, skills: Iterable[str]) -> Dict[int, Dict[str, float]]:
+        """ Find employees with the skills, or with skills similar to them
+
+        Each requested skill is matched with the employee's best matching skill,
+        weighted by the similarity of the skills (1 for the same skill).
+
+        :param skills: Skills as written by a user
+        :return: dict: {employeeId: {matched skill: weight}}
+        """
+        model = self._model
+        matches = defaultdict(dict)
+        for skill in skills:
+            best = {}
+            for feature, similarity in self.similar_skill_features(skill, model):
+                for employee_id in model.employees_by_skill.get(feature, ()):
+                    if similarity > best.get(employee_id, (0,))[0]:
+                        best[employee_id] = (similarity, feature)
+            for employee_id, (similarity, feature) in best.items():
+                name = self.skill_key.get(feature, feature)
+                previous = matches[employee_id].get(name, 0)
+                matches[employee_id][name] = max(previous, similarity)
+        return matches
 
     def clear_recommendation_history(self):
         """
@@ -638,30 +914,30 @@ class SkillRecommenderCF:
         :param ignored_skills: What skills not to include in the recommendations (recommendation history)
         :return: Recommendations in a SkillRecommendation object
         """
-        user_skills = self.get_user_skills(user_id)
+        model = self._model
+        user_skill_vector = self._user_vector(model, user_id)
+        user_skills = [skill for skill, sc in user_skill_vector.items() if sc > 0]
 
         if len(user_skills) == 0:
             raise KeyError(f"No skill data found for user {user_id}")
 
-        user_skill_vector = self.skill_index.loc[user_id]
-
         if not self.config["neighbourhood"]["use_neighbourhood"]:
-            score = self.skill_similarity.dot(user_skill_vector).div(
-                self.skill_similarity.sum(axis=1)
+            score = model.skill_similarity.dot(user_skill_vector).div(
+                model.skill_similarity.sum(axis=1)
             )
         else:
             # Construct the neighbourhood from the most similar skills to the
             # ones the user already has.
-            most_similar_to_likes = self.skill_neighbours.loc[user_skills]
+            most_similar_to_likes = model.skill_neighbours.loc[user_skills]
             similar_list = most_similar_to_likes.values.tolist()
             similar_list = list(
                 set(item for sublist in similar_list for item in sublist)
             )
-            neighbourhood = self.skill_similarity[similar_list].loc[similar_list]
+            neighbourhood = model.skill_similarity[similar_list].loc[similar_list]
 
             # A user vector containing only the neighbourhood items and
             # the known user likes.
-            user_vector = self.skill_index.loc[user_id].loc[similar_list]
+            user_vector = user_skill_vector.loc[similar_list]
 
             score = neighbourhood.dot(user_vector).div(neighbourhood.sum(axis=1))
 
@@ -685,7 +961,7 @@ class SkillRecommenderCF:
         rec_skills = list(recommendations.index)
         rec_similarities = list(recommendations)
         rec_most_similar = self._get_most_similar(
-            rec_skills, user_skills, nb_most_similar
+            model, rec_skills, user_skills, nb_most_similar
         )
 
         if self.config["convert_back"]:
@@ -1,13 +1,20 @@
-from typing import List, Dict, Tuple, Iterable
+from typing import List, Dict, Tuple, Iterable, Optional
 from collections import Counter
 from datetime import timedelta
-from itertools import islice
+from itertools import accumulate, islice
 
 from bot.helpers import YearWeek
 
+# How many weeks from the requested week find_person_by_skills looks for free weeks
+SEARCH_WEEKS = 52
+
 
 def find_person_by_skills(
-    skills: List[str], users: Dict, allocations: Dict, year_week: str
+    skills: List[str],
+    users: Dict,
+    allocations: Dict,
+    year_week: str,
+    skill_weights: Optional[Dict[int, Dict[str, float]]] = None,
 ):
     """Look for people with a certain set of skills.
 
@@ -18,57 +25,103 @@ def find_person_by_skills(
     :param users: User information output of the Data API.
     :param allocations: Allocation information output of the Data API.
     :param year_week: The week for which available workers are being searched for.
+    :param skill_weights: Weighted matching skills of each person, in addition to the exact matches. E.g. from SkillRecommenderCF.skill_matches
     :return: A List containing found persons, sorted by the number of matching skills and their availability in time.
     """
     matching_people = []
-    for person in users.values():
-        # Go through all the people in the API
-        matching_person = None  # Holds worker_id and matched skills.
-        skills_tuple = ()  # Tuple for holding the skills.
-        for requested_skill in skills:
-            # Look for matches in list of requested skills.
-            if person["skills"] is not None:
-                # Check to see if person has skills at all.
-                if requested_skill in person["skills"]:
-                    # A match is found.
-                    matching_person = person["employeeId"]
-                    skills_tuple += (requested_skill,)  # Record the matched skill.
-        if matching_person is not None:
-            # At the end of the loop,
-            # if a person with a matching skill has been found,
-            # collect the allocations for the person
-
-            # all allocations within year from year_week
-            start_week = YearWeek.from_string(year_week)
-            all_alloc = chronological_allocations(
-                allocations.get(matching_person, ()),
-                start_week,
-                start_week + timedelta(weeks=52),
-            )
+    for matching_person, skills_tuple, score in matching_people_with_scores(
+        skills, users, skill_weights
+    ):
+        # A person with a matching skill has been found,
+        # collect the allocations for the person
 
-            # allocations under 100%
-            non_full_alloc = (
-                (week, percentage / 100)
-                for week, percentage in all_alloc
-                if percentage < 100
-            )
+        # all allocations within year from year_week
+        start_week = YearWeek.from_string(year_week)
+        all_alloc = chronological_allocations(
+            allocations.get(matching_person, ()),
+            start_week,
+            start_week + timedelta(weeks=SEARCH_WEEKS),
+        )
+
+        # allocations under 100%
+        non_full_alloc = (
+            (week, percentage / 100)
+            for week, percentage in all_alloc
+            if percentage < 100
+        )
 
-            # take at most 10 first allocations
-            alloc = list(islice(non_full_alloc, 10))
+        # take at most 10 first allocations
+        alloc = list(islice(non_full_alloc, 10))
 
-            # if person has any week with under 100% allocation
-            # append him to the list which is to be returned.
-            if alloc:
-                matching_people.append((matching_person, skills_tuple, alloc))
+        # if person has any week with under 100% allocation
+        # append him to the list which is to be returned.
+        if alloc:
+            matching_people.append((score, (matching_person, skills_tuple, alloc)))
     # Sort people by
-    #  1. greatest number of matching skills
+    #  1. greatest (weighted) number of matching skills
     #  2. earliest available time
     #  3. smallest allocation percent
     matching_people = sorted(
         matching_people,
-        key=lambda person: (-len(person[1]), person[2][0][0], person[2][0][1]),
+        key=lambda item: (-item[0], item[1][2][0][0], item[1][2][0][1]),
     )
-    return matching_people
+    return [person for _score, person in matching_people]
+
+
+def normalize_skill(skill: str) -> str:
+    "Normalize skill for matching, ignoring case and surrounding whitespace"
+    return skill.strip().casefold()
+
+
+def matching_people_with_scores(
+    skills: Iterable[str],
+    users: Dict,
+    skill_weights: Optional[Dict[int, Dict[str, float]]] = None,
+) -> Iterable[Tuple[int, Tuple[str, ...], float]]:
+    """ Generator of people with matching skills
+
+    The skills of the users are matched exactly, ignoring case, with weight 1.
+    The matches in skill_weights are added to them, or raise their weights,
+    so similar skills are found as well.
+    The matching skills are ordered best match first, and the score is the
+    sum of their weights.
+
+    :param skills: Names of requested skills.
+    :param users: User information output of the Data API.
+    :param skill_weights: dict: {employeeId: {matched skill: weight}}
+    :return: generator of (employeeId, matching skills, score)
+    """
+    skills = list(skills)
+    for person in users.values():
+        employee_id = person["employeeId"]
+        # {normalized skill: (skill, weight)}
+        weights = {
+            normalize_skill(skill): (skill, 1.0)
+            for skill in matching_skills(skills, person)
+        }
+        if skill_weights is not None:
+            for skill, weight in skill_weights.get(employee_id, {}).items():
+                key = normalize_skill(skill)
+                if weight > weights.get(key, (skill, 0))[1]:
+                    weights[key] = (skill, weight)
+        if weights:
+            matches = sorted(weights.values(), key=lambda item: -item[1])
+            skills_tuple = tuple(skill for skill, _weight in matches)
+            yield employee_id, skills_tuple, sum(weight for _skill, weight in matches)
+
+
+def matching_skills(skills: Iterable[str], person: Dict) -> Tuple[str, ...]:
+    """ Return the requested skills the person has, in the requested order
+
+    :param skills: Names of requested skills.
+    :param person: User information of one person, as in output of the Data API.
+    :return: Tuple of matching skills, empty if none match
+    """
+    if person["skills"] is None:
+        # The person has no skills listed at all.
+        return ()
+    has = {normalize_skill(skill) for skill in person["skills"]}
+    return tuple(skill for skill in skills if normalize_skill(skill) in has)
 
 
 def chronological_allocations(
@@ -95,3 +148,282 @@ def chronological_allocations(
         if yw > end_week:
             return
         yield (str(yw), alloc[str(yw)])
+
+
+class WeeklyAvailability:
+    """ Free capacity of one employee over a run of consecutive weeks
+
+    Precomputes prefix sums and a sparse table of minimums of the weekly free
+    capacity, so that the total, average and minimum free capacity of any
+    sub-range can be answered in constant time.
+    Weeks are referred to by their index from the first week of the run.
+    """
+
+    def __init__(self, free: List[int]):
+        """
+        :param free: Free capacity percentage in range [0,100] for each week
+        """
+        self.nb_weeks = len(free)
+        self._prefix = [0, *accumulate(free)]
+        self._min_table = [list(free)]
+        span = 1
+        while 2 * span <= self.nb_weeks:
+            previous = self._min_table[-1]
+            self._min_table.append(
+                [
+                    min(previous[i], previous[i + span])
+                    for i in range(self.nb_weeks - 2 * span + 1)
+                ]
+            )
+            span *= 2
+
+    def total_free(self, first: int, last: int) -> int:
+        "Sum of free capacity from week index first to last inclusive"
+        return self._prefix[last + 1] - self._prefix[first]
+
+    def average_free(self, first: int, last: int) -> float:
+        "Average free capacity from week index first to last inclusive"
+        return self.total_free(first, last) / (last - first + 1)
+
+    def min_free(self, first: int, last: int) -> int:
+        "Smallest free capacity from week index first to last inclusive"
+        level = (last - first + 1).bit_length() - 1
+        row = self._min_table[level]
+        return min(row[first], row[last - (1 << level) + 1])
+
+
+def availability_index(
+    allocations: Dict,
+    start_week: YearWeek,
+    end_week: YearWeek,
+    employee_ids: Optional[Iterable[int]] = None,
+) -> Dict[int, WeeklyAvailability]:
+    """ Build WeeklyAvailability for each employee from allocation data
+
+    Employees without any allocations in the range are not included,
+    they are free for the whole range.
+
+    :param allocations: Allocation information output of the Data API.
+    :param start_week: The first week of the range
+    :param end_week: The last week of the range
+    :param employee_ids: Employees to include, all employees when None
+    :return: dict: {employeeId: WeeklyAvailability}
+    """
+    weeks = {}
+    for yw in start_week.iter_weeks():
+        if yw > end_week:
+            break
+        weeks[str(yw)] = len(weeks)
+
+    if employee_ids is None:
+        employee_ids = allocations.keys()
+
+    index = {}
+    for employee_id in employee_ids:
+        employee_allocations = allocations.get(employee_id)
+        if not employee_allocations:
+            continue
+        free = [100] * len(weeks)
+        for allocation in employee_allocations:
+            i = weeks.get(allocation["yearWeek"])
+            if i is not None:
+                free[i] -= allocation["percentage"]
+        index[employee_id] = WeeklyAvailability([max(f, 0) for f in free])
+    return index
+
+
+def find_person_available_in_range(
+    skills: Iterable[str],
+    users: Dict,
+    allocations: Dict,
+    start_week: YearWeek,
+    end_week: YearWeek,
+    min_free: int,
+    skill_weights: Optional[Dict[int, Dict[str, float]]] = None,
+):
+    """Look for people with a certain set of skills, who are free enough in every
+    week of the given range.
+
+    The result has the same form as in find_person_by_skills, except the
+    availability contains a single item: the range as string, and the largest
+    weekly allocation within the range.
+    People are sorted by
+      1. greatest (weighted) number of matching skills
+      2. greatest free capacity in the busiest week of the range
+      3. greatest average free capacity over the range
+
+    :param skills: Names of requested skills.
+    :param users: User information output of the Data API.
+    :param allocations: Allocation information output of the Data API.
+    :param start_week: The first week of the range.
+    :param end_week: The last week of the range.
+    :param min_free: Free capacity percentage required for every week of the range.
+    :param skill_weights: As in find_person_by_skills
+    :return: A List containing found persons
+    """
+    if start_week > end_week:
+        return []
+
+    matching = list(matching_people_with_scores(skills, users, skill_weights))
+
+    index = availability_index(
+        allocations, start_week, end_week, (employee_id for employee_id, *_ in matching)
+    )
+    free_for_whole_range = WeeklyAvailability([100])
+    range_str = f"{start_week}..{end_week}"
+
+    found = []
+    for employee_id, skills_tuple, score in matching:
+        availability = index.get(employee_id, free_for_whole_range)
+        last = availability.nb_weeks - 1
+        worst = availability.min_free(0, last)
+        if worst < min_free or worst == 0:
+            continue
+        found.append(
+            (
+                (-score, -worst, -availability.average_free(0, last)),
+                (employee_id, skills_tuple, [(range_str, 1 - worst / 100)]),
+            )
+        )
+    found.sort(key=lambda item: item[0])
+    return [person for _key, person in found]
+
+
+def _greedy_cover(masks: List[int], full: int) -> List[int]:
+    """ Cover the bits of full with masks, taking always the mask covering most
+
+    :param masks: Bitmasks to choose from
+    :param full: Bitmask to cover, must be coverable with masks
+    :return: The chosen masks
+    """
+    chosen = []
+    covered = 0
+    while covered != full:
+        best = max(masks, key=lambda mask: bin(mask & ~covered).count("1"))
+        chosen.append(best)
+        covered |= best
+    return chosen
+
+
+def smallest_cover(masks: Iterable[int], full: int) -> List[int]:
+    """ Find the smallest set of masks, which together cover the bits of full
+
+    Branch and bound search: the uncovered skill with the lowest bit is covered
+    with each mask in turn, and branches that cannot beat the best found cover
+    are cut. Greedy cover is used as the initial bound.
+
+    :param masks: Bitmasks to choose from
+    :param full: Bitmask to cover, must be coverable with masks
+    :return: The chosen masks
+    """
+    # Masks that are subsets of another mask can never improve the cover
+    masks = sorted(set(masks), key=lambda mask: -bin(mask).count("1"))
+    maximal = []
+    for mask in masks:
+        if not any(mask | other == other for other in maximal):
+            maximal.append(mask)
+
+    best = _greedy_cover(maximal, full)
+    covering = {}
+    for mask in maximal:
+        bits = mask
+        while bits:
+            bit = bits & -bits
+            covering.setdefault(bit, []).append(mask)
+            bits ^= bit
+
+    chosen = []
+
+    def search(covered: int):
+        nonlocal best
+        if covered == full:
+            if len(chosen) < len(best):
+                best = list(chosen)
+            return
+        if len(chosen) + 1 >= len(best):
+            return
+        uncovered = full & ~covered
+        for mask in covering[uncovered & -uncovered]:
+            chosen.append(mask)
+            search(covered | mask)
+            chosen.pop()
+
+    search(0)
+    return best
+
+
+def find_team(
+    skills: Iterable[str],
+    users: Dict,
+    allocations: Dict,
+    start_week: YearWeek,
+    end_week: YearWeek,
+    min_free: int,
+) -> Tuple[List, List[str]]:
+    """Look for the smallest team, which together have all the requested skills,
+    and where everyone is free enough in every week of the given range.
+
+    The matching skills of each person are encoded as a bitmask over the
+    requested skills. Of the people with the same bitmask only the one with
+    the most free capacity is considered for the team.
+
+    The team members have the same form as in find_person_available_in_range.
+    If none of the available people have some requested skill, the team covers
+    the rest of the skills, and the missing skills are returned as well.
+
+    :param skills: Names of requested skills.
+    :param users: User information output of the Data API.
+    :param allocations: Allocation information output of the Data API.
+    :param start_week: The first week of the range.
+    :param end_week: The last week of the range.
+    :param min_free: Free capacity percentage required for every week of the range.
+    :return: Tuple: (team members, missing skills)
+    """
+    # the requested skills, once each when normalized as in find
+    unique = {}
+    for skill in skills:
+        unique.setdefault(normalize_skill(skill), skill)
+    skills = list(unique.values())
+    if start_week > end_week:
+        return [], skills
+    bits = {normalize_skill(skill): 1 << i for i, skill in enumerate(skills)}
+
+    masks = {}
+    for person in users.values():
+        mask = 0
+        for skill in person["skills"] or ():
+            mask |= bits.get(normalize_skill(skill), 0)
+        if mask:
+            masks[person["employeeId"]] = mask
+
+    index = availability_index(allocations, start_week, end_week, masks)
+    free_for_whole_range = WeeklyAvailability([100])
+
+    # the most available person for each combination of matching skills
+    best_by_mask = {}
+    for employee_id, mask in masks.items():
+        availability = index.get(employee_id, free_for_whole_range)
+        last = availability.nb_weeks - 1
+        worst = availability.min_free(0, last)
+        if worst < min_free or worst == 0:
+            continue
+        key = (worst, availability.average_free(0, last))
+        if mask not in best_by_mask or key > best_by_mask[mask][0]:
+            best_by_mask[mask] = (key, employee_id)
+
+    full = 0
+    for mask in best_by_mask:
+        full |= mask
+    missing = [skill for skill in skills if not bits[normalize_skill(skill)] & full]
+    if not full:
+        return [], missing
+
+    range_str = f"{start_week}..{end_week}"
+    team = []
+    for mask in smallest_cover(best_by_mask, full):
+        (worst, _average), employee_id = best_by_mask[mask]
+        team_skills = tuple(
+            skill for skill in skills if bits[normalize_skill(skill)] & mask
+        )
+        team.append((employee_id, team_skills, [(range_str, 1 - worst / 100)]))
+    return team, missing
@@ -0,0 +1,229 @@
+"""
+The mock data api on an asyncio (aiohttp) server, for load tests with more
+concurrent requests than the Flask development server of app.py keeps up
+with. The routes are the same, from api.py, and the responses are cached,
+tagged, compressed and made faulty the same way, see app.py.
+
+  python -m aio_app [port]
+"""
+import asyncio
+import hashlib
+import json
+import sys
+
+from aiohttp import web
+
+import api
+from api import COMPRESSORS, COMPRESSION_MIN_SIZE, cache_get, cache_put
+from datasource import Datasource
+from faults import FaultInjector
+
+
+class Query:
+    "Query parameters of a request, with getlist like request.args of Flask"
+
+    def __init__(self, query):
+        self.query = query
+
+    def get(self, name):
+        return self.query.get(name)
+
+    def getlist(self, name):
+        return self.query.getall(name, [])
+
+
+@web.middleware
+async def require_api_key(request, handler):
+    if request.headers.get("x-api-key") != api.API_KEY:
+        return web.Response(status=401, text="You shall not pass")
+    return await handler(request)
+
+
+@web.middleware
+async def inject_faults(request, handler):
+    "Delay the request, or respond with an error, as configured in faults"
+    if request.path.startswith("/admin/"):
+        return await handler(request)
+    outcome = request.app["faults"].outcome(request.path)
+    await asyncio.sleep(outcome.delay)
+    if outcome.status is not None:
+        return web.json_response({"error": "injected fault"}, status=outcome.status)
+    request["fault_outcome"] = outcome
+    return await handler(request)
+
+
+def accepted_encoding(request):
+    "Return the compression of COMPRESSORS the request accepts best, or None"
+    qualities = {}
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, param = item.partition(";")
+        param = param.strip()
+        try:
+            quality = float(param[2:]) if param.startswith("q=") else 1.0
+        except ValueError:
+            quality = 0.0
+        qualities[name.strip().lower()] = quality
+    accepted = {
+        encoding: qualities.get(encoding, qualities.get("*", 0.0))
+        for encoding in COMPRESSORS
+    }
+    best = max(accepted, key=accepted.get)
+    return best if accepted[best] > 0 else None
+
+
+def is_not_modified(request, etag):
+    "Whether the client's copy, tagged in If-None-Match, is still valid"
+    tags = request.headers.get("If-None-Match", "").split(",")
+    return any(tag.strip() in ("*", f'"{etag}"', f'W/"{etag}"') for tag in tags)
+
+
+async def send(request, body, etag):
+    """ Send the successful JSON response, or 304 if the client's copy is still
+    valid. Large responses are compressed like in app.compress.
+
+    @param body: Serialized response
+    @param etag: Unquoted ETag of the body
+    """
+    headers = {"ETag": f'"{etag}"', "Vary": "Accept-Encoding"}
+    if is_not_modified(request, etag):
+        return web.Response(status=304, headers=headers)
+    encoding = accepted_encoding(request)
+    if encoding is not None and len(body) >= COMPRESSION_MIN_SIZE:
+        key = (etag, encoding)
+        compressed = cache_get(api.compressed_cache, key)
+        if compressed is None:
+            compressed = COMPRESSORS[encoding](body)
+            cache_put(api.compressed_cache, key, compressed, api.MAX_COMPRESSED_CACHE)
+        body = compressed
+        headers["Content-Encoding"] = encoding
+        # the compressed body is not byte-for-byte the tagged one
+        headers["ETag"] = f'W/"{etag}"'
+
+    outcome = request.get("fault_outcome")
+    if outcome is not None and (outcome.reset or outcome.drip):
+        return await send_faulty(request, body, headers, outcome)
+    return web.Response(body=body, headers=headers, content_type="application/json")
+
+
+async def send_faulty(request, body, headers, outcome):
+    "Send the body slowly, or close the connection in the middle of it"
+    response = web.StreamResponse(headers=headers)
+    response.content_type = "application/json"
+    # Content-Length is kept, for the client to notice a missing end
+    response.content_length = len(body)
+    await response.prepare(request)
+    if outcome.reset:
+        await response.write(body[: len(body) // 2])
+        request.transport.close()
+        return response
+    size = outcome.drip.chunk_size
+    for start in range(0, len(body), size):
+        await asyncio.sleep(outcome.drip.interval)
+        await response.write(body[start : start + size])
+    await response.write_eof()
+    return response
+
+
+def serialize(data):
+    "Return the JSON of the data, and its ETag"
+    body = json.dumps(data, separators=(",", ":")).encode()
+    return body, hashlib.sha1(body).hexdigest()
+
+
+async def respond(request, data, status=200):
+    body, etag = serialize(data)
+    if status != 200:
+        return web.Response(body=body, status=status, content_type="application/json")
+    return await send(request, body, etag)
+
+
+def cached(route):
+    """ Make a handler of the collection route of api, serving the successful
+    responses from response_cache like app.cached
+    """
+
+    async def handler(request):
+        source = request.app["source"]
+        key = api.response_cache_key(request.path, request.query.items(), source)
+        entry = cache_get(api.response_cache, key)
+        if entry is None:
+            data, status = route(source, Query(request.query))
+            if status != 200:
+                return await respond(request, data, status)
+            body, etag = serialize(data)
+            entry = (body, "application/json", etag)
+            cache_put(api.response_cache, key, entry, api.MAX_RESPONSE_CACHE)
+        body, _mimetype, etag = entry
+        return await send(request, body, etag)
+
+    return handler
+
+
+async def admin_faults(request):
+    "Get, replace or clear the faults configuration, see faults.py"
+    faults = request.app["faults"]
+    if request.method == "PUT":
+        try:
+            faults.configure(await request.json() or {})
+        except ValueError as error:
+            return web.json_response({"error": str(error)}, status=400)
+    elif request.method == "DELETE":
+        faults.configure({})
+    return web.json_response(faults.config)
+
+
+async def user(request):
+    "Return info of the user (e.g. skills, wishes)"
+    user_id = int(request.match_info["user_id"])
+    return await respond(request, *api.user(request.app["source"], user_id))
+
+
+async def search(request):
+    data, status = api.search(request.app["source"], Query(request.query))
+    return await respond(request, data, status)
+
+
+async def changes(request):
+    data, status = api.changes(request.app["source"], Query(request.query))
+    return await respond(request, data, status)
+
+
+async def reload(request):
+    return await respond(request, *api.reload(request.app["source"]))
+
+
+def example(data):
+    async def handler(request):
+        return await respond(request, data)
+
+    return handler
+
+
+def make_app(source):
+    "Return the application serving the data of the Datasource"
+    app = web.Application(middlewares=[require_api_key, inject_faults])
+    app["source"] = source
+    app["faults"] = FaultInjector()
+    app.add_routes(
+        [
+            web.get("/admin/faults", admin_faults),
+            web.put("/admin/faults", admin_faults),
+            web.delete("/admin/faults", admin_faults),
+            web.get("/user/example", example(api.EXAMPLE_USER)),
+            web.get("/user/example/allocations", example(api.EXAMPLE_USER_ALLOCATIONS)),
+            web.get("/allocations/example", example(api.EXAMPLE_ALLOCATIONS)),
+            web.get(r"/user/{user_id:\d+}", user),
+            web.get("/users", cached(api.users)),
+            web.get("/skills", cached(api.skills)),
+            web.get("/allocations", cached(api.allocations)),
+            web.get("/search", search),
+            web.get("/changes", changes),
+            web.post("/reload", reload),
+        ]
+    )
+    return app
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 80
+    web.run_app(make_app(Datasource()), host="0.0.0.0", port=port)
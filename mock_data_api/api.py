@@ -0,0 +1,201 @@
+"""
+Routes of the mock data api, shared by the Flask (app.py) and aiohttp
+(aio_app.py) servers. The endpoints are documented in app.py.
+
+The route functions take the Datasource and the query parameters (with
+get(name) and getlist(name), like request.args of Flask), and return the
+data of the response and its status code.
+"""
+from collections import OrderedDict
+import gzip
+import os
+import threading
+import zlib
+
+API_KEY = "open sesame"
+
+# Responses smaller than this are not worth compressing
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_LEVEL = 6
+COMPRESSORS = {
+    "gzip": lambda data: gzip.compress(data, COMPRESSION_LEVEL),
+    "deflate": lambda data: zlib.compress(data, COMPRESSION_LEVEL),
+}
+# Compressed bodies by (ETag, encoding), the data does not change after loading
+MAX_COMPRESSED_CACHE = 64
+compressed_cache = OrderedDict()
+# Serialized bodies of the collections by (path, query, data version)
+MAX_RESPONSE_CACHE = 256
+response_cache = OrderedDict()
+cache_lock = threading.Lock()
+
+
+def cache_get(cache, key):
+    "Return the value of the key in the LRU cache, or None"
+    with cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def cache_put(cache, key, value, max_size):
+    "Add the value to the LRU cache, evicting the least recently used ones"
+    with cache_lock:
+        cache[key] = value
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+
+def response_cache_key(path, query, source):
+    "Key of a response in response_cache, query as (name, value) pairs"
+    return path, tuple(sorted(query)), source.data_version
+
+
+def collection_params(args):
+    """ Parse the pagination and projection parameters
+
+    @return: tuple: (after, limit, fields), each None when not given
+    @raise ValueError: if the parameters are not valid
+    """
+    after = args.get("after")
+    limit = args.get("limit")
+    after = int(after) if after is not None else None
+    limit = int(limit) if limit is not None else None
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be positive")
+    fields = args.getlist("fields")
+    if fields:
+        fields = {"employeeId"}.union(*(value.split(",") for value in fields))
+    return after, limit, fields or None
+
+
+def collection_response(records, after, limit, fields, **extra):
+    "Return the (page of) records, with only the fields if given"
+    if fields:
+        records = [
+            {key: value for key, value in record.items() if key in fields}
+            for record in records
+        ]
+    if after is None and limit is None and not extra:
+        return records
+    full = limit is not None and len(records) == limit
+    return {
+        **extra,
+        "users": records,
+        "next": records[-1]["employeeId"] if full else None,
+    }
+
+
+def user(source, user_id):
+    "Return info of the user (e.g. skills, wishes)"
+    data = source.user_info(user_id)
+    if data is None:
+        return {}, 404
+    return data, 200
+
+
+def users(source, args):
+    "Return info of all user"
+    try:
+        after, limit, fields = collection_params(args)
+    except ValueError:
+        return {"error": "invalid parameters"}, 400
+    records = source.all_users(after, limit)
+    return collection_response(records, after, limit, fields), 200
+
+
+def skills(source, args):
+    try:
+        after, limit, fields = collection_params(args)
+    except ValueError:
+        return {"error": "invalid parameters"}, 400
+    raw = source.skills_by_user(after, limit)
+    data = [{"employeeId": user, "skills": skills} for user, skills in raw.items()]
+    return collection_response(data, after, limit, fields), 200
+
+
+def allocations(source, args):
+    start = args.get("start")
+    end = args.get("end")
+    if start is None:
+        return {"error": "missing parameters"}, 400
+    try:
+        after, limit, fields = collection_params(args)
+        data = source.allocations_within(start, end, after, limit)
+    except ValueError:
+        return {"error": "invalid parameters"}, 400
+    return (
+        collection_response(
+            data, after, limit, fields, startYearWeek=start, endYearWeek=end
+        ),
+        200,
+    )
+
+
+def search(source, args):
+    skills = args.getlist("skills")
+    start = args.get("start")
+    end = args.get("end")
+    min_free = args.get("min_free")
+    if not skills or start is None or end is None:
+        return {"error": "missing parameters"}, 400
+    try:
+        if min_free is not None:
+            min_free = int(min_free)
+        employee_ids = [int(user) for user in args.getlist("ids")]
+        data = source.search(skills, start, end, min_free, employee_ids)
+    except ValueError:
+        return {"error": "invalid parameters"}, 400
+    return {"startYearWeek": start, "endYearWeek": end, "users": data}, 200
+
+
+def changes(source, args):
+    return source.changes_since(args.get("since")), 200
+
+
+def reload(source):
+    "Reload the data, and drop the responses of the old data"
+    source.reload()
+    with cache_lock:
+        response_cache.clear()
+    return {"token": source.token()}, 200
+
+
+EXAMPLE_USER = {
+    "employeeId": 1,
+    "role": "Developer (Example)",
+    "skills": ["database", "internet explorer", "Web programming"],
+    "wishes": [
+        "I'd like to work on the very fullest stack available, but not overflowing it"
+    ],
+}
+
+EXAMPLE_USER_ALLOCATIONS = {
+    "employeeId": 1,
+    "allocations": [
+        {"id": 12345, "percentage": 100, "yearWeek": "2020-W47",},
+        {"id": 1234, "percentage": 100, "yearWeek": "2020-W48",},
+        {"id": 1234, "percentage": 100, "yearWeek": "2020-W49",},
+        {"id": 1234, "percentage": 100, "yearWeek": "2020-W50",},
+    ],
+}
+
+EXAMPLE_ALLOCATIONS = {
+    "startYearWeek": "2020-W47",
+    "endYearWeek": "2020-W50",
+    "users": [
+        {
+            "employeeId": 1,
+            "allocations": [
+                {"id": 12345, "percentage": 100, "yearWeek": "2020-W47",},
+                {"id": 1234, "percentage": 100, "yearWeek": "2020-W48",},
+                {"id": 1234, "percentage": 100, "yearWeek": "2020-W49",},
+            ],
+        },
+        {
+            "employeeId": 2,
+            "allocations": [{"id": 1234, "percentage": 100, "yearWeek": "2020-W50",},],
+        },
+    ],
+}
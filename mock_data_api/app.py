@@ -1,6 +1,9 @@
 """
 A mock data interface and api for the bot.
 
+The routes are implemented in api.py, and served by this Flask app, or by
+the aiohttp server of aio_app.py for more concurrent requests.
+
 Endpoints:
 
 /user/<id>
@@ -41,6 +44,74 @@ Endpoints:
     }
   ]
 
+/search?skills=<str>&skills=<str>&start=<YearWeek>&end=<YearWeek>&min_free=<int>&ids=<int>&ids=<int>
+  Users with any of the skills (case and punctuation insensitive), or any of
+  the employee ids, with allocations between start and end.
+  When min_free is given, only users at least min_free percent free every
+  week between start and end.
+  {
+    "startYearWeek": str,
+    "endYearWeek": str,
+    "users": [
+      {
+        "employeeId": int,
+        "role": str,
+        "skills": [str],
+        "wishes": [str],
+        "allocations": [Allocation],
+      }
+    ]
+  }
+
+/users, /skills and /allocations are paginated with the parameters
+  limit=<int>  the maximum number of users in the response
+  after=<int>  the employeeId after which the page starts
+With either of them, /users and /skills respond with an object instead of
+the array, and all three have the cursor for the next page, when the page
+is full (the next page can be empty):
+  {
+    "users": [...],
+    "next": int or null,
+  }
+The records are in the order of employeeId. The fields of the records can
+be selected with fields=<str> (repeated or comma separated), employeeId is
+always included, e.g. /users?fields=skills
+
+/changes?since=<token>
+  Users added, changed or deleted since the token of a previous response.
+  Without a valid token, e.g. from before a restart, all the users are
+  returned and reset is true.
+  {
+    "token": str,
+    "reset": bool,
+    "users": [
+      {
+        "employeeId": int,
+        "role": str,
+        "skills": [str],
+        "wishes": [str],
+      }
+    ],
+    "deleted": [int],
+  }
+
+GET, PUT or DELETE /admin/faults
+  Get, replace or clear the injected latencies, errors, connection resets
+  and slowly sent bodies, as described in faults.py.
+
+POST /reload
+  Read the data files again, logging the changed users for /changes.
+  {
+    "token": str,
+  }
+
+
+All successful responses have an ETag header. Requests with matching
+If-None-Match header get an empty 304 (Not Modified) response.
+
+Responses of at least COMPRESSION_MIN_SIZE bytes are compressed with gzip or
+deflate, when the request's Accept-Encoding allows it. The compressed
+responses are cached, and have weak ETags.
 
 Allocation
   {
@@ -50,11 +121,18 @@ Allocation
   }
 """
 
-from flask import Flask, jsonify, request
+from functools import wraps
+import time
+
+from flask import Flask, g, jsonify, request
 
+import api
+from api import COMPRESSORS, COMPRESSION_MIN_SIZE, cache_get, cache_put
 from datasource import Datasource
+from faults import FaultInjector, faulty_body
 
 source = Datasource()
+faults = FaultInjector()
 
 
 app = Flask(__name__)
@@ -63,96 +141,181 @@ app = Flask(__name__)
 @app.before_request
 def require_api_key():
     print("key:", request.headers.get("x-api-key"))
-    if request.headers.get("x-api-key") != "open sesame":
+    if request.headers.get("x-api-key") != api.API_KEY:
         return "You shall not pass", 401
 
 
+@app.before_request
+def inject_faults():
+    "Delay the request, or respond with an error, as configured in faults"
+    if request.path.startswith("/admin/"):
+        return None
+    outcome = faults.outcome(request.path)
+    time.sleep(outcome.delay)
+    if outcome.status is not None:
+        return {"error": "injected fault"}, outcome.status
+    g.fault_outcome = outcome
+    return None
+
+
+# Registered first, to be called after the other after_request functions
+@app.after_request
+def inject_body_faults(response):
+    "Send the body slowly, or close the connection in the middle of it"
+    outcome = g.get("fault_outcome")
+    if (
+        outcome is None
+        or not (outcome.reset or outcome.drip)
+        or response.direct_passthrough
+    ):
+        return response
+    # Content-Length is kept, for the client to notice a missing end
+    response.response = faulty_body(response.get_data(), outcome)
+    return response
+
+
+# after_request functions are called in the reverse order of registration,
+# so this is called after add_etag
+@app.after_request
+def compress(response):
+    "Compress large responses with gzip or deflate, if the client accepts it"
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(COMPRESSORS)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return response
+
+    etag, _weak = response.get_etag()
+    key = (etag, encoding)
+    compressed = cache_get(api.compressed_cache, key) if etag else None
+    if compressed is None:
+        compressed = COMPRESSORS[encoding](body)
+        if etag:
+            cache_put(api.compressed_cache, key, compressed, api.MAX_COMPRESSED_CACHE)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    if etag:
+        # the compressed body is not byte-for-byte the tagged one
+        response.set_etag(etag, weak=True)
+    return response
+
+
+@app.after_request
+def add_etag(response):
+    "Tag successful responses, and reply 304 if the client's copy is still valid"
+    if request.method == "GET" and response.status_code == 200:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+def cached(view):
+    """ Serve the successful responses of the view from response_cache
+
+    The cached response is serialized and tagged once, and compress finds the
+    compressed variants by the ETag, so repeated requests only send bytes.
+    """
+
+    @wraps(view)
+    def cached_view(*args, **kwargs):
+        key = api.response_cache_key(
+            request.path, request.args.items(multi=True), source
+        )
+        entry = cache_get(api.response_cache, key)
+        if entry is None:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            response.add_etag()
+            entry = (response.get_data(), response.mimetype, response.get_etag()[0])
+            cache_put(api.response_cache, key, entry, api.MAX_RESPONSE_CACHE)
+        body, mimetype, etag = entry
+        response = app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+        return response
+
+    return cached_view
+
+
+@app.route("/admin/faults", methods=["GET", "PUT", "DELETE"])
+def admin_faults():
+    "Get, replace or clear the faults configuration, see faults.py"
+    if request.method == "PUT":
+        try:
+            faults.configure(request.get_json(force=True) or {})
+        except ValueError as error:
+            return {"error": str(error)}, 400
+    elif request.method == "DELETE":
+        faults.configure({})
+    return faults.config
+
+
+def respond(data, status):
+    return jsonify(data), status
+
+
 @app.route("/user/<int:user_id>")
 def user(user_id):
     "Return info of the user (e.g. skills, wishes)"
-    data = source.user_info(user_id)
-    if data is None:
-        return {}, 404
-    return data
+    return respond(*api.user(source, user_id))
 
 
 @app.route("/users")
+@cached
 def users():
     "Return info of all user"
-    return jsonify(source.all_users())
+    return respond(*api.users(source, request.args))
 
 
 @app.route("/skills")
+@cached
 def skills():
-    raw = source.skills_by_user()
-    data = [{"employeeId": user, "skills": skills} for user, skills in raw.items()]
-    return jsonify(data)
+    return respond(*api.skills(source, request.args))
 
 
 @app.route("/allocations")
+@cached
 def allocations():
-    start = request.args.get("start")
-    end = request.args.get("end")
-    if start is None:
-        return {"error": "missing parameters"}, 400
-    try:
-        data = source.allocations_within(start, end)
-    except ValueError:
-        return {"error": "invalid parameters"}, 400
-    return {
-        "startYearWeek": start,
-        "endYearWeek": end,
-        "users": data,
-    }
+    return respond(*api.allocations(source, request.args))
+
+
+@app.route("/search")
+def search():
+    return respond(*api.search(source, request.args))
+
+
+@app.route("/changes")
+def changes():
+    return respond(*api.changes(source, request.args))
+
+
+@app.route("/reload", methods=["POST"])
+def reload():
+    return respond(*api.reload(source))
 
 
 @app.route("/user/example")
 def example_user():
-    return {
-        "employeeId": 1,
-        "role": "Developer (Example)",
-        "skills": ["database", "internet explorer", "Web programming"],
-        "wishes": [
-            "I'd like to work on the very fullest stack available, but not overflowing it"
-        ],
-    }
+    return api.EXAMPLE_USER
 
 
 @app.route("/user/example/allocations")
 def example_user_allocations():
-    return {
-        "employeeId": 1,
-        "allocations": [
-            {"id": 12345, "percentage": 100, "yearWeek": "2020-W47",},
-            {"id": 1234, "percentage": 100, "yearWeek": "2020-W48",},
-            {"id": 1234, "percentage": 100, "yearWeek": "2020-W49",},
-            {"id": 1234, "percentage": 100, "yearWeek": "2020-W50",},
-        ],
-    }
+    return api.EXAMPLE_USER_ALLOCATIONS
 
 
 @app.route("/allocations/example")
 def example_allocations():
-    return {
-        "startYearWeek": "2020-W47",
-        "endYearWeek": "2020-W50",
-        "users": [
-            {
-                "employeeId": 1,
-                "allocations": [
-                    {"id": 12345, "percentage": 100, "yearWeek": "2020-W47",},
-                    {"id": 1234, "percentage": 100, "yearWeek": "2020-W48",},
-                    {"id": 1234, "percentage": 100, "yearWeek": "2020-W49",},
-                ],
-            },
-            {
-                "employeeId": 2,
-                "allocations": [
-                    {"id": 1234, "percentage": 100, "yearWeek": "2020-W50",},
-                ],
-            },
-        ],
-    }
+    return api.EXAMPLE_ALLOCATIONS
 
 
 if __name__ == "__main__":
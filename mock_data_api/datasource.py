@@ -1,58 +1,285 @@
-from collections import namedtuple
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
 from pathlib import Path
+from typing import Any, Iterator, List, TextIO
+from uuid import uuid4
 
+import hashlib
 import json
+import os
+import pickle
+import sys
+
+from synthetic import SyntheticCompany
 
 DATA_DIR = Path(__file__).resolve(strict=True).parent / "data"
 PEOPLE_FILE = DATA_DIR / "people-simple.json"
 ALLOCATION_FILE = DATA_DIR / "allocation.json"
+# Parsed data files, loaded instead of parsing them again
+CACHE_FILE = DATA_DIR / "parsed.pickle"
+# Change when the parsed data changes, to not load older caches
+CACHE_VERSION = 1
+
+# Size and seed of a generated company, served instead of the data files
+# when MOCK_EMPLOYEES is set
+MOCK_EMPLOYEES = os.environ.get("MOCK_EMPLOYEES")
+MOCK_SEED = int(os.environ.get("MOCK_SEED", 0))
+
+JSON_DECODER = json.JSONDecoder()
+SEPARATORS = frozenset(" \t\r\n,[]")
+
+
+def iter_json_values(f: TextIO, chunk_size: int = 2 ** 16) -> Iterator[Any]:
+    """ Parse the JSON values of a file one at a time, reading it in chunks.
+    The values can be one after another, e.g. pretty-printed objects, or the
+    items of a top-level array. The text of each value is decoded once, and
+    only the text of the value being read is buffered.
+
+    @param f: File opened in text mode
+    @param chunk_size: Number of characters read at a time
+    @return: generator of the parsed values
+    """
+    buffer = ""
+    pos = 0
+    for chunk in iter(lambda: f.read(chunk_size), ""):
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            pos = _skip_separators(buffer, pos)
+            if pos == len(buffer):
+                break
+            try:
+                value, end = JSON_DECODER.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # the value continues in the next chunk
+            if end == len(buffer) and not isinstance(value, (dict, list, str)):
+                break  # a number may continue in the next chunk
+            yield value
+            pos = end
+    pos = _skip_separators(buffer, pos)
+    if pos < len(buffer):
+        # invalid, or the file ended in the middle of a value
+        value, pos = JSON_DECODER.raw_decode(buffer, pos)
+        yield value
+
+
+def _skip_separators(text: str, pos: int) -> int:
+    "Skip whitespace, commas and brackets in text from pos, return the next position"
+    while pos < len(text) and text[pos] in SEPARATORS:
+        pos += 1
+    return pos
 
 
 def parse_users(path: Path):
     """ Parse user data json to json.
     Assumes the data file to be as given by customer, i.e. unmodified.
-    That is,
+    That is, the user objects one after another.
 
     @param path: User data file path
     @return: User data as JSON
     """
     users = {}
     with path.open(encoding="utf-8") as f:
-        user_dict = ""
-        for line in f:
-            if line.startswith("}"):
-                user_dict += "}"
-                user = json.loads(user_dict)
-                users[user["employeeId"]] = user
-                user_dict = ""
-            else:
-                user_dict += line
+        for user in iter_json_values(f):
+            users[user["employeeId"]] = user
     return users
 
 
 def parse_allocations(path: Path):
     # assuming one array
-    with path.open() as f:
-        raw = json.load(f)
     result = {}
-    keys = ("id", "yearWeek", "percentage")
-    for user in raw:
-        user_id = user["user"]["employeeId"]
-        allocations = []
-        for project in user.get("projects", ()):
-            allocations.extend(
-                {key: alloc[key] for key in keys}
-                for alloc in project.get("allocations", ())
-            )
-        allocations.sort(key=lambda item: item["yearWeek"])
-        result[user_id] = allocations
+    with path.open(encoding="utf-8") as f:
+        for user in iter_json_values(f):
+            user_id = user["user"]["employeeId"]
+            allocations = []
+            for project in user.get("projects", ()):
+                allocations.extend(
+                    {
+                        "id": alloc["id"],
+                        # the same weeks repeat in every user's allocations
+                        "yearWeek": sys.intern(alloc["yearWeek"]),
+                        "percentage": alloc["percentage"],
+                    }
+                    for alloc in project.get("allocations", ())
+                )
+            allocations.sort(key=lambda item: item["yearWeek"])
+            result[user_id] = allocations
     return result
 
 
+def page(ids, after=None, limit=None):
+    """ Slice a page of sorted ids, for cursor pagination
+
+    @param ids: Sorted ids
+    @param after: Id after which the page starts, None to start from the first
+    @param limit: Maximum size of the page, None for no limit
+    @return: The ids of the page
+    """
+    first = bisect_right(ids, after) if after is not None else 0
+    return ids[first : first + limit] if limit else ids[first:]
+
+
+def file_key(path: Path):
+    "Identify the contents of the file, by its modification time, size and hash"
+    stat = path.stat()
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(chunk)
+    return stat.st_mtime_ns, stat.st_size, digest.hexdigest()
+
+
+def load_data():
+    """ Load the users and allocations, from the cache file when it was made
+    from the same data files, otherwise by parsing the data files and
+    updating the cache.
+
+    @return: tuple: (users, allocations)
+    """
+    people_file, allocation_file = PEOPLE_FILE, ALLOCATION_FILE
+    key = (CACHE_VERSION, file_key(people_file), file_key(allocation_file))
+    try:
+        with CACHE_FILE.open("rb") as f:
+            cached_key, data = pickle.load(f)
+        if cached_key == key:
+            return data
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+
+    data = parse_users(people_file), parse_allocations(allocation_file)
+    try:
+        with CACHE_FILE.open("wb") as f:
+            pickle.dump((key, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as error:
+        print("could not write the data cache:", error)
+    return data
+
+
+def normalize_skill(skill: str) -> str:
+    """ Normalize skill for searching, e.g. "React.js" and "ReactJS" to "reactjs"
+
+    @param skill: Skill as written
+    @return: Lowercase skill without other than alphanumeric characters
+    """
+    return "".join(c for c in skill.lower() if c.isalnum())
+
+
+def check_year_week(year_week: str):
+    """ Check that the year-week is valid, e.g. 2020-W40
+
+    @param year_week: Year-week as string
+    @raise ValueError: if the year-week is not valid
+    """
+    datetime.strptime(year_week + "-1", "%G-W%V-%u")
+
+
 class Datasource:
     def __init__(self):
-        self.users = parse_users(PEOPLE_FILE)
-        self.allocations = parse_allocations(ALLOCATION_FILE)
+        self.company = None
+        if MOCK_EMPLOYEES:
+            self.company = SyntheticCompany(int(MOCK_EMPLOYEES), MOCK_SEED)
+            self.users = dict(self.company.users)
+            self.allocations = dict(self.company.allocations)
+        else:
+            self.users, self.allocations = load_data()
+        self._make_indexes()
+
+        # Log of the changed users for the changes since a token. The tokens
+        # of a previous run are not valid, as the log is not persisted.
+        self.run_id = uuid4().hex[:8]
+        self.version = 0
+        # Incremented on every reload, unlike version which counts changed users
+        self.data_version = 0
+        self._change_versions = []
+        self._changed_users = []
+
+    def _make_indexes(self):
+        # users in order for pagination
+        self.user_ids = sorted(self.users)
+
+        # indexes for searching
+        self.users_by_skill = defaultdict(set)
+        for user, info in self.users.items():
+            for skill in info["skills"] or ():
+                self.users_by_skill[normalize_skill(skill)].add(user)
+        self.allocation_weeks = {
+            user: [allocation["yearWeek"] for allocation in allocations]
+            for user, allocations in self.allocations.items()
+        }
+        # the users allocated in each week, and the weeks in order
+        self.users_by_week = defaultdict(set)
+        for user, weeks in self.allocation_weeks.items():
+            for week in weeks:
+                self.users_by_week[week].add(user)
+        self.weeks = sorted(self.users_by_week)
+
+    def reload(self):
+        """ Read the data files again, or change the generated company, and
+        log the users that have changed
+        """
+        if self.company is not None:
+            self.company.step()
+            users = dict(self.company.users)
+            self.allocations = dict(self.company.allocations)
+        else:
+            users, self.allocations = load_data()
+        changed = [
+            user
+            for user in self.users.keys() | users.keys()
+            if self.users.get(user) != users.get(user)
+        ]
+        self.users = users
+        self._make_indexes()
+        self.data_version += 1
+        self._log_changes(changed)
+
+    def _log_changes(self, users):
+        "Log the users as changed in a new version"
+        if not users:
+            return
+        self.version += 1
+        for user in users:
+            self._change_versions.append(self.version)
+            self._changed_users.append(user)
+
+    def token(self):
+        return f"{self.run_id}.{self.version}"
+
+    def changes_since(self, token=None):
+        """ Users added, changed or deleted since the token
+
+        When the token is not given or is not valid, e.g. from a previous
+        run, all the users are returned, and reset is true.
+
+        returns dict: {
+            "token": str,
+            "reset": bool,
+            "users": [dict],  # as from user_info
+            "deleted": [int],
+        }
+        """
+        run_id, _, version = (token or "").partition(".")
+        if (
+            run_id != self.run_id
+            or not version.isdigit()
+            or int(version) > self.version
+        ):
+            return {
+                "token": self.token(),
+                "reset": True,
+                "users": self.all_users(),
+                "deleted": [],
+            }
+        first = bisect_right(self._change_versions, int(version))
+        # unique ids in the order of the changes
+        changed = dict.fromkeys(self._changed_users[first:])
+        return {
+            "token": self.token(),
+            "reset": False,
+            "users": [self.users[user] for user in changed if user in self.users],
+            "deleted": [user for user in changed if user not in self.users],
+        }
 
     def user_info(self, user_id):
         """
@@ -65,32 +292,85 @@ class Datasource:
         """
         return self.users.get(user_id)
 
-    def all_users(self):
-        return list(self.users.values())
+    def all_users(self, after=None, limit=None):
+        "Users in the order of employeeId, optionally a page of them, see page"
+        return [self.users[user] for user in page(self.user_ids, after, limit)]
+
+    def skills_by_user(self, after=None, limit=None):
+        """returns dict: {employeeId: [str]}, optionally a page of users, see page"""
+        return {
+            user: self.users[user]["skills"]
+            for user in page(self.user_ids, after, limit)
+        }
+
+    def allocations_within(self, start, end=None, after=None, limit=None):
+        """ Allocations from start to end inclusive, using the week indexes
 
-    def skills_by_user(self):
-        """returns dict: {employeeId: [str]}"""
-        return {user: info["skills"] for user, info in self.users.items()}
+        Users are in the order of employeeId, optionally a page of them, see page.
 
-    def allocations_within(self, start, end=None):
+        returns list: [{"employeeId": int, "allocations": [Allocation]}]
+        """
         if end and start > end:
             return []
+        first = bisect_left(self.weeks, start)
+        last = bisect_right(self.weeks, end) if end else len(self.weeks)
+        users = set()
+        for week in self.weeks[first:last]:
+            users.update(self.users_by_week[week])
+
+        result = []
+        for user in page(sorted(users), after, limit):
+            result.append(
+                {
+                    "employeeId": user,
+                    "allocations": self._allocations_between(user, start, end),
+                }
+            )
+        return result
 
-        if end:
+    def _allocations_between(self, user, start, end=None):
+        "Allocations of the user from start to end inclusive, using the sorted weeks"
+        weeks = self.allocation_weeks.get(user, ())
+        first = bisect_left(weeks, start)
+        last = bisect_right(weeks, end) if end else len(weeks)
+        return self.allocations[user][first:last]
 
-            def in_range(allocation):
-                return start <= allocation["yearWeek"] <= end
+    def search(self, skills, start, end, min_free=None, employee_ids=()):
+        """ Find users with any of the skills, or any of the employee_ids, and
+        their allocations from start to end
 
-        else:
+        When min_free is given, only users who are at least min_free percent
+        free (and not fully allocated) in every week of the range are included.
 
-            def in_range(allocation):
-                return start <= allocation["yearWeek"]
+        returns list: [
+          {
+            "employeeId": int,
+            "role": str,
+            "skills": [str],
+            "wishes": [str],
+            "allocations": [Allocation],
+          }
+        ]
+        """
+        check_year_week(start)
+        check_year_week(end)
+        if start > end:
+            return []
+
+        found = set()
+        for skill in skills:
+            found.update(self.users_by_skill.get(normalize_skill(skill), ()))
+        found.update(user for user in employee_ids if user in self.users)
 
         result = []
-        for user, allocations in self.allocations.items():
-            matching = list(filter(in_range, allocations))
-            if matching:
-                result.append(
-                    {"employeeId": user, "allocations": matching,}
-                )
+        for user in sorted(found):
+            allocations = self._allocations_between(user, start, end)
+            if min_free is not None:
+                allocated = Counter()
+                for allocation in allocations:
+                    allocated[allocation["yearWeek"]] += allocation["percentage"]
+                busiest = max(allocated.values(), default=0)
+                if 100 - busiest < max(min_free, 1):
+                    continue
+            result.append({**self.users[user], "allocations": allocations})
         return result
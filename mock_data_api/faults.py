@@ -0,0 +1,158 @@
+""" Fault injection for the mock data api
+
+Faults are configured by the first part of the route (e.g. /users, or /user
+for /user/<id>), with "*" for the routes not configured otherwise:
+  {
+    "seed": int,  # optional, for repeatable faults
+    "routes": {
+      "/users": {
+        # lognormal response delay in seconds
+        "latency": {"median": float, "p99": float},
+        # probabilities of error responses by status code
+        "errors": {"401": float, "404": float, "500": float},
+        # probability of closing the connection in the middle of the response
+        "reset": float,
+        # sending the response body in chunks of chunk_size bytes, waiting
+        # interval seconds before each chunk
+        "drip": {"chunk_size": int, "interval": float},
+      }
+    }
+  }
+"""
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional
+
+import math
+import random
+import threading
+import time
+
+# The 99th percentile of the standard normal distribution
+Z_99 = 2.3263
+
+
+class ConnectionReset(Exception):
+    "Raised in the middle of a response body to close the connection"
+
+
+def route_group(path: str) -> str:
+    "Return the first part of the path, e.g. /user for /user/123"
+    return "/" + path.lstrip("/").split("/", 1)[0]
+
+
+@dataclass
+class Latency:
+    median: float
+    p99: float
+
+    def sample(self, rng: random.Random) -> float:
+        "Return a lognormal delay with the median and 99th percentile"
+        if self.median <= 0:
+            return 0.0
+        sigma = max(math.log(max(self.p99, self.median) / self.median) / Z_99, 0)
+        return rng.lognormvariate(math.log(self.median), sigma)
+
+
+@dataclass
+class Drip:
+    chunk_size: int
+    interval: float
+
+
+@dataclass
+class RouteFaults:
+    latency: Optional[Latency] = None
+    errors: Dict[int, float] = field(default_factory=dict)
+    reset: float = 0.0
+    drip: Optional[Drip] = None
+
+    @classmethod
+    def from_json(cls, config: dict) -> "RouteFaults":
+        """ Parse the faults of a route
+
+        @raise ValueError: if the configuration is not valid
+        """
+        try:
+            latency = config.get("latency")
+            drip = config.get("drip")
+            errors = config.get("errors", {})
+            faults = cls(
+                latency=Latency(**latency) if latency else None,
+                errors={int(status): float(rate) for status, rate in errors.items()},
+                reset=float(config.get("reset", 0)),
+                drip=Drip(**drip) if drip else None,
+            )
+        except (AttributeError, TypeError) as error:
+            raise ValueError(f"invalid faults: {error}")
+        rates = [faults.reset, *faults.errors.values()]
+        if any(not 0 <= rate <= 1 for rate in rates) or sum(rates) > 1:
+            raise ValueError("rates must be between 0 and 1, and sum to at most 1")
+        if faults.drip and faults.drip.chunk_size < 1:
+            raise ValueError("drip chunk_size must be positive")
+        return faults
+
+
+@dataclass
+class Outcome:
+    "What happens to one request"
+    delay: float = 0.0
+    status: Optional[int] = None
+    """Status of the error response, None for the normal response"""
+    reset: bool = False
+    drip: Optional[Drip] = None
+
+
+class FaultInjector:
+    "Thread-safe faults configuration, deciding the faults of each request"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure({})
+
+    def configure(self, config: dict):
+        """ Replace the faults with the configuration, see the module docstring
+
+        @raise ValueError: if the configuration is not valid
+        """
+        if not isinstance(config, dict) or not isinstance(
+            config.get("routes", {}), dict
+        ):
+            raise ValueError("faults must be an object with the routes as an object")
+        routes = {
+            route: RouteFaults.from_json(faults)
+            for route, faults in config.get("routes", {}).items()
+        }
+        with self._lock:
+            self.config = config
+            self.routes = routes
+            self.rng = random.Random(config.get("seed"))
+
+    def outcome(self, path: str) -> Outcome:
+        "Decide the faults of a request to the path"
+        with self._lock:
+            faults = self.routes.get(route_group(path), self.routes.get("*"))
+            if faults is None:
+                return Outcome()
+            delay = faults.latency.sample(self.rng) if faults.latency else 0.0
+            roll = self.rng.random()
+        for status, rate in faults.errors.items():
+            if roll < rate:
+                return Outcome(delay, status=status)
+            roll -= rate
+        return Outcome(delay, reset=roll < faults.reset, drip=faults.drip)
+
+
+def faulty_body(body: bytes, outcome: Outcome) -> Iterator[bytes]:
+    """ Yield the body slowly in chunks, or half of it before raising
+    ConnectionReset, as decided by the outcome
+    """
+    if outcome.reset:
+        yield body[: len(body) // 2]
+        raise ConnectionReset()
+    if outcome.drip is None:
+        yield body
+        return
+    size = outcome.drip.chunk_size
+    for start in range(0, len(body), size):
+        time.sleep(outcome.drip.interval)
+        yield body[start : start + size]
@@ -0,0 +1,238 @@
+"""
+Deterministic synthetic company for the mock data api, and for the
+benchmarks of the bot, which import it from here.
+"""
+from datetime import date, timedelta
+from itertools import accumulate
+from typing import List
+
+import random
+import sys
+
+# Skills that are often listed together, with the roles having them.
+# Within a cluster the skills are in the order of popularity.
+# fmt: off
+SKILL_CLUSTERS = [
+    (
+        ("Frontend Developer", "Web Developer"),
+        ["JavaScript", "React", "CSS", "HTML", "TypeScript", "Redux", "Vue.js",
+         "Angular", "Webpack", "Sass", "Next.js", "Svelte"],
+    ),
+    (
+        ("Backend Developer", "Software Developer"),
+        ["Java", "Python", "SQL", "Spring Boot", "Node.js", "REST", "PostgreSQL",
+         "Django", "C#", ".NET", "Go", "Kotlin", "MongoDB", "GraphQL", "Kafka"],
+    ),
+    (
+        ("DevOps Engineer", "Cloud Architect"),
+        ["AWS", "Docker", "Linux", "Kubernetes", "Azure", "Terraform", "CI/CD",
+         "Jenkins", "Ansible", "Google Cloud", "Bash", "Prometheus"],
+    ),
+    (
+        ("Data Scientist", "Data Engineer"),
+        ["Python", "SQL", "Machine Learning", "Pandas", "Statistics", "Spark",
+         "TensorFlow", "Power BI", "R", "Airflow", "PyTorch", "Tableau"],
+    ),
+    (
+        ("Mobile Developer",),
+        ["Android", "iOS", "Kotlin", "Swift", "React Native", "Flutter",
+         "Objective-C", "Firebase"],
+    ),
+    (
+        ("Test Automation Engineer", "QA Engineer"),
+        ["Testing", "Test Automation", "Robot Framework", "Selenium", "Python",
+         "Cypress", "JMeter", "Jira"],
+    ),
+    (
+        ("Designer", "Service Designer"),
+        ["UX", "UI Design", "Figma", "Service Design", "Usability",
+         "Prototyping", "Adobe XD", "Accessibility"],
+    ),
+    (
+        ("Project Manager", "Scrum Master"),
+        ["Project Management", "Scrum", "Agile", "Jira", "Leadership",
+         "Requirements Engineering", "SAFe", "Kanban"],
+    ),
+    (
+        ("Embedded Developer",),
+        ["C", "C++", "Embedded Systems", "Linux", "Qt", "RTOS", "Python",
+         "Yocto"],
+    ),
+]
+# fmt: on
+# Skills listed by only a few, e.g. niche tools
+NB_RARE_SKILLS = 2000
+PERCENTAGES = (20, 40, 50, 60, 80, 100)
+PERCENTAGE_WEIGHTS = (10, 10, 20, 10, 20, 30)
+# Syllables of the generated skill names. The skill recommender of the bot
+# removes numbers from the skills, and stems them, so the names are made of
+# letters, and end in a vowel other than e.
+CONSONANTS = "bdfgklmnprstvz"
+VOWELS = "aeiou"
+FINAL_VOWELS = "aiou"
+
+
+def zipf_weights(n: int, exponent: float = 1.1) -> List[float]:
+    "Cumulative Zipfian weights for n items, the first being the most popular"
+    return list(accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+
+def skill_names(n: int, rng: random.Random) -> List[str]:
+    "Return n distinct word-like skill names, e.g. 'Kavoru'"
+    names = {}  # ordered, for the same names with the same seed
+    while len(names) < n:
+        syllables = [
+            rng.choice(CONSONANTS) + rng.choice(VOWELS)
+            for _ in range(rng.randint(1, 3))
+        ]
+        syllables.append(rng.choice(CONSONANTS) + rng.choice(FINAL_VOWELS))
+        names["".join(syllables).capitalize()] = None
+    return list(names)
+
+
+def year_week(day: date) -> str:
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02}"
+
+
+class SyntheticCompany:
+    """ Deterministic synthetic users and allocations for load testing
+
+    Each employee has a main cluster of co-occurring skills, which gives
+    their role, and maybe a few others. The clusters and the skills within
+    them follow Zipfian popularity, and some employees list a rare skill.
+    Projects of a few weeks to a year need people of one cluster, and each
+    employee has zero to three projects of their main cluster.
+
+    The company changes over time with step: employees leave and join, and
+    learn new skills.
+    """
+
+    def __init__(
+        self,
+        nb_employees: int,
+        seed: int = 0,
+        first_day: date = None,
+        nb_weeks: int = 78,
+        churn: float = 0.01,
+    ):
+        """
+        @param nb_employees: Number of employees
+        @param seed: Seed of the random generator, the same seed gives the same company
+        @param first_day: Day of the first week of allocations, by default 26 weeks ago
+        @param nb_weeks: Number of weeks of allocations
+        @param churn: Fraction of employees leaving, joining and learning skills in a step
+        """
+        self.rng = random.Random(seed)
+        self.churn = churn
+        first_day = first_day or date.today() - timedelta(weeks=26)
+        self.weeks = [
+            sys.intern(year_week(first_day + timedelta(weeks=i)))
+            for i in range(nb_weeks)
+        ]
+        self.rare_skills = skill_names(NB_RARE_SKILLS, random.Random(seed))
+        self.cluster_weights = zipf_weights(len(SKILL_CLUSTERS))
+        self.rare_weights = zipf_weights(NB_RARE_SKILLS, 0.8)
+        self.users = {}
+        self.allocations = {}
+        # The allocations are shared by the employees with the same
+        # project, week and percentage
+        self._allocation_objects = {}
+        # [(id, first week index, duration)] by cluster
+        self._projects = [[] for _ in SKILL_CLUSTERS]
+        self._next_project = 1
+        self._next_id = 1
+        for _ in range(nb_employees):
+            self._add_employee()
+
+    def _clusters(self):
+        "Return indexes of the clusters of an employee, the main cluster first"
+        clusters = self.rng.choices(
+            range(len(SKILL_CLUSTERS)),
+            cum_weights=self.cluster_weights,
+            k=self.rng.choice((1, 1, 2, 2, 3)),
+        )
+        return list(dict.fromkeys(clusters))
+
+    def _skills(self, cluster: int, nb: int):
+        skills = SKILL_CLUSTERS[cluster][1]
+        return self.rng.choices(skills, cum_weights=zipf_weights(len(skills)), k=nb)
+
+    def _add_employee(self):
+        rng = self.rng
+        employee_id = self._next_id
+        self._next_id += 1
+        clusters = self._clusters()
+        skills = self._skills(clusters[0], rng.randint(3, 8))
+        for cluster in clusters[1:]:
+            skills += self._skills(cluster, rng.randint(1, 4))
+        if rng.random() < 0.3:
+            skills += rng.choices(self.rare_skills, cum_weights=self.rare_weights)
+        other = rng.choices(
+            range(len(SKILL_CLUSTERS)), cum_weights=self.cluster_weights
+        )[0]
+        self.users[employee_id] = {
+            "employeeId": employee_id,
+            "role": rng.choice(SKILL_CLUSTERS[clusters[0]][0]),
+            "skills": list(dict.fromkeys(skills)) if rng.random() > 0.03 else None,
+            "wishes": self._skills(other, rng.randint(0, 2)),
+        }
+        self.allocations[employee_id] = self._allocate(clusters[0])
+        return employee_id
+
+    def _allocate(self, cluster: int):
+        "Return allocations on random projects needing the skills of the cluster"
+        rng = self.rng
+        cluster_projects = self._projects[cluster]
+        allocations = []
+        projects = set()
+        for _ in range(rng.choice((0, 1, 1, 2, 2, 3))):
+            # new projects are started as the company grows
+            if not cluster_projects or rng.random() < 0.2:
+                start = rng.randrange(len(self.weeks))
+                cluster_projects.append((self._next_project, start, rng.randint(4, 52)))
+                self._next_project += 1
+            project, start, duration = rng.choice(cluster_projects)
+            if project in projects:
+                continue
+            projects.add(project)
+            percentage = rng.choices(PERCENTAGES, PERCENTAGE_WEIGHTS)[0]
+            for week in self.weeks[start : start + duration]:
+                key = (project, week, percentage)
+                allocation = self._allocation_objects.get(key)
+                if allocation is None:
+                    allocation = {
+                        "id": project,
+                        "yearWeek": week,
+                        "percentage": percentage,
+                    }
+                    self._allocation_objects[key] = allocation
+                allocations.append(allocation)
+        allocations.sort(key=lambda item: item["yearWeek"])
+        return allocations
+
+    def step(self):
+        """ Change the company: churn of the employees leave, as many join,
+        and churn of the employees learn a new skill
+        """
+        rng = self.rng
+        nb_changed = max(1, round(self.churn * len(self.users)))
+        leaving = rng.sample(sorted(self.users), min(nb_changed, len(self.users)))
+        for employee_id in leaving:
+            del self.users[employee_id]
+            del self.allocations[employee_id]
+        for _ in range(len(leaving)):
+            self._add_employee()
+        for employee_id in rng.sample(sorted(self.users), nb_changed):
+            user = self.users[employee_id]
+            cluster = rng.choices(
+                range(len(SKILL_CLUSTERS)), cum_weights=self.cluster_weights
+            )
+            skills = (user["skills"] or []) + self._skills(cluster[0], 1)
+            # a new object, the previous one may be in use
+            self.users[employee_id] = {**user, "skills": list(dict.fromkeys(skills))}
+
+    def random_query(self, rng: random.Random) -> List[str]:
+        "Random skills from one cluster, as a staffing lead would ask"
+        skills = rng.choices(SKILL_CLUSTERS, cum_weights=self.cluster_weights)[0][1]
+        return rng.sample(skills, rng.randint(1, min(4, len(skills))))
@@ -0,0 +1,66 @@
+"Helpers for the tests of the mock data api, which is not a package"
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Thread
+
+import asyncio
+import socket
+import sys
+
+from aiohttp import web
+from werkzeug.serving import make_server
+
+MOCK_API_DIR = Path(__file__).parents[1] / "mock_data_api"
+API_KEY = "open sesame"
+SERVERS = ["flask", "aiohttp"]
+
+
+def load_mock_api(nb_employees=2000):
+    """ Import the app of the mock data api, serving a synthetic company of
+    nb_employees on the first import
+    """
+    if str(MOCK_API_DIR) not in sys.path:
+        sys.path.insert(0, str(MOCK_API_DIR))
+    import datasource
+
+    datasource.MOCK_EMPLOYEES = str(nb_employees)
+    import app
+
+    return app
+
+
+@contextmanager
+def serve(server):
+    """ Serve the mock data api in a thread, with the Flask app or the aiohttp
+    server of aio_app, both from the same Datasource
+
+    :param server: One of SERVERS
+    :return: context manager of the url of the api
+    """
+    app = load_mock_api()
+    if server == "flask":
+        httpd = make_server("127.0.0.1", 0, app.app, threaded=True)
+        Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            yield f"http://127.0.0.1:{httpd.server_port}"
+        finally:
+            httpd.shutdown()
+        return
+
+    import aio_app
+
+    loop = asyncio.new_event_loop()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    runner = web.AppRunner(aio_app.make_app(app.source))
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.SockSite(runner, sock).start())
+    thread = Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{sock.getsockname()[1]}"
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
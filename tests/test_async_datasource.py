@@ -0,0 +1,174 @@
+import asyncio
+import time
+
+import pytest
+import requests
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from bot.data_api import async_datasource
+from bot.data_api.async_datasource import AsyncDatasource, SyncFacade
+from bot.data_api.datasource import CircuitBreaker, CircuitOpen, Timeout
+from bot.helpers import YearWeek
+
+DELAY = 0.2
+
+
+def make_api():
+    async def users(_request):
+        await asyncio.sleep(DELAY)
+        return web.json_response([{"employeeId": 1, "skills": ["python"]}])
+
+    async def allocations(_request):
+        await asyncio.sleep(DELAY)
+        return web.json_response({"users": [{"employeeId": 1, "allocations": []}]})
+
+    app = web.Application()
+    app.router.add_get("/users", users)
+    app.router.add_get("/allocations", allocations)
+    return app
+
+
+def test_independent_fetches_overlap():
+    async def fetch():
+        server = TestServer(make_api())
+        await server.start_server()
+        ds = AsyncDatasource(str(server.make_url("")).rstrip("/"), "key")
+        try:
+            t = time.perf_counter()
+            users, allocations = await ds.users_and_allocations(YearWeek(2020, 1), None)
+            elapsed = time.perf_counter() - t
+        finally:
+            await ds.close()
+            await server.close()
+        return users, allocations, elapsed
+
+    users, allocations, elapsed = asyncio.run(fetch())
+    assert users == {1: {"employeeId": 1, "skills": ["python"]}}
+    assert allocations == {1: []}
+    assert elapsed < 1.5 * DELAY, "fetches were not concurrent"
+
+
+def test_sync_facade_runs_in_background_loop():
+    facade = SyncFacade(AsyncDatasource("http://localhost", "key"))
+    server = TestServer(make_api())
+    asyncio.run_coroutine_threadsafe(server.start_server(), facade._loop).result()
+    facade.datasource.base_url = str(server.make_url("")).rstrip("/")
+    try:
+        assert facade.all_users() == {1: {"employeeId": 1, "skills": ["python"]}}
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), facade._loop).result()
+        facade.close()
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    hits = []
+    app = make_api()
+
+    @web.middleware
+    async def count(request, handler):
+        hits.append(request.path)
+        return await handler(request)
+
+    app.middlewares.append(count)
+
+    async def fetch():
+        server = TestServer(app)
+        await server.start_server()
+        ds = AsyncDatasource(
+            str(server.make_url("")).rstrip("/"), "key", cache_ttls={"/users": 0}
+        )
+        try:
+            return await asyncio.gather(*(ds.all_users() for _ in range(5)))
+        finally:
+            await ds.close()
+            await server.close()
+
+    results = asyncio.run(fetch())
+    assert len(results) == 5
+    assert hits == ["/users"]
+
+
+def test_last_good_response_is_served_while_api_fails():
+    async def fetch():
+        server = TestServer(make_api())
+        await server.start_server()
+        url = str(server.make_url("")).rstrip("/")
+        ds = AsyncDatasource(url, "key", cache_ttls={"/users": 0.01}, max_stale=0)
+        ds.breaker = CircuitBreaker(min_requests=3, reset_timeout=60)
+        try:
+            users = await ds.all_users()
+            await server.close()
+            await asyncio.sleep(0.01)
+            assert await ds.all_users() == users
+            ds.clear_cache()
+            with pytest.raises(requests.ConnectionError):
+                await ds.all_users()
+            with pytest.raises(CircuitOpen):
+                await ds.all_users()
+        finally:
+            await ds.close()
+
+    asyncio.run(fetch())
+
+
+def test_allocation_windows_are_cached_once():
+    hits = []
+    app = make_api()
+
+    @web.middleware
+    async def count(request, handler):
+        hits.append(request.path)
+        return await handler(request)
+
+    app.middlewares.append(count)
+
+    async def fetch():
+        server = TestServer(app)
+        await server.start_server()
+        ds = AsyncDatasource(str(server.make_url("")).rstrip("/"), "key")
+        weeks = YearWeek(2020, 1), YearWeek(2020, 5)
+        try:
+            await asyncio.gather(*(ds.allocations_within(*weeks) for _ in range(3)))
+            await ds.allocations_within(*weeks)
+            # only in the allocation cache, not in the response cache
+            assert ds.allocation_cache.has(*weeks)
+            assert ds.cache.size == 0
+        finally:
+            await ds.close()
+            await server.close()
+
+    asyncio.run(fetch())
+    assert hits == ["/allocations"]
+
+
+def test_slowly_sent_body_times_out(monkeypatch):
+    monkeypatch.setattr(async_datasource, "CONNECT_TIMEOUT", 0.1)
+
+    async def drip(request):
+        res = web.StreamResponse()
+        await res.prepare(request)
+        for _ in range(20):
+            await res.write(b" ")
+            await asyncio.sleep(0.05)
+        await res.write(b"[]")
+        return res
+
+    app = web.Application()
+    app.router.add_get("/users", drip)
+
+    async def fetch():
+        server = TestServer(app)
+        await server.start_server()
+        url = str(server.make_url("")).rstrip("/")
+        ds = AsyncDatasource(url, "key", timeouts={"/users": 0.2})
+        try:
+            t = time.perf_counter()
+            with pytest.raises(Timeout):
+                await ds.all_users()
+            return time.perf_counter() - t
+        finally:
+            await ds.close()
+            await server.close()
+
+    assert asyncio.run(fetch()) < 0.5
@@ -0,0 +1,117 @@
+import re
+from datetime import timedelta
+
+import pytest
+import requests
+
+from bot.bot import FIND_QUERY_PATTERN, Bot, CandidateQuery, Command
+from bot.data_api.datasource import CircuitOpen, Datasource, Timeout
+from bot.helpers import YearWeek
+from tests.mock_api import API_KEY, load_mock_api, serve
+
+CURRENT_WEEK = YearWeek(2020, 10)
+
+
+@pytest.fixture(autouse=True)
+def current_week(monkeypatch):
+    monkeypatch.setattr(YearWeek, "now", classmethod(lambda cls: CURRENT_WEEK))
+
+
+def parse(command, message):
+    match = re.compile(command + FIND_QUERY_PATTERN, re.IGNORECASE).match(message)
+    query = Bot._parse_candidate_query(match)
+    return query._replace(skills=sorted(query.skills))
+
+
+@pytest.mark.parametrize("command", [r"find\s+", r"find\s+team\s+"])
+def test_find_queries_are_parsed(command):
+    prefix = "find team " if "team" in command else "find "
+    assert parse(command, prefix + "python, java") == CandidateQuery(
+        ["java", "python"], CURRENT_WEEK
+    )
+    assert parse(command, prefix + "w12 python") == CandidateQuery(
+        ["python"], YearWeek(2020, 12)
+    )
+    # the weeks before the current one are next year
+    assert parse(command, prefix + "w5-w12 60% free python, java") == (
+        CandidateQuery(["java", "python"], YearWeek(2021, 5), YearWeek(2021, 12), 60)
+    )
+    assert parse(command, prefix + "w12-w5 python") == CandidateQuery(
+        ["python"], YearWeek(2020, 12), YearWeek(2021, 5)
+    )
+    # a percentage alone is for the current week
+    assert parse(command, prefix + "50% python") == CandidateQuery(
+        ["python"], CURRENT_WEEK, CURRENT_WEEK, 50
+    )
+
+
+@pytest.mark.parametrize("message", ["find w54 python", "find 101% free python"])
+def test_invalid_find_queries_are_rejected(message):
+    with pytest.raises(ValueError):
+        parse(r"find\s+", message)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        CandidateQuery(["python", "java"], YearWeek(2020, 52)),
+        CandidateQuery(["python"], YearWeek(2020, 52), YearWeek(2021, 3)),
+        CandidateQuery(["python"], YearWeek(2020, 5), YearWeek(2020, 5), 60),
+    ],
+)
+def test_candidate_query_encoding_round_trips(query):
+    assert CandidateQuery.decode(query.encode()) == query
+
+
+def test_candidate_query_older_encoding_is_decoded():
+    assert CandidateQuery.decode("python,java_2020_5") == CandidateQuery(
+        ["python", "java"], YearWeek(2020, 5)
+    )
+
+
+def test_free_capacity_is_described_only_when_requested():
+    query = CandidateQuery(["python"], CURRENT_WEEK, CURRENT_WEEK)
+    assert query.free_str() == "free"
+    assert query._replace(min_free=60).free_str() == "at least 60% free"
+
+
+class StubRecommender:
+    "Recommender matching the given employees with every query"
+
+    def __init__(self, matches):
+        self.matches = matches
+
+    def skill_matches(self, _skills):
+        return self.matches
+
+
+def test_similar_skill_matches_survive_api_search():
+    source = load_mock_api().source
+    start = YearWeek.from_string(source.weeks[0])
+    query = CandidateQuery(["SQL"], start, start + timedelta(weeks=4))
+    with serve("flask") as url:
+        bot = Bot.__new__(Bot)
+        bot.data_source = Datasource(url, API_KEY)
+        bot.recommender = StubRecommender({})
+        candidate = bot._search_candidates(query)[0][0]
+
+        # The stem of "SQLs" matches "SQL" in the recommender, but not in the api
+        query = query._replace(skills=["SQLs"])
+        assert bot._search_candidates(query) == []
+        bot.recommender = StubRecommender({candidate: {"SQLs": 1.0}})
+        assert [person[0] for person in bot._search_candidates(query)] == [candidate]
+        assert bot.data_source.search_available
+
+
+@pytest.mark.parametrize(
+    "error",
+    [Timeout("/users"), CircuitOpen("/users"), requests.ConnectionError("refused")],
+)
+def test_data_api_errors_are_replied(error):
+    def fail(*_args):
+        raise error
+
+    bot = Bot.__new__(Bot)
+    bot._is_signed_up = lambda _user_id: True
+    bot._commands = [Command("find", re.compile("find").match, fail)]
+    assert "connection issues" in bot.reply("ASDF", "find python")["text"]
@@ -0,0 +1,66 @@
+import pytest
+
+from bot.data_api.datasource import Datasource, Timeout
+from bot.data_api.mirror import DataMirror
+from bot.helpers import YearWeek
+
+USER = {"employeeId": 1, "role": "", "skills": ["python"], "wishes": []}
+
+
+def allocation(week, percentage):
+    return {"id": 1, "yearWeek": str(week), "percentage": percentage}
+
+
+class StubDatasource(Datasource):
+    "Datasource with stubbed api responses, which can be turned off"
+
+    def __init__(self, mirror):
+        super().__init__("http://localhost", "key", mirror=mirror)
+        self.api_down = False
+        self.week = YearWeek.now()
+
+    def _get(self, route, params=None):
+        if self.api_down:
+            raise Timeout(route)
+        if route == "/allocations":
+            allocations = [allocation(self.week, 50)]
+            return {"users": [{"employeeId": 1, "allocations": allocations}]}
+        return [USER]
+
+
+def test_allocation_ranges_from_mirror():
+    mirror = DataMirror(":memory:")
+    weeks = [YearWeek(2020, week) for week in range(1, 6)]
+    mirror.replace(
+        [USER], {1: [allocation(week, 10 * week.week) for week in weeks], 2: []},
+    )
+    assert mirror.allocations_within(weeks[1], weeks[3]) == {
+        1: [allocation(week, 10 * week.week) for week in weeks[1:4]]
+    }
+    assert len(mirror.allocations_within(weeks[2], None)[1]) == 3
+    assert mirror.all_users() == {1: USER}
+    assert mirror.skills_by_user() == {1: ["python"]}
+    assert mirror.user_info(2) is None
+
+
+def test_unsynced_mirror_is_not_read():
+    ds = StubDatasource(DataMirror(":memory:"))
+    assert ds.all_users() == {1: USER}
+    ds.api_down = True
+    with pytest.raises(Timeout):
+        ds.all_users()
+
+
+def test_mirror_is_read_on_cold_start_and_when_api_is_down():
+    mirror = DataMirror(":memory:")
+    mirror.replace([{**USER, "role": "old"}], {})
+    ds = StubDatasource(mirror)
+    # Before the first sync, the data of the previous run is used
+    assert ds.all_users()[1]["role"] == "old"
+
+    ds.sync_mirror()
+    assert ds.all_users() == {1: USER}
+    ds.api_down = True
+    assert ds.all_users() == {1: USER}
+    assert dict(ds.iter_skills_by_user()) == {1: ["python"]}
+    assert ds.allocations_within(ds.week, None) == {1: [allocation(ds.week, 50)]}
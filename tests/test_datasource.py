@@ -0,0 +1,316 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from bot.data_api.datasource import (
+    CircuitBreaker,
+    CircuitOpen,
+    Datasource,
+    NotFound,
+    Timeout,
+    DEFAULT_TIMEOUT,
+    NOT_MODIFIED,
+    cache_key,
+    weeks_between,
+)
+from bot.helpers import YearWeek
+
+SOME_WEEK = YearWeek(2020, 1)
+
+
+class StubDatasource(Datasource):
+    def __init__(self, responses):
+        super().__init__("http://localhost", "key")
+        self.responses = responses
+        self.requests = []
+
+    def _get(self, route, params=None):
+        self.requests.append((route, params))
+        response = self.responses[route]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_search_candidates_splits_users_and_allocations():
+    allocations = [{"id": 1, "yearWeek": str(SOME_WEEK), "percentage": 50}]
+    user = {"employeeId": 1, "role": "", "skills": ["python"], "wishes": []}
+    ds = StubDatasource({"/search": {"users": [{**user, "allocations": allocations}]}})
+    users, found_allocations = ds.search_candidates(
+        ["python"], SOME_WEEK, SOME_WEEK, 50
+    )
+    assert users == {1: user}
+    assert found_allocations == {1: allocations}
+    [(_, params)] = ds.requests
+    assert params["min_free"] == 50
+
+
+def test_missing_search_endpoint_is_not_requested_again():
+    ds = StubDatasource({"/search": NotFound("/search")})
+    for _ in range(2):
+        with pytest.raises(NotFound):
+            ds.search_candidates(["python"], SOME_WEEK, SOME_WEEK)
+    assert len(ds.requests) == 1
+
+
+def test_timeouts_by_route():
+    ds = Datasource("http://localhost", "key", timeouts={"/users": 30})
+    assert ds._timeout_for("/users")[1] == 30
+    assert ds._timeout_for("/user/123")[1] == ds.timeouts["/user"]
+    assert ds._timeout_for("/unknown")[1] == DEFAULT_TIMEOUT
+
+
+class FetchCountingDatasource(Datasource):
+    "Datasource with stubbed api responses, counting the fetches"
+
+    def __init__(self, **kwargs):
+        super().__init__("http://localhost", "key", **kwargs)
+        self.fetches = []
+        self.data = [{"employeeId": 1, "skills": []}]
+
+    def _fetch(self, route, params=None, etag=None):
+        self.fetches.append((route, etag))
+        if etag == "v1":
+            return NOT_MODIFIED
+        if route == "/allocations":
+            return {"users": []}, "v1", 100
+        if route == "/changes":
+            return self.changes, None, 100
+        return self.data, "v1", 100
+
+
+def test_fresh_responses_are_served_from_cache():
+    ds = FetchCountingDatasource()
+    for _ in range(3):
+        assert ds.all_users() == {1: ds.data[0]}
+    assert ds.fetches == [("/users", None)]
+
+
+def test_expired_response_is_revalidated_in_background():
+    ds = FetchCountingDatasource(cache_ttls={"/users": 0.01})
+    first = ds.all_users()
+    time.sleep(0.02)
+    assert ds.all_users() == first, "stale data is not served"
+    ds._refresher.shutdown(wait=True)
+    assert ds.fetches == [("/users", None), ("/users", "v1")]
+    ds.all_users()
+    assert len(ds.fetches) == 2, "revalidated data is not fresh"
+
+
+def test_cache_is_bounded_by_size():
+    ds = FetchCountingDatasource(cache_max_bytes=250)
+    for week in range(1, 4):
+        ds.allocations_within(YearWeek(2020, week), None)
+    assert ds.cache.size <= 250
+    ds.allocations_within(YearWeek(2020, 1), None)
+    assert len(ds.fetches) == 4, "least recently used response was not evicted"
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    class SlowDatasource(FetchCountingDatasource):
+        def _fetch(self, route, params=None, etag=None):
+            time.sleep(0.1)
+            return super()._fetch(route, params, etag)
+
+    ds = SlowDatasource(cache_ttls={"/users": 0})
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: ds.all_users(), range(8)))
+    assert all(result == results[0] for result in results)
+    assert len(ds.fetches) == 1
+    ds.all_users()
+    assert len(ds.fetches) == 2, "finished request was coalesced"
+
+
+def test_changes_are_applied_to_cached_users():
+    ds = FetchCountingDatasource()
+    ds.all_users()
+    ds.changes = {
+        "token": "1",
+        "users": [{"employeeId": 2, "skills": ["go"]}],
+        "deleted": [1],
+    }
+    ds.sync_changes()
+    assert ds.all_users() == {2: {"employeeId": 2, "skills": ["go"]}}
+    assert ds.skills_by_user() == {1: []}, "uncached response was patched"
+
+    ds.changes = {"token": "2", "users": [{"employeeId": 2, "skills": []}]}
+    ds.sync_changes()
+    assert ds.all_users() == {2: {"employeeId": 2, "skills": []}}
+    assert ds.fetches == [
+        ("/users", None),
+        ("/changes", None),
+        ("/skills", None),
+        ("/changes", None),
+    ]
+
+
+def test_synced_users_are_not_expired_by_ttl():
+    ds = FetchCountingDatasource(cache_ttls={"/users": 0.01}, max_stale=0)
+    ds.all_users()
+    ds.changes = {"token": "1", "users": [], "deleted": []}
+    ds.sync_changes()
+    time.sleep(0.02)
+    ds.all_users()
+    assert ds.cache.get(cache_key("/users")).etag == "v1", "unchanged ETag was dropped"
+
+    ds.changes = {"token": "2", "users": [{"employeeId": 2, "skills": []}]}
+    ds.sync_changes()
+    time.sleep(0.02)
+    assert ds.all_users() == {1: ds.data[0], 2: {"employeeId": 2, "skills": []}}
+    assert ds.fetches == [("/users", None), ("/changes", None), ("/changes", None)]
+
+    ds.synced_ttl = 0.01
+    ds.sync_changes()
+    time.sleep(0.02)
+    ds.all_users()
+    assert ds.fetches[-1] == ("/users", None), "patched response was revalidated"
+
+
+class FlakySession:
+    "Stand-in for the requests session of a Datasource, failing on demand"
+
+    def __init__(self):
+        self.failing = False
+        self.requests = 0
+        self.body = b'[{"employeeId": 1, "skills": []}]'
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        if self.failing:
+            raise Timeout(url)
+        res = requests.Response()
+        res.status_code = 200
+        res.raw = io.BytesIO(self.body)
+        return res
+
+
+def test_circuit_breaker_fails_fast_until_trial_succeeds():
+    changes = []
+    breaker = CircuitBreaker(
+        min_requests=2,
+        reset_timeout=0.05,
+        on_state_change=lambda old, new: changes.append(new),
+    )
+    ds = Datasource(
+        "http://localhost", "key", cache_ttls={"/users": 0}, breaker=breaker
+    )
+    ds.session = FlakySession()
+    ds.session.failing = True
+    for _ in range(2):
+        with pytest.raises(Timeout):
+            ds.all_users()
+    with pytest.raises(CircuitOpen):
+        ds.all_users()
+    assert ds.session.requests == 2
+
+    time.sleep(0.05)
+    ds.session.failing = False
+    assert ds.all_users() == {1: {"employeeId": 1, "skills": []}}
+    assert changes == ["open", "half-open", "closed"]
+
+
+@pytest.mark.parametrize("page_size", [1000, 0])
+def test_breaker_opens_again_when_trial_body_fails(page_size):
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=0.01)
+    ds = Datasource(
+        "http://localhost",
+        "key",
+        cache_ttls={"/users": 0},
+        breaker=breaker,
+        page_size=page_size,
+    )
+    ds.session = FlakySession()
+    ds.session.failing = True
+    with pytest.raises(Timeout):
+        list(ds.iter_users())
+    assert breaker.state == "open"
+
+    time.sleep(0.01)
+    ds.session.failing = False
+    # the trial gets the headers, but its body is cut off
+    ds.session.body = b'[{"employeeId": 1, "skills": [}'
+    with pytest.raises(ValueError):
+        list(ds.iter_users())
+    assert breaker.state == "open"
+
+    time.sleep(0.01)
+    ds.session.body = b'[{"employeeId": 1, "skills": []}]'
+    assert list(ds.iter_users()) == [{"employeeId": 1, "skills": []}]
+    assert breaker.state == "closed"
+
+
+def test_last_good_response_is_served_while_api_fails():
+    ds = Datasource("http://localhost", "key", cache_ttls={"/users": 0.01}, max_stale=0)
+    ds.session = FlakySession()
+    users = ds.all_users()
+    time.sleep(0.01)
+    ds.session.failing = True
+    assert ds.all_users() == users
+    assert ds.session.requests == 2
+
+
+class AllocationDatasource(Datasource):
+    "Datasource with an allocation of every week, recording the fetched ranges"
+
+    def __init__(self):
+        super().__init__("http://localhost", "key")
+        self.ranges = []
+
+    def _fetch(self, route, params=None, etag=None):
+        start = YearWeek.from_string(params["start"])
+        end = YearWeek.from_string(params["end"])
+        self.ranges.append((start, end))
+        allocations = [
+            {"id": 1, "yearWeek": str(week), "percentage": 50}
+            for week in weeks_between(start, end)
+        ]
+        return {"users": [{"employeeId": 1, "allocations": allocations}]}, None, 100
+
+
+def test_only_missing_weeks_are_fetched():
+    ds = AllocationDatasource()
+    weeks = [YearWeek(2020, week) for week in range(1, 11)]
+    ds.allocations_within(weeks[2], weeks[4])
+    allocations = ds.allocations_within(weeks[0], weeks[9])
+    assert [a["yearWeek"] for a in allocations[1]] == [str(week) for week in weeks]
+    assert ds.ranges == [
+        (weeks[2], weeks[4]),
+        (weeks[0], weeks[1]),
+        (weeks[5], weeks[9]),
+    ]
+    ds.allocations_within(weeks[1], weeks[8])
+    assert len(ds.ranges) == 3
+
+
+class PagedDatasource(Datasource):
+    "Datasource with a paginated /users of ten users"
+
+    def __init__(self, **kwargs):
+        super().__init__("http://localhost", "key", **kwargs)
+        self.pages = []
+
+    def _fetch(self, route, params=None, etag=None):
+        self.pages.append(params.get("after"))
+        after = params.get("after", 0)
+        ids = list(range(after + 1, min(after + params["limit"], 10) + 1))
+        users = [{"employeeId": i} for i in ids]
+        return {"users": users, "next": ids[-1] if ids[-1] < 10 else None}, None, 10
+
+
+def test_pages_are_fetched_lazily():
+    ds = PagedDatasource(page_size=4)
+    users = ds.iter_users()
+    assert [next(users)["employeeId"] for _ in range(5)] == [1, 2, 3, 4, 5]
+    assert ds.pages == [None, 4]
+    assert [user["employeeId"] for user in users] == [6, 7, 8, 9, 10]
+    assert ds.pages == [None, 4, 8]
+
+
+def test_pages_are_not_cached():
+    ds = PagedDatasource(page_size=4, cache_ttls={"/users": 60})
+    assert len(list(ds.iter_users())) == len(list(ds.iter_users())) == 10
+    assert ds.pages == [None, 4, 8] * 2
+    assert ds.cache.size == 0
@@ -1,6 +1,7 @@
 import pytest
 
 from bot.searches import find_kit
+from bot.helpers import YearWeek
 
 SOME_WEEK = "2020-W01"
 
@@ -48,3 +49,106 @@ def test_person_with_100_percent_allocation_is_excluded(percentages):
     found = find_kit.find_person_by_skills(skills, users, allocation, SOME_WEEK)
     for _, _, allocations in found:
         assert all(week != SOME_WEEK for week, _ in allocations)
+
+
+def test_weekly_availability_range_queries():
+    free = [100, 40, 60, 0, 80, 20, 100]
+    availability = find_kit.WeeklyAvailability(free)
+    for first in range(len(free)):
+        for last in range(first, len(free)):
+            window = free[first : last + 1]
+            assert availability.min_free(first, last) == min(window)
+            assert availability.total_free(first, last) == sum(window)
+
+
+def test_person_free_enough_for_whole_range_is_found():
+    employee_id = 0
+    skills = ["matching skill"]
+    users = sample_users_with(employee_id, skills)
+    start, end = YearWeek(2020, 1), YearWeek(2020, 4)
+    allocation = {
+        employee_id: [{"yearWeek": "2020-W02", "percentage": 40}],
+        1: [{"yearWeek": "2020-W03", "percentage": 80}],
+    }
+    found = find_kit.find_person_available_in_range(
+        skills, users, allocation, start, end, 60
+    )
+    [(found_id, found_skills, [(_, allocated)])] = found
+    assert found_id == employee_id, "wrong person"
+    assert set(found_skills) == set(skills), "wrong skill set"
+    assert allocated == pytest.approx(0.4)
+
+    found = find_kit.find_person_available_in_range(
+        skills, users, allocation, start, end, 61
+    )
+    assert not found, "person is not free enough for every week"
+
+
+def test_range_candidates_are_sorted_by_busiest_week():
+    skills = ["matching skill"]
+    users = {i: {"employeeId": i, "skills": skills} for i in (1, 2, 3)}
+    allocation = {
+        1: [{"yearWeek": "2020-W02", "percentage": 50}],
+        2: [{"yearWeek": "2020-W03", "percentage": 10}],
+    }
+    found = find_kit.find_person_available_in_range(
+        skills, users, allocation, YearWeek(2020, 1), YearWeek(2020, 4), 0
+    )
+    assert [employee_id for employee_id, _, _ in found] == [3, 2, 1]
+
+
+def test_smallest_cover_beats_greedy():
+    # greedy takes 0b111000 first and needs three masks, two are enough
+    masks = [0b111000, 0b110100, 0b001011]
+    assert sorted(find_kit.smallest_cover(masks, 0b111111)) == sorted(
+        [0b110100, 0b001011]
+    )
+
+
+def test_smallest_available_team_is_found():
+    users = {
+        1: {"employeeId": 1, "skills": ["a", "b"]},
+        2: {"employeeId": 2, "skills": ["c"]},
+        3: {"employeeId": 3, "skills": ["a", "b", "c"]},
+        4: {"employeeId": 4, "skills": None},
+    }
+    week = YearWeek(2020, 1)
+    team, missing = find_kit.find_team(["a", "b", "c", "d"], users, {}, week, week, 0)
+    assert [employee_id for employee_id, _, _ in team] == [3]
+    assert missing == ["d"]
+
+    allocation = {3: [{"yearWeek": str(week), "percentage": 100}]}
+    team, missing = find_kit.find_team(
+        ["a", "b", "c"], users, allocation, week, week, 0
+    )
+    assert sorted(employee_id for employee_id, _, _ in team) == [1, 2]
+    assert not missing
+
+
+def test_exact_matches_are_found_with_skill_weights():
+    users = sample_users_with(0, ["Matching Skill"])
+    # Employee 0 is not known to the recommender, e.g. a new hire
+    skill_weights = {1: {"skill 1": 0.5}}
+    found = find_kit.find_person_by_skills(
+        ["matching skill"], users, {}, SOME_WEEK, skill_weights
+    )
+    assert [(employee_id, skills) for employee_id, skills, _ in found] == [
+        (0, ("matching skill",)),
+        (1, ("skill 1",)),
+    ]
+
+
+def test_team_skills_are_matched_ignoring_case():
+    users = {
+        1: {"employeeId": 1, "skills": ["Python "]},
+        2: {"employeeId": 2, "skills": ["sql"]},
+    }
+    week = YearWeek(2020, 1)
+    team, missing = find_kit.find_team(
+        ["python", "SQL", "Python"], users, {}, week, week, 0
+    )
+    assert sorted(team_skills for _, team_skills, _ in team) == [
+        ("SQL",),
+        ("python",),
+    ]
+    assert not missing
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from bot.data_api.json_stream import iter_array_items
+
+
+def chunked(data: bytes, size: int):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("chunk_size", (1, 3, 64, 100000))
+def test_array_items_at_key_are_decoded(chunk_size):
+    document = {
+        "endYearWeek": None,
+        "startYearWeek": "2020-W01",
+        "users": [
+            {
+                "employeeId": i,
+                "allocations": [{"id": 123, "percentage": 50, "yearWeek": "2020-W01"}],
+                "role": "Kehittäjä",
+            }
+            for i in range(20)
+        ],
+    }
+    data = json.dumps(document, ensure_ascii=False).encode()
+    items = iter_array_items(chunked(data, chunk_size), "users")
+    assert list(items) == document["users"]
+
+
+@pytest.mark.parametrize("chunk_size", (1, 2, 5))
+def test_numbers_split_between_chunks(chunk_size):
+    array = [1, 22, 333, 4444, "text", None]
+    data = json.dumps(array).encode()
+    assert list(iter_array_items(chunked(data, chunk_size))) == array
+
+
+def test_empty_arrays():
+    assert list(iter_array_items([b"[ ]"])) == []
+    assert list(iter_array_items([b'{"users": []}'], "users")) == []
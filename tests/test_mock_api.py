@@ -0,0 +1,148 @@
+""" Route contract of the mock data api, which both servers must keep
+
+The tests request the api over HTTP from the Flask app and the aiohttp
+server, both serving the same synthetic company.
+"""
+import pytest
+import requests
+
+from tests.mock_api import API_KEY, SERVERS, load_mock_api, serve
+
+WEEKS = {"start": "2020-W01", "end": "2020-W10"}
+
+
+@pytest.fixture(scope="module", params=SERVERS)
+def base_url(request):
+    with serve(request.param) as url:
+        yield url
+
+
+@pytest.fixture(scope="module")
+def mock_api():
+    return load_mock_api()
+
+
+def get(base_url, path, params=None, **headers):
+    return requests.get(
+        base_url + path, params=params, headers={"x-api-key": API_KEY, **headers}
+    )
+
+
+def test_api_key_is_required(base_url):
+    assert requests.get(base_url + "/users").status_code == 401
+    res = requests.get(base_url + "/users", headers={"x-api-key": "guess"})
+    assert res.status_code == 401
+
+
+def test_user(base_url, mock_api):
+    user_id = mock_api.source.user_ids[0]
+    user = mock_api.source.user_info(user_id)
+    assert get(base_url, f"/user/{user_id}").json() == user
+    res = get(base_url, "/user/999999999")
+    assert res.status_code == 404
+    assert res.json() == {}
+
+
+def test_collections(base_url, mock_api):
+    source = mock_api.source
+    assert get(base_url, "/users").json() == source.all_users()
+    skills = get(base_url, "/skills").json()
+    assert {item["employeeId"]: item["skills"] for item in skills} == {
+        user["employeeId"]: user["skills"] for user in source.all_users()
+    }
+    allocations = get(base_url, "/allocations", WEEKS).json()
+    assert allocations == {
+        "startYearWeek": WEEKS["start"],
+        "endYearWeek": WEEKS["end"],
+        "users": source.allocations_within(WEEKS["start"], WEEKS["end"]),
+        "next": None,
+    }
+
+
+def test_pages_cover_the_collection(base_url, mock_api):
+    users, after = [], None
+    while True:
+        page = get(base_url, "/users", {"limit": 300, "after": after}).json()
+        users += page["users"]
+        if page["next"] is None:
+            break
+        after = page["next"]
+    assert users == mock_api.source.all_users()
+
+    page = get(base_url, "/users", {"limit": 2, "fields": "skills"}).json()
+    assert [set(user) for user in page["users"]] == [{"employeeId", "skills"}] * 2
+
+
+@pytest.mark.parametrize(
+    "path, params",
+    [
+        ("/users", {"limit": 0}),
+        ("/skills", {"after": "first"}),
+        ("/allocations", {}),
+        ("/allocations", {"start": "2020-W01", "limit": "all"}),
+        ("/search", {"skills": "Python"}),
+        ("/search", {**WEEKS, "skills": "Python", "min_free": "some"}),
+        ("/search", {**WEEKS, "skills": "Python", "ids": "first"}),
+    ],
+)
+def test_invalid_parameters(base_url, path, params):
+    res = get(base_url, path, params)
+    assert res.status_code == 400
+    assert "error" in res.json()
+
+
+def test_search(base_url, mock_api):
+    params = {**WEEKS, "skills": ["Python", "SQL"], "min_free": 50}
+    assert get(base_url, "/search", params).json() == {
+        "startYearWeek": WEEKS["start"],
+        "endYearWeek": WEEKS["end"],
+        "users": mock_api.source.search(["Python", "SQL"], *WEEKS.values(), 50),
+    }
+    user_id = mock_api.source.user_ids[0]
+    params = {**WEEKS, "skills": "no such skill", "ids": [user_id, 999999999]}
+    found = get(base_url, "/search", params).json()["users"]
+    assert [user["employeeId"] for user in found] == [user_id]
+
+
+def test_changes(base_url, mock_api):
+    data = get(base_url, "/changes").json()
+    assert data["reset"]
+    assert data["token"] == mock_api.source.token()
+    data = get(base_url, "/changes", {"since": data["token"]}).json()
+    assert not data["reset"]
+    assert data["users"] == data["deleted"] == []
+
+
+def test_conditional_and_compressed_responses(base_url):
+    res = get(base_url, "/skills", **{"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in res.headers
+    etag = res.headers["ETag"]
+    assert get(base_url, "/skills", **{"If-None-Match": etag}).status_code == 304
+
+    compressed = get(base_url, "/skills", **{"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["ETag"] == "W/" + etag
+    assert compressed.json() == res.json()
+
+
+def test_examples(base_url, mock_api):
+    assert get(base_url, "/user/example").json() == mock_api.api.EXAMPLE_USER
+    allocations = mock_api.api.EXAMPLE_ALLOCATIONS
+    assert get(base_url, "/allocations/example").json() == allocations
+
+
+def test_collections_are_serialized_once(base_url, mock_api, monkeypatch):
+    first = get(base_url, "/users", {"limit": 10, "after": 5})
+    monkeypatch.setattr(
+        mock_api.source, "all_users", lambda *args: pytest.fail("not cached")
+    )
+    second = get(base_url, "/users", {"after": 5, "limit": 10})
+    assert second.content == first.content
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+
+def test_reload_invalidates_cached_responses(base_url, mock_api):
+    before = get(base_url, "/skills").json()
+    res = requests.post(base_url + "/reload", headers={"x-api-key": API_KEY})
+    assert res.json() == {"token": mock_api.source.token()}
+    assert get(base_url, "/skills").json() != before
@@ -0,0 +1,110 @@
+""" The datasource against the mock data api with injected faults
+
+The mock api serves a synthetic company in a thread, with both servers, and
+each test configures the faults through /admin/faults.
+"""
+import time
+
+import pytest
+import requests
+
+from bot.data_api.datasource import (
+    AccessDenied,
+    CircuitBreaker,
+    CircuitOpen,
+    Datasource,
+    Timeout,
+)
+from tests.mock_api import API_KEY, SERVERS, serve
+
+
+@pytest.fixture(scope="module", params=SERVERS)
+def base_url(request):
+    with serve(request.param) as url:
+        yield url
+
+
+@pytest.fixture
+def set_faults(base_url):
+    def set_faults(routes, seed=0):
+        res = requests.put(
+            base_url + "/admin/faults",
+            json={"seed": seed, "routes": routes},
+            headers={"x-api-key": API_KEY},
+        )
+        res.raise_for_status()
+
+    yield set_faults
+    requests.delete(base_url + "/admin/faults", headers={"x-api-key": API_KEY})
+
+
+def timed(func):
+    "Return the time taken by func, and its result or exception"
+    start = time.perf_counter()
+    try:
+        result = func()
+    except Exception as error:
+        result = error
+    return time.perf_counter() - start, result
+
+
+def test_tail_latency_is_bounded_by_timeout(base_url, set_faults):
+    set_faults({"/users": {"latency": {"median": 0.01, "p99": 1.0}}})
+    ds = Datasource(
+        base_url, API_KEY, timeouts={"/users": 0.2}, cache_ttls={"/users": 0}
+    )
+    ds.breaker = CircuitBreaker(min_requests=1000)
+    durations = []
+    for _ in range(50):
+        duration, result = timed(ds.all_users)
+        durations.append(duration)
+        assert isinstance(result, (dict, Timeout))
+    durations.sort()
+    # The api is fast most of the time, and the slow responses are cut off
+    assert durations[len(durations) // 2] < 0.1
+    assert durations[-1] < 0.5
+
+
+def test_slowly_sent_body_times_out(base_url, set_faults):
+    set_faults({"/users": {"drip": {"chunk_size": 1024, "interval": 0.1}}})
+    ds = Datasource(base_url, API_KEY, timeouts={"/users": 0.5})
+    duration, result = timed(ds.all_users)
+    assert isinstance(result, Timeout)
+    assert duration < 1.0
+
+
+def test_last_good_response_is_served_after_reset(base_url, set_faults):
+    ds = Datasource(base_url, API_KEY, cache_ttls={"/users": 0.01}, max_stale=0)
+    users = ds.all_users()
+    set_faults({"/users": {"reset": 1.0}})
+    time.sleep(0.01)
+    duration, result = timed(ds.all_users)
+    assert result == users
+    assert duration < 0.5
+
+
+def test_breaker_fails_fast_on_server_errors(base_url, set_faults):
+    set_faults({"*": {"errors": {"500": 1.0}}})
+    ds = Datasource(base_url, API_KEY, retries=0)
+    ds.breaker = CircuitBreaker(min_requests=5, reset_timeout=60)
+    for user_id in range(5):
+        assert ds.user_info(user_id) == {}
+    duration, result = timed(lambda: ds.user_info(100))
+    assert isinstance(result, CircuitOpen)
+    assert duration < 0.05
+
+
+def test_injected_errors_are_raised(base_url, set_faults):
+    set_faults({"/user": {"errors": {"401": 1.0}}})
+    ds = Datasource(base_url, API_KEY)
+    with pytest.raises(AccessDenied):
+        ds.user_info(1)
+
+
+def test_invalid_faults_are_rejected(base_url):
+    res = requests.put(
+        base_url + "/admin/faults",
+        json={"routes": {"*": {"errors": {"500": 2}}}},
+        headers={"x-api-key": API_KEY},
+    )
+    assert res.status_code == 400
@@ -64,3 +64,34 @@ def test_ignore_skills():
     assert all(
         n_ign in new_rec.recommendation_list for n_ign in not_ignored
     ), "Recommender ignored too many skills"
+
+
+def test_skill_matches_include_exact_matches():
+    skill = MockDatasource.skills[user_id][0]
+    matches = recommender.skill_matches([skill.upper()])
+
+    assert all(
+        employee_id in matches
+        for employee_id, skills in MockDatasource.skills.items()
+        if skill in skills
+    ), "Employee with the exact skill was not matched"
+    assert all(
+        0 < weight <= 1 for weights in matches.values() for weight in weights.values()
+    ), "Matches are not weighted by similarity"
+
+
+def test_update_user_skills():
+    updated = SkillRecommenderCF(MockDatasource())  # type: ignore
+    assert not updated.update_user_skills({750: MockDatasource.skills[750]})
+
+    skill_index = updated.skill_index
+    assert updated.update_user_skills({800: ["python", "rust"]}, deleted=[750])
+    assert 800 in updated.skill_matches(["rust"])
+    assert 750 not in updated.skill_matches(MockDatasource.skills[750])
+    assert updated.get_user_skills(750) == []
+    assert updated.get_user_skills(800) == ["python"], "rare skill was not ignored"
+    assert updated.skill_index is skill_index, "skill index was built again"
+
+    remaining = {user: ["python", "rust"] for user in (800, 801, 802)}
+    assert updated.update_user_skills(remaining, complete=True)
+    assert list(updated.skill_index.index) == [800, 801, 802]
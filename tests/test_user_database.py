@@ -1,4 +1,15 @@
-from bot.chatBotDatabase import get_database_object, User
+from concurrent.futures import ThreadPoolExecutor
+
+import datetime
+import sqlite3
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from bot import chatBotDatabase
+from bot.chatBotDatabase import get_database_object, User, WriteBehind
 
 
 def get_sqlite(in_memory: bool):
@@ -16,3 +27,215 @@ def test_in_memory():
     assert test_user == db.get_user_by_id(
         test_user.user_id
     ), "User is stored correctly in database"
+
+
+def test_due_users():
+    db = get_sqlite(True)
+    now = datetime.datetime(2020, 11, 1, 12)
+    users = [
+        User("later", 1, now + datetime.timedelta(hours=1)),
+        User("now", 2, now),
+        User("never", 3),
+        User("yesterday", 4, now - datetime.timedelta(days=1)),
+    ]
+    for user in users:
+        db.add_user(user)
+    assert list(db.get_due_users(now)) == [users[2], users[3], users[1]]
+    assert list(db.get_due_users(now, limit=2)) == [users[2], users[3]]
+    assert list(db.get_due_users(now, limit=1)) == [users[2]]
+    # the users without a reminder come first, then the most overdue
+    db.add_user(User("never again", 5))
+    db.add_user(User("last week", 6, now - datetime.timedelta(weeks=1)))
+    due = list(db.get_due_users(now))
+    assert [user.user_id for user in due[2:]] == ["last week", "yesterday", "now"]
+    assert {user.user_id for user in due[:2]} == {"never", "never again"}
+    assert list(db.get_due_users(now, limit=3)) == due[:3]
+
+
+# The plan output has been checked with SQLite 3.40, its format varies by version
+@pytest.mark.skipif(
+    sqlite3.sqlite_version_info < (3, 40), reason="query plan format of SQLite 3.40"
+)
+def test_due_users_are_read_through_index():
+    db = get_sqlite(True)
+    query = chatBotDatabase.DUE_USERS_QUERY.format(param="(?)", nulls_first="")
+    plan = db.connection.execute(
+        "EXPLAIN QUERY PLAN " + query, (datetime.datetime(2020, 11, 1),)
+    ).fetchall()
+    details = [row[-1] for row in plan]
+    assert sum("USING INDEX users_remind_next" in detail for detail in details) == 2
+    assert not any("TEMP B-TREE" in detail for detail in details)
+
+
+def test_batched_writes():
+    db = get_sqlite(True)
+    now = datetime.datetime(2020, 11, 1, 12)
+    db.add_user(User("ASDF", 1234))
+    db.add_history_many("ASDF", now, ["python", "go"])
+    assert sorted(db.get_history_by_user_id("ASDF")) == [
+        ("ASDF", now, "go"),
+        ("ASDF", now, "python"),
+    ]
+
+    writes = WriteBehind(db)
+    writes.set_next_reminder("ASDF", now)
+    writes.set_next_reminder("gone", now)
+    writes.add_history_many("ASDF", now, ["rust"])
+    writes.add_history_many("gone", now, ["rust"])
+    assert db.get_user_by_id("ASDF").remind_next is None
+    assert writes.next_reminder("ASDF") == now
+    assert writes.history("ASDF") == [("ASDF", now, "rust")]
+    writes.flush()
+    assert db.get_user_by_id("ASDF").remind_next == now
+    assert len(db.get_history_by_user_id("ASDF")) == 3
+    assert db.get_history_by_user_id("gone") == []
+    assert writes.next_reminder("ASDF") is None
+    assert writes.history("ASDF") == []
+
+    # A batch written again, e.g. after a dropped connection, is not duplicated
+    db.write_batch([("ASDF", now)], [("ASDF", now, "rust")])
+    assert len(db.get_history_by_user_id("ASDF")) == 3
+
+
+class BlockingDatabase:
+    "Database whose write_batch waits for the test, and then fails or succeeds"
+
+    def __init__(self):
+        self.writing = threading.Event()
+        self.proceed = threading.Event()
+        self.fail = False
+        self.batches = []
+
+    def write_batch(self, reminders, history):
+        self.writing.set()
+        if not self.proceed.wait(1):
+            raise TimeoutError("the test did not proceed, blocked by the writes")
+        if self.fail:
+            raise psycopg2.OperationalError("server closed the connection")
+        self.batches.append((dict(reminders), list(history)))
+
+
+def test_writes_are_buffered_while_flushing():
+    db = BlockingDatabase()
+    writes = WriteBehind(db)
+    first, second = datetime.datetime(2020, 11, 1), datetime.datetime(2020, 11, 2)
+    writes.set_next_reminder("ASDF", first)
+    writes.add_history_many("ASDF", first, ["rust"])
+    db.fail = True
+    with ThreadPoolExecutor(1) as executor:
+        flushed = executor.submit(writes.flush)
+        assert db.writing.wait(5)
+        # not blocked by the transaction, and the batch is still visible
+        assert writes.next_reminder("ASDF") == first
+        writes.set_next_reminder("ASDF", second)
+        writes.set_next_reminder("QWER", second)
+        writes.add_history_many("ASDF", second, ["go"])
+        assert writes.history("ASDF") == [
+            ("ASDF", first, "rust"),
+            ("ASDF", second, "go"),
+        ]
+        db.proceed.set()
+        assert isinstance(flushed.exception(5), psycopg2.OperationalError)
+
+    # the failed batch is kept, under the writes made meanwhile
+    assert writes.next_reminder("ASDF") == second
+    db.fail = False
+    writes.flush()
+    assert db.batches == [
+        (
+            {"ASDF": second, "QWER": second},
+            [("ASDF", first, "rust"), ("ASDF", second, "go")],
+        )
+    ]
+    assert writes.history("ASDF") == []
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, params=()):
+        if self.conn.drop_on_query:
+            self.conn.closed = 1
+            raise psycopg2.OperationalError("server closed the connection")
+        self.conn.pool.queries.append(query)
+
+    def fetchall(self):
+        return [("ASDF", 1234, None)]
+
+
+class FakeConnection:
+    "Connection of FakePool, which can be dropped by the server"
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = 0
+        self.drop_on_query = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakePool:
+    "Stand-in for ThreadedConnectionPool, recording the connections in use"
+
+    def __init__(self, minconn, maxconn, dsn):
+        self.maxconn = maxconn
+        self.idle = []
+        self.in_use = 0
+        self.max_in_use = 0
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            self.in_use += 1
+            assert self.in_use <= self.maxconn, "connection pool exhausted"
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            return self.idle.pop() if self.idle else FakeConnection(self)
+
+    def putconn(self, conn, close=False):
+        time.sleep(0.01)
+        with self.lock:
+            self.in_use -= 1
+            if not close:
+                self.idle.append(conn)
+
+    def closeall(self):
+        pass
+
+
+def test_postgres_connections_are_pooled(monkeypatch):
+    monkeypatch.setattr(chatBotDatabase, "ThreadedConnectionPool", FakePool)
+    db = get_database_object("postgres", "dbname=test", pool_size=2)
+    with ThreadPoolExecutor(8) as executor:
+        users = list(executor.map(db.get_user_by_id, ["ASDF"] * 16))
+    assert users == [User("ASDF", 1234)] * 16
+    assert db._pool.max_in_use == 2
+
+    # A connection dropped by the server is replaced, and the query retried
+    for conn in db._pool.idle:
+        conn.drop_on_query = True
+    db.health_check_idle = 60
+    assert db.get_user_by_id("ASDF") == User("ASDF", 1234)
+
+    # Writes are not retried, they may have been committed before the drop
+    for conn in db._pool.idle:
+        conn.drop_on_query = True
+    queries = len(db._pool.queries)
+    with pytest.raises(psycopg2.OperationalError):
+        db.add_history("ASDF", datetime.datetime(2020, 11, 1), "go")
+    assert len(db._pool.queries) == queries